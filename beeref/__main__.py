@@ -25,6 +25,7 @@ from PyQt6 import QtCore, QtWidgets
 from beeref import constants
 from beeref.assets import BeeAssets
 from beeref.config import CommandlineArgs, BeeSettings, logfile_name
+from beeref.profiler import profiler
 from beeref.utils import create_palette_from_dict
 from beeref.view import BeeGraphicsView
 
@@ -68,7 +69,8 @@ class BeeRefMainWindow(QtWidgets.QMainWindow):
         event.accept()
 
     def __del__(self):
-        del self.view
+        if hasattr(self, 'view'):
+            del self.view
 
 
 def safe_timer(timeout, func, *args, **kwargs):
@@ -105,7 +107,7 @@ def main():
     settings = BeeSettings()
     logger.info(f'Using settings: {settings.fileName()}')
     logger.info(f'Logging to: {logfile_name()}')
-    CommandlineArgs(with_check=True)  # Force checking
+    args = CommandlineArgs(with_check=True)  # Force checking
     app = BeeRefApplication(sys.argv)
     palette = create_palette_from_dict(constants.COLORS)
     app.setPalette(palette)
@@ -118,6 +120,8 @@ def main():
     safe_timer(50, lambda: None)
 
     app.exec()
+    if args.profile_trace:
+        profiler.write_trace(args.profile_trace)
     del bee
     del app
     logger.debug('BeeRef closed')
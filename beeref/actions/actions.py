@@ -244,6 +244,11 @@ actions = [
         'text': 'Show &Debug Log',
         'callback': 'on_action_debuglog',
     },
+    {
+        'id': 'memory_usage',
+        'text': 'Show &Memory Usage',
+        'callback': 'on_action_memory_usage',
+    },
     {
         'id': 'show_scrollbars',
         'text': 'Show &Scrollbars',
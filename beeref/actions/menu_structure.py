@@ -112,6 +112,7 @@ menu_structure = [
             'help',
             'about',
             'debuglog',
+            'memory_usage',
         ],
     },
 ]
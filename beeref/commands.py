@@ -13,10 +13,165 @@
 # You should have received a copy of the GNU General Public License
 # along with BeeRef.  If not, see <https://www.gnu.org/licenses/>.
 
-from PyQt6 import QtCore, QtGui
+import array
+import contextlib
+import functools
 
+from PyQt6 import QtGui
 
-class InsertItems(QtGui.QUndoCommand):
+from beeref.geometry import GeometrySnapshot
+
+
+def _mark_items_dirty(func):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        func(self, *args, **kwargs)
+        items = self.items if hasattr(self, 'items') else [self.item]
+        for item in items:
+            item.dirty = True
+
+    return wrapper
+
+
+def changes_items(cls):
+    """Class decorator for commands that change properties of their items
+    which get written to the bee file.
+
+    Marks the items as dirty on redo and undo. This also covers changes
+    that were made before the command was pushed with
+    ``ignore_first_redo``, e.g. moving items with the mouse.
+    """
+
+    cls.redo = _mark_items_dirty(cls.redo)
+    cls.undo = _mark_items_dirty(cls.undo)
+    return cls
+
+
+def bulk_transform(items):
+    """Context manager for changing many items at once, see
+    ``BeeGraphicsScene.bulk_transform``."""
+
+    scene = items[0].scene() if items else None
+    if scene and hasattr(scene, 'bulk_transform'):
+        return scene.bulk_transform(items)
+    return contextlib.nullcontext()
+
+
+def pack_transforms(items):
+    """Packs position, scale, rotation and flip of the given items into
+    one flat array of doubles, five values per item."""
+
+    values = array.array('d')
+    for item in items:
+        values.extend(item.transform_state())
+    return values
+
+
+def apply_transforms(items, values):
+    """Sets position, scale, rotation and flip of the given items from
+    an array returned by ``pack_transforms``."""
+
+    with bulk_transform(items):
+        for i, item in enumerate(items):
+            item.set_transform_state(*values[i * 5:i * 5 + 5])
+
+
+class TransformItems(QtGui.QUndoCommand):
+    """Base for commands that change position, scale, rotation or flip
+    of many items at once.
+
+    Subclasses implement ``transform``, which does the actual work on
+    the first redo. The items' states before and after are kept as
+    packed arrays, so that undo and any further redo only need to set
+    them again instead of repeating the calculations item by item.
+    """
+
+    def __init__(self, text, items):
+        super().__init__(text)
+        self.items = items
+        self.before = None
+        self.after = None
+
+    def transform(self):
+        raise NotImplementedError
+
+    def redo(self):
+        if self.after is None:
+            self.before = pack_transforms(self.items)
+            with bulk_transform(self.items):
+                self.transform()
+            self.after = pack_transforms(self.items)
+        else:
+            apply_transforms(self.items, self.after)
+
+    def undo(self):
+        apply_transforms(self.items, self.before)
+
+
+class BeeUndoStack(QtGui.QUndoStack):
+    """Undo stack that keeps track of the memory its commands keep alive.
+
+    Commands report the memory of items they hold on to which aren't
+    in the scene (e.g. deleted items) via ``retained_bytes``. Qt's undo
+    stack can't drop single commands, so when the retained memory
+    exceeds the budget, the images of the oldest commands get spilled
+    to temporary files instead.
+    """
+
+    def iter_commands(self):
+        """All commands on the stack, oldest first, including the
+        commands inside macros."""
+
+        def walk(command):
+            yield command
+            for i in range(command.childCount()):
+                yield from walk(command.child(i))
+
+        for i in range(self.count()):
+            yield from walk(self.command(i))
+
+    def retained_bytes(self):
+        return sum(command.retained_bytes()
+                   for command in self.iter_commands()
+                   if hasattr(command, 'retained_bytes'))
+
+    def enforce_memory_budget(self, budget):
+        """Spill the images retained by the oldest commands until the
+        remaining ones fit into the given budget (bytes)."""
+
+        commands = [command for command in self.iter_commands()
+                    if hasattr(command, 'retained_bytes')]
+        total = sum(command.retained_bytes() for command in commands)
+        for command in commands:
+            if total <= budget:
+                break
+            total -= command.spill()
+
+
+class RetainsItems(QtGui.QUndoCommand):
+    """Base for commands whose items aren't in the scene while the
+    command is done or undone, but need to be kept for undo or redo."""
+
+    def retained_items(self):
+        return (item for item in self.items
+                if not item.scene() and hasattr(item, 'memory_bytes'))
+
+    def retained_bytes(self):
+        """The memory taken up by items that are only kept alive by
+        this command."""
+
+        return sum(item.memory_bytes() for item in self.retained_items())
+
+    def spill(self):
+        """Move the image data of retained items to temporary files.
+
+        :returns: The number of bytes freed
+        """
+
+        return sum(item.spill_pixmap() for item in self.retained_items())
+
+
+class InsertItems(RetainsItems):
 
     def __init__(self, scene, items, position=None, ignore_first_redo=False):
         super().__init__('Insert items')
@@ -49,7 +204,7 @@ class InsertItems(QtGui.QUndoCommand):
                 item.setPos(pos)
 
 
-class DeleteItems(QtGui.QUndoCommand):
+class DeleteItems(RetainsItems):
 
     def __init__(self, scene, items):
         super().__init__('Delete items')
@@ -58,6 +213,10 @@ class DeleteItems(QtGui.QUndoCommand):
 
     def redo(self):
         for item in self.items:
+            if hasattr(item, 'detach_from_file'):
+                # The file we would load from won't keep the image
+                # data of deleted items around
+                item.detach_from_file()
             self.scene.removeItem(item)
 
     def undo(self):
@@ -67,6 +226,7 @@ class DeleteItems(QtGui.QUndoCommand):
             self.scene.addItem(item)
 
 
+@changes_items
 class MoveItemsBy(QtGui.QUndoCommand):
 
     def __init__(self, items, delta, ignore_first_redo=False):
@@ -79,14 +239,17 @@ class MoveItemsBy(QtGui.QUndoCommand):
         if self.ignore_first_redo:
             self.ignore_first_redo = False
             return
-        for item in self.items:
-            item.moveBy(self.delta.x(), self.delta.y())
+        with bulk_transform(self.items):
+            for item in self.items:
+                item.moveBy(self.delta.x(), self.delta.y())
 
     def undo(self):
-        for item in self.items:
-            item.moveBy(-self.delta.x(), -self.delta.y())
+        with bulk_transform(self.items):
+            for item in self.items:
+                item.moveBy(-self.delta.x(), -self.delta.y())
 
 
+@changes_items
 class ScaleItemsBy(QtGui.QUndoCommand):
     """Scale items by a given factor around the given anchor."""
 
@@ -101,16 +264,19 @@ class ScaleItemsBy(QtGui.QUndoCommand):
         if self.ignore_first_redo:
             self.ignore_first_redo = False
             return
-        for item in self.items:
-            item.setScale(item.scale() * self.factor,
-                          item.mapFromScene(self.anchor))
+        with bulk_transform(self.items):
+            for item in self.items:
+                item.setScale(item.scale() * self.factor,
+                              item.mapFromScene(self.anchor))
 
     def undo(self):
-        for item in self.items:
-            item.setScale(item.scale() / self.factor,
-                          item.mapFromScene(self.anchor))
+        with bulk_transform(self.items):
+            for item in self.items:
+                item.setScale(item.scale() / self.factor,
+                              item.mapFromScene(self.anchor))
 
 
+@changes_items
 class RotateItemsBy(QtGui.QUndoCommand):
     """Rotate items by a given delta around the given anchor."""
 
@@ -125,104 +291,88 @@ class RotateItemsBy(QtGui.QUndoCommand):
         if self.ignore_first_redo:
             self.ignore_first_redo = False
             return
-        for item in self.items:
-            item.setRotation(
-                item.rotation() + self.delta * item.flip(),
-                item.mapFromScene(self.anchor))
+        with bulk_transform(self.items):
+            for item in self.items:
+                item.setRotation(
+                    item.rotation() + self.delta * item.flip(),
+                    item.mapFromScene(self.anchor))
 
     def undo(self):
-        for item in self.items:
-            item.setRotation(item.rotation() - self.delta * item.flip(),
-                             item.mapFromScene(self.anchor))
+        with bulk_transform(self.items):
+            for item in self.items:
+                item.setRotation(
+                    item.rotation() - self.delta * item.flip(),
+                    item.mapFromScene(self.anchor))
 
 
-class NormalizeItems(QtGui.QUndoCommand):
+@changes_items
+class NormalizeItems(TransformItems):
 
     def __init__(self, items, scale_factors):
-        super().__init__('Normalize items')
-        self.items = items
+        super().__init__('Normalize items', items)
         self.scale_factors = scale_factors
 
-    def redo(self):
-        self.old_scale_factors = []
-        for item, factor in zip(self.items, self.scale_factors):
-            self.old_scale_factors.append(item.scale())
-            item.setScale(item.scale() * factor, item.center)
-
-    def undo(self):
-        for item, factor in zip(self.items, self.old_scale_factors):
-            item.setScale(factor, item.center)
+    def transform(self):
+        # Scale around each item's center, calculated from one snapshot
+        # instead of mapping the center for every item before and after
+        geometry = GeometrySnapshot(self.items)
+        positions = geometry.scaled_positions(self.scale_factors)
+        for item, factor, (x, y) in zip(
+                self.items, self.scale_factors, positions):
+            scale = item.scale() * factor
+            if scale > 0:
+                item.set_transform_state(
+                    x, y, scale, item.rotation(), item.flip())
 
 
-class FlipItems(QtGui.QUndoCommand):
+@changes_items
+class FlipItems(TransformItems):
 
     def __init__(self, items, anchor, vertical):
-        super().__init__('Flip items')
-        self.items = items
+        super().__init__('Flip items', items)
         self.anchor = anchor
         self.vertical = vertical
 
-    def redo(self):
+    def transform(self):
         for item in self.items:
             item.do_flip(self.vertical, item.mapFromScene(self.anchor))
 
-    def undo(self):
-        self.redo()
 
-
-class ResetScale(QtGui.QUndoCommand):
+@changes_items
+class ResetScale(TransformItems):
 
     def __init__(self, items):
-        super().__init__('Reset Scale')
-        self.items = items
+        super().__init__('Reset Scale', items)
 
-    def redo(self):
-        self.old_scale_factors = []
+    def transform(self):
         for item in self.items:
-            self.old_scale_factors.append(item.scale())
             item.setScale(1, anchor=item.center)
 
-    def undo(self):
-        for item, scale_factor in zip(self.items, self.old_scale_factors):
-            item.setScale(scale_factor, anchor=item.center)
-
 
-class ResetRotation(QtGui.QUndoCommand):
+@changes_items
+class ResetRotation(TransformItems):
 
     def __init__(self, items):
-        super().__init__('Reset Rotation')
-        self.items = items
+        super().__init__('Reset Rotation', items)
 
-    def redo(self):
-        self.old_rotations = []
+    def transform(self):
         for item in self.items:
-            self.old_rotations.append(item.rotation())
             item.setRotation(0, anchor=item.center)
 
-    def undo(self):
-        for item, rotation in zip(self.items, self.old_rotations):
-            item.setRotation(rotation, anchor=item.center)
-
 
-class ResetFlip(QtGui.QUndoCommand):
+@changes_items
+class ResetFlip(TransformItems):
 
     def __init__(self, items):
-        super().__init__('Reset Flip')
-        self.items = items
+        super().__init__('Reset Flip', items)
 
-    def redo(self):
-        self.old_flips = []
+    def transform(self):
         for item in self.items:
-            self.old_flips.append(item.flip())
             if item.flip() == -1:
                 item.do_flip(anchor=item.center)
 
-    def undo(self):
-        for item, flip in zip(self.items, self.old_flips):
-            if flip == -1:
-                item.do_flip(anchor=item.center)
-
 
+@changes_items
 class ResetCrop(QtGui.QUndoCommand):
 
     def __init__(self, items):
@@ -240,62 +390,47 @@ class ResetCrop(QtGui.QUndoCommand):
             item.crop = crop
 
 
-class ResetTransforms(QtGui.QUndoCommand):
+@changes_items
+class ResetTransforms(TransformItems):
 
     def __init__(self, items):
-        super().__init__('Reset All Transformations')
-        self.items = items
+        super().__init__('Reset All Transformations', items)
+        self.croppable = [item for item in items if item.is_croppable]
+        self.old_crops = [item.crop for item in self.croppable]
 
-    def redo(self):
-        self.old_values = []
+    def transform(self):
         for item in self.items:
-            values = {
-                'scale': item.scale(),
-                'rotation': item.rotation(),
-                'flip': item.flip(),
-            }
-            if item.is_croppable:
-                values['crop'] = item.crop
-                item.reset_crop()
-            self.old_values.append(values)
-
             item.setScale(1, anchor=item.center)
             item.setRotation(0, anchor=item.center)
             if item.flip() == -1:
                 item.do_flip(anchor=item.center)
 
+    def redo(self):
+        for item in self.croppable:
+            item.reset_crop()
+        super().redo()
+
     def undo(self):
-        for item, old in zip(self.items, self.old_values):
-            item.setScale(old['scale'], anchor=item.center)
-            item.setRotation(old['rotation'], anchor=item.center)
-            if old['flip'] == -1:
-                item.do_flip(anchor=item.center)
-            if item.is_croppable:
-                item.crop = old['crop']
+        super().undo()
+        for item, crop in zip(self.croppable, self.old_crops):
+            item.crop = crop
 
 
-class ArrangeItems(QtGui.QUndoCommand):
+@changes_items
+class ArrangeItems(TransformItems):
 
     def __init__(self, scene, items, positions):
-        super().__init__('Arrange items')
+        super().__init__('Arrange items', items)
         self.scene = scene
-        self.items = items
         self.positions = positions
 
-    def redo(self):
-        self.old_positions = []
-        for item, pos in zip(self.items, self.positions):
-            self.old_positions.append(item.pos())
-            orig_topleft = item.mapToScene(QtCore.QPointF(0, 0))
-            rect_topleft = self.scene.itemsBoundingRect(
-                items=[item]).topLeft()
-            item.setPos(pos + orig_topleft - rect_topleft)
-
-    def undo(self):
-        for item, pos in zip(self.items, self.old_positions):
-            item.setPos(pos)
+    def transform(self):
+        offsets = GeometrySnapshot(self.items).origin_offsets()
+        for item, pos, offset in zip(self.items, self.positions, offsets):
+            item.setPos(pos + offset)
 
 
+@changes_items
 class CropItem(QtGui.QUndoCommand):
     def __init__(self, item, crop):
         super().__init__('Crop item')
@@ -59,6 +59,16 @@ parser.add_argument(
     default=False,
     action='store_true',
     help='draw item\'s transform handle areas for debugging')
+parser.add_argument(
+    '--profile',
+    default=False,
+    action='store_true',
+    help='show frame times and other timings in an overlay')
+parser.add_argument(
+    '--profile-trace',
+    metavar='FILENAME',
+    help=('write timings to a Chrome trace JSON file on exit '
+          '(implies --profile)'))
 
 
 class CommandlineArgs:
@@ -174,6 +184,11 @@ def logfile_name():
         os.path.dirname(BeeSettings().fileName()), f'{constants.APPNAME}.log')
 
 
+def http_cache_dir():
+    return os.path.join(
+        os.path.dirname(BeeSettings().fileName()), 'HTTPCache')
+
+
 logging_conf = {
     'version': 1,
     'formatters': {
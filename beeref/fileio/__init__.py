@@ -13,13 +13,17 @@
 # You should have received a copy of the GNU General Public License
 # along with BeeRef.  If not, see <https://www.gnu.org/licenses/>.
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import os
+import time
 
-from PyQt6 import QtCore
+from PyQt6 import QtCore, QtGui
 
 from beeref import commands
 from beeref.fileio.errors import BeeFileIOError
-from beeref.fileio.image import load_image
+from beeref.fileio.image import create_fetcher, load_image, StageTimings
 from beeref.fileio.sql import SQLiteIO, is_bee_file
 from beeref.items import BeePixmapItem
 
@@ -35,47 +39,122 @@ __all__ = [
 
 logger = logging.getLogger(__name__)
 
+# What to do with large images on import, see load_images:
+IMPORT_ORIGINAL = 'original'
+IMPORT_CAP = 'cap'
+IMPORT_PROXY = 'proxy'
+IMPORT_POLICIES = (IMPORT_ORIGINAL, IMPORT_CAP, IMPORT_PROXY)
 
-def load_bee(filename, scene, worker=None):
-    """Load BeeRef native file."""
+# How many images per CPU core to decode ahead of adding them to the
+# scene when importing:
+IMPORT_AHEAD = 2
+
+
+def load_bee(filename, scene, lazy=False, worker=None):
+    """Load BeeRef native file.
+
+    :param lazy: Don't load pixmaps until they are needed
+    """
     logger.info(f'Loading from file {filename}...')
-    io = SQLiteIO(filename, scene, readonly=True, worker=worker)
+    io = SQLiteIO(filename, scene, readonly=True, lazy=lazy, worker=worker)
     return io.read()
 
 
-def save_bee(filename, scene, create_new=False, worker=None):
-    """Save BeeRef native file."""
+def save_bee(filename, scene, create_new=False, journal_mode=None,
+             synchronous=None, worker=None):
+    """Save BeeRef native file.
+
+    :param journal_mode: SQLite journal mode, e.g. ``WAL``
+    :param synchronous: SQLite synchronous level, e.g. ``NORMAL``
+    """
     logger.info(f'Saving to file {filename}...')
     logger.debug(f'Create new: {create_new}')
-    io = SQLiteIO(filename, scene, create_new, worker=worker)
+    io = SQLiteIO(filename, scene, create_new, worker=worker,
+                  journal_mode=journal_mode, synchronous=synchronous)
     io.write()
     logger.info('Saved!')
 
 
-def load_images(filenames, pos, scene, worker):
-    """Add images to existing scene."""
+def load_images(filenames, pos, scene, worker, policy=IMPORT_ORIGINAL,
+                max_size=None):
+    """Add images to existing scene.
+
+    Images are decoded by a pool of threads. A limited number of
+    images is decoded ahead, and they are added to the scene in the
+    order they were given. Images from remote URLs are all downloaded
+    concurrently up front.
+
+    :param policy: What to do with images larger than ``max_size``
+        pixels on their longer side: ``original`` keeps them as they
+        are, ``cap`` scales them down, and ``proxy`` keeps the original
+        but shows a scaled down version until the full resolution is
+        needed. Without ``max_size``, images are always kept as they
+        are.
+    """
 
     errors = []
     items = []
+    timings = StageTimings()
+    start = time.perf_counter()
     worker.begin_processing.emit(len(filenames))
-    for i, filename in enumerate(filenames):
-        logger.info(f'Loading image from file {filename}')
-        img, filename = load_image(filename)
-        worker.progress.emit(i)
-        if img.isNull():
-            logger.info(f'Could not load file {filename}')
-            errors.append(filename)
-            continue
-
-        item = BeePixmapItem(img, filename)
-        item.set_pos_center(pos)
-        scene.add_item_later({'item': item, 'type': 'pixmap'}, selected=True)
-        items.append(item)
-        if worker.canceled:
-            break
-        # Give main thread time to process items:
-        worker.msleep(10)
 
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool, \
+            create_fetcher() as fetcher:
+        # Filenames may also be local paths or image data:
+        fetcher.prefetch([f.url() for f in filenames
+                          if isinstance(f, QtCore.QUrl)
+                          and not f.isLocalFile()])
+        pending = iter(filenames)
+        futures = deque()
+
+        if max_size is None:
+            # Nothing is too large, so there is nothing to scale down
+            policy = IMPORT_ORIGINAL
+        if policy == IMPORT_ORIGINAL:
+            max_size = None
+        proxy = (policy == IMPORT_PROXY)
+        if proxy:
+            # Proxies are shown in place of mipmaps, so they can't be
+            # smaller than the smallest mipmap:
+            max_size = max(max_size, 2 * BeePixmapItem.MIPMAP_MIN_SIZE)
+
+        def submit_next():
+            for filename in pending:
+                futures.append(pool.submit(
+                    load_image, filename, timings, max_size, proxy,
+                    fetcher))
+                return
+
+        for i in range(IMPORT_AHEAD * (os.cpu_count() or 1)):
+            submit_next()
+
+        for i in range(len(filenames)):
+            img, filename, data = futures.popleft().result()
+            submit_next()
+            logger.info(f'Loaded image from file {filename}')
+            worker.progress.emit(i)
+            if img.isNull():
+                logger.info(f'Could not load file {filename}')
+                errors.append(filename)
+                continue
+
+            with timings.measure('item'):
+                if proxy and data:
+                    item = BeePixmapItem(QtGui.QImage(), filename)
+                    item.set_proxy(img, data)
+                else:
+                    item = BeePixmapItem(img, filename, image_data=data)
+                item.set_pos_center(pos)
+            scene.add_item_later(
+                {'item': item, 'type': 'pixmap'}, selected=True)
+            items.append(item)
+            if worker.canceled:
+                for future in futures:
+                    future.cancel()
+                break
+
+    logger.info(f'Loaded {len(items)} images in '
+                f'{time.perf_counter() - start:.3f}s ({timings})')
     scene.undo_stack.push(
         commands.InsertItems(scene, items, ignore_first_redo=True))
     worker.finished.emit('', errors)
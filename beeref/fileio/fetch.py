@@ -0,0 +1,341 @@
+# This file is part of BeeRef.
+#
+# BeeRef is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BeeRef is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BeeRef.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Downloading images from URLs, e.g. when dropping images from a
+browser.
+
+Downloads run concurrently, reuse connections to the same host and are
+cached on disk, so that dropping the same images again only needs a
+quick revalidation with the server. Downloads through a proxy are left
+to urllib.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import http.client
+import json
+import logging
+import os
+import threading
+from urllib import request
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlsplit
+
+from beeref import constants
+
+
+logger = logging.getLogger(__name__)
+
+# How many downloads to run at the same time; browsers use about as
+# many connections per host:
+FETCH_CONCURRENCY = 6
+# Seconds to wait for a server before giving up:
+FETCH_TIMEOUT = 30
+MAX_REDIRECTS = 5
+# How much disk space the HTTP cache may take up before the least
+# recently used entries get removed (bytes):
+HTTP_CACHE_BYTES = 256 * 1024 * 1024
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class FetchError(Exception):
+    pass
+
+
+class CacheEntry:
+
+    def __init__(self, url, etag, data):
+        self.url = url
+        self.etag = etag
+        self.data = data
+
+
+class HTTPCache:
+    """Downloaded data on disk, keyed by URL and ETag.
+
+    An entry is only valid as long as the server reports the same ETag
+    for its URL, so responses without an ETag aren't cached.
+    """
+
+    def __init__(self, directory, max_bytes=HTTP_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def path(self, url):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.directory, key)
+
+    def get(self, url):
+        """The cached entry for the given URL, or None."""
+
+        path = self.path(url)
+        try:
+            with open(f'{path}.json') as f:
+                meta = json.load(f)
+            with open(f'{path}.data', 'rb') as f:
+                data = f.read()
+        except (OSError, ValueError):
+            return None
+        if meta.get('url') != url or not meta.get('etag'):
+            return None
+        return CacheEntry(url, meta['etag'], data)
+
+    def touch(self, url):
+        """Mark the entry for the given URL as recently used."""
+
+        try:
+            os.utime(f'{self.path(url)}.data')
+        except OSError:
+            pass
+
+    def put(self, url, etag, data):
+        path = self.path(url)
+        with self._lock:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                # Write to temporary files first so that other threads
+                # never see half written entries:
+                with open(f'{path}.data.tmp', 'wb') as f:
+                    f.write(data)
+                with open(f'{path}.json.tmp', 'w') as f:
+                    json.dump({'url': url, 'etag': etag}, f)
+                os.replace(f'{path}.data.tmp', f'{path}.data')
+                os.replace(f'{path}.json.tmp', f'{path}.json')
+            except OSError as e:
+                logger.warning(f'Could not write to HTTP cache: {e}')
+                return
+            self._prune()
+
+    def _prune(self):
+        """Remove least recently used entries until the cache fits into
+        ``max_bytes``."""
+
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.data'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            logger.debug(f'Removing {path} from HTTP cache')
+            for filename in (path, f'{path[:-len(".data")]}.json'):
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+            total -= size
+
+
+class ConnectionPool:
+    """Open HTTP connections that can be reused for further requests to
+    the same host (keep-alive)."""
+
+    def __init__(self, timeout=FETCH_TIMEOUT):
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        """An idle connection to the given host, or a new one.
+
+        :returns: Tuple of the connection and whether it has been used
+            before
+        """
+
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return (idle.pop(), True)
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+        return (conn, False)
+
+    def put(self, scheme, netloc, conn):
+        """Keep the given connection for reuse."""
+
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(conn)
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle = {}
+
+
+class Fetcher:
+    """Downloads data from URLs.
+
+    Use ``prefetch`` to start downloads in the background; ``fetch``
+    then waits for the download of the given URL to finish. Downloads
+    that haven't been started yet are canceled on ``close``.
+
+    :param cache: Optional ``HTTPCache``
+    """
+
+    def __init__(self, cache=None, concurrency=FETCH_CONCURRENCY,
+                 timeout=FETCH_TIMEOUT):
+        self.cache = cache
+        self.timeout = timeout
+        self.connections = ConnectionPool(timeout=timeout)
+        self._executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix='fetch')
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # Cancel pending downloads ourselves; shutdown's cancel_futures
+        # needs Python 3.9
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+        self._executor.shutdown(wait=False)
+        self.connections.close()
+
+    def prefetch(self, urls):
+        """Start downloading the given URLs in the background."""
+
+        with self._lock:
+            for url in urls:
+                if url not in self._futures:
+                    self._futures[url] = self._executor.submit(
+                        self._fetch, url)
+
+    def fetch(self, url):
+        """Download the given URL, or wait for its download to finish
+        if it has been prefetched.
+
+        :returns: The data as bytestring
+        :raises FetchError: If the download failed
+        """
+
+        with self._lock:
+            future = self._futures.get(url)
+        if future:
+            return future.result()
+        return self._fetch(url)
+
+    def _fetch(self, url):
+        if urlsplit(url).scheme not in ('http', 'https'):
+            # E.g. data: or ftp: URLs, which browsers sometimes give us
+            try:
+                return request.urlopen(url, timeout=self.timeout).read()
+            except (OSError, ValueError) as e:
+                raise FetchError(str(e))
+
+        cached = self.cache.get(url) if self.cache else None
+        location = url
+        for i in range(MAX_REDIRECTS + 1):
+            headers = {
+                'User-Agent': f'{constants.APPNAME}/{constants.VERSION}',
+                'Accept': 'image/*, */*;q=0.8',
+            }
+            if cached and location == url:
+                headers['If-None-Match'] = cached.etag
+            status, response_headers, data = self._request(location, headers)
+            if status in REDIRECT_CODES and 'Location' in response_headers:
+                location = urljoin(location, response_headers['Location'])
+                logger.debug(f'Redirected to {location}')
+                continue
+            break
+        else:
+            raise FetchError(f'Too many redirects: {url}')
+
+        if status == 304 and cached:
+            logger.debug(f'Using cached data for {url}')
+            self.cache.touch(url)
+            return cached.data
+        if status != 200:
+            raise FetchError(f'HTTP status {status}: {location}')
+        etag = response_headers.get('ETag')
+        if self.cache and etag:
+            self.cache.put(url, etag, data)
+        return data
+
+    def _request(self, url, headers):
+        """Make a GET request on a pooled connection.
+
+        :returns: Tuple of status code, response headers and body
+        """
+
+        parts = urlsplit(url)
+        if self._uses_proxy(parts):
+            return self._request_with_urllib(url, headers)
+        path = parts.path or '/'
+        if parts.query:
+            path += f'?{parts.query}'
+
+        while True:
+            conn, reused = self.connections.get(parts.scheme, parts.netloc)
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                if reused:
+                    # The server may have closed the idle connection in
+                    # the meantime; try again with a new one
+                    logger.debug(f'Reused connection failed: {e}')
+                    continue
+                raise FetchError(f'{e}: {url}')
+            if response.will_close:
+                conn.close()
+            else:
+                self.connections.put(parts.scheme, parts.netloc, conn)
+            return (response.status, response.headers, data)
+
+    def _uses_proxy(self, parts):
+        """Whether the environment or system settings configure a proxy
+        for the given URL parts."""
+
+        proxies = request.getproxies()
+        return (parts.scheme in proxies
+                and not request.proxy_bypass(parts.hostname or ''))
+
+    def _request_with_urllib(self, url, headers):
+        """Make a GET request with urllib, which knows how to talk to
+        proxies, instead of on a pooled connection.
+
+        :returns: Tuple of status code, response headers and body
+        """
+
+        logger.debug(f'Using proxy for {url}')
+        req = request.Request(url, headers=headers)
+        # urlopen's default opener keeps the proxy settings from when it
+        # was first used, so build one with the current settings:
+        opener = request.build_opener()
+        try:
+            with opener.open(req, timeout=self.timeout) as response:
+                return (response.status, response.headers, response.read())
+        except HTTPError as e:
+            # Also raised for 304 Not Modified
+            with e:
+                return (e.code, e.headers, b'')
+        except (OSError, http.client.HTTPException) as e:
+            raise FetchError(f'{e}: {url}')
@@ -13,87 +13,288 @@
 # You should have received a copy of the GNU General Public License
 # along with BeeRef.  If not, see <https://www.gnu.org/licenses/>.
 
+from contextlib import contextmanager
 import logging
+import math
 import os.path
-import tempfile
-from urllib.error import URLError
-from urllib import request
+import threading
+import time
 
-from PyQt6 import QtGui
+from PyQt6 import QtCore, QtGui
 
-import exif
-import plum
+from beeref.config import http_cache_dir
+from beeref.fileio.fetch import Fetcher, FetchError, HTTPCache
+from beeref.profiler import profiler
 
 
 logger = logging.getLogger(__name__)
 
 
-def exif_rotated_image(path=None):
+class StageTimings:
+    """Total time spent in each stage of importing images, summed up
+    over all threads. Stages also show up in the profiler trace."""
+
+    def __init__(self):
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return ', '.join(f'{name}: {total:.3f}s'
+                         for name, total in self.totals.items())
+
+    @contextmanager
+    def measure(self, name):
+        start = time.perf_counter()
+        try:
+            with profiler.measure(f'import_{name}'):
+                yield
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                self.totals[name] = self.totals.get(name, 0) + duration
+
+
+def scaled_size(size, max_size, proxy=False):
+    """The size to decode an image of the given size at so that its
+    longer side is at most ``max_size`` pixels.
+
+    :param proxy: Only scale down by powers of two, so that the result
+        matches the item's mipmap levels (see
+        :meth:`BeePixmapItem.set_proxy`)
+    :returns: The scaled size as QSize, or None if the image doesn't
+        need to be scaled down
+    """
+
+    longest = max(size.width(), size.height())
+    if not max_size or longest <= max_size:
+        return None
+    if proxy:
+        factor = 2 ** math.ceil(math.log2(longest / max_size))
+        return QtCore.QSize(math.ceil(size.width() / factor),
+                            math.ceil(size.height() / factor))
+    factor = max_size / longest
+    return QtCore.QSize(max(round(size.width() * factor), 1),
+                        max(round(size.height() * factor), 1))
+
+
+def encode_image(img):
+    """Encode an image as JPEG, or as PNG if it has transparency."""
+
+    barray = QtCore.QByteArray()
+    buffer = QtCore.QBuffer(barray)
+    buffer.open(QtCore.QIODevice.OpenModeFlag.WriteOnly)
+    if img.hasAlphaChannel():
+        img.save(buffer, 'PNG')
+    else:
+        img.save(buffer, 'JPG', 90)
+    return barray.data()
+
+
+# Image data that can be decoded without going through a file:
+DATA_SOURCES = (bytes, bytearray, memoryview,
+                QtCore.QByteArray, QtCore.QBuffer)
+
+
+def _open_source(source):
+    """A QIODevice to decode the given image data from.
+
+    QBuffers are read from directly. Other sources are copied into a
+    QBuffer once, since Qt can't read from Python memory directly.
+    """
+
+    if isinstance(source, QtCore.QBuffer):
+        buffer = source
+    else:
+        buffer = QtCore.QBuffer()
+        buffer.setData(source)
+    if buffer.isOpen():
+        buffer.seek(0)
+    else:
+        buffer.open(QtCore.QIODevice.OpenModeFlag.ReadOnly)
+    return buffer
+
+
+def _source_bytes(source):
+    """The given image data as bytestring, e.g. for storing it in bee
+    files."""
+
+    if isinstance(source, bytes):
+        return source
+    if isinstance(source, QtCore.QBuffer):
+        return source.data().data()
+    if isinstance(source, QtCore.QByteArray):
+        return source.data()
+    return bytes(source)
+
+
+def _read_source(source):
+    """Read the given file if ``source`` is a path, otherwise return
+    the image data as is.
+
+    :raises OSError: If the file can't be read
+    """
+
+    if isinstance(source, DATA_SOURCES):
+        return source
+    with open(source, 'rb') as f:
+        return f.read()
+
+
+def load_image_data(data, max_size=None, proxy=False):
+    """Decode image data into a QImage that is transformed according
+    to its EXIF orientation.
+
+    The orientation is read by the decoder from the same buffer, so
+    the data needs to be read only once.
+
+    :param data: The image data as one of ``DATA_SOURCES``, e.g.
+        bytes, memoryview or QBuffer
+
+    :param max_size: Scale large images down while decoding, so that
+        their longer side is at most this many pixels. The full size
+        image is never decoded. The original data is replaced by the
+        scaled down image encoded as JPEG or PNG.
+    :param proxy: Keep the original data of images that are scaled
+        down, so that the scaled down image can be shown in place of
+        the original until the full resolution is needed. Images that
+        need to be transformed according to their EXIF orientation are
+        decoded at full size in this case.
+    :returns: Tuple of the image and the original data if it can be
+        stored in bee files as is (see :func:`original_data`), else None
+    """
+
+    # The reader doesn't take ownership of the buffer, so we need to
+    # keep a reference to it while reading:
+    buffer = _open_source(data)
+    reader = QtGui.QImageReader(buffer)
+    reader.setAutoTransform(True)
+    transformed = (reader.transformation()
+                   != QtGui.QImageIOHandler.Transformation.TransformationNone)
+    size = None
+    if max_size and not (proxy and transformed):
+        size = scaled_size(reader.size(), max_size, proxy=proxy)
+    if size:
+        logger.debug(f'Scaling image down from {reader.size()} to {size}')
+        reader.setScaledSize(size)
+    img = reader.read()
+    if img.isNull():
+        logger.debug(f'Could not decode image: {reader.errorString()}')
+        return (img, None)
+    if transformed:
+        logger.debug('Not keeping original data: needs EXIF transformation')
+        return (img, encode_image(img) if size else None)
+    if size and not proxy:
+        return (img, encode_image(img))
+    return (img, _source_bytes(data))
+
+
+def exif_rotated_image(source=None):
     """Returns a QImage that is transformed according to the source's
     orientation EXIF data.
+
+    :param source: A filename or image data (see ``load_image_data``)
     """
 
-    img = QtGui.QImage(path)
-    if img.isNull():
-        return img
+    if source is None:
+        return QtGui.QImage()
 
-    with open(path, 'rb') as f:
-        try:
-            exifimg = exif.Image(f)
-        except (plum.exceptions.UnpackError, NotImplementedError):
-            logger.exception(f'Exif parser failed on image: {path}')
-            return img
+    try:
+        data = _read_source(source)
+    except OSError as e:
+        logger.debug(f'Could not read image: {e}')
+        return QtGui.QImage()
+    return load_image_data(data)[0]
 
-    if 'orientation' in exifimg.list_all():
-        orientation = exifimg.orientation
-    else:
-        return img
-
-    transform = QtGui.QTransform()
-
-    if orientation == exif.Orientation.TOP_RIGHT:
-        return img.mirrored(horizontal=True, vertical=False)
-    if orientation == exif.Orientation.BOTTOM_RIGHT:
-        transform.rotate(180)
-        return img.transformed(transform)
-    if orientation == exif.Orientation.BOTTOM_LEFT:
-        return img.mirrored(horizontal=False, vertical=True)
-    if orientation == exif.Orientation.LEFT_TOP:
-        transform.rotate(90)
-        return img.transformed(transform).mirrored(
-            horizontal=True, vertical=False)
-    if orientation == exif.Orientation.RIGHT_TOP:
-        transform.rotate(90)
-        return img.transformed(transform)
-    if orientation == exif.Orientation.RIGHT_BOTTOM:
-        transform.rotate(270)
-        return img.transformed(transform).mirrored(
-            horizontal=True, vertical=False)
-    if orientation == exif.Orientation.LEFT_BOTTOM:
-        transform.rotate(270)
-        return img.transformed(transform)
-
-    return img
-
-
-def load_image(path):
+
+def original_data(source):
+    """Returns the image data if it can be stored in bee files as is,
+    otherwise None.
+
+    Images that need to be transformed according to their EXIF
+    orientation can't be stored as is, since the transformation isn't
+    applied when reading bee files.
+
+    :param source: A filename or image data (see ``load_image_data``)
+    """
+
+    try:
+        data = _read_source(source)
+    except OSError:
+        return None
+
+    buffer = _open_source(data)
+    reader = QtGui.QImageReader(buffer)
+    if not reader.canRead():
+        return None
+    if (reader.transformation()
+            != QtGui.QImageIOHandler.Transformation.TransformationNone):
+        logger.debug('Not keeping original data: needs EXIF transformation')
+        return None
+    return _source_bytes(data)
+
+
+def _load_local_image(path, timings, max_size, proxy):
+    try:
+        with timings.measure('read'):
+            with open(path, 'rb') as f:
+                data = f.read()
+    except OSError as e:
+        logger.debug(f'Could not read image: {e}')
+        return (QtGui.QImage(), path, None)
+    with timings.measure('decode'):
+        img, data = load_image_data(data, max_size, proxy)
+    return (img, path, data)
+
+
+def create_fetcher():
+    """A fetcher for downloading images, with the user's HTTP cache."""
+
+    return Fetcher(cache=HTTPCache(http_cache_dir()))
+
+
+def load_image(path, timings=None, max_size=None, proxy=False,
+               fetcher=None):
+    """Load an image from a filename, URL or image data.
+
+    Image data (see ``load_image_data``) is decoded directly, e.g. for
+    images dropped from other applications.
+
+    :param timings: Optional ``StageTimings`` to add the time spent on
+        decoding and reading to
+    :param max_size: See :func:`load_image_data`
+    :param proxy: See :func:`load_image_data`
+    :param fetcher: ``Fetcher`` to download remote URLs with, e.g. one
+        that the URL has been prefetched with. A new one is used if not
+        given.
+    :returns: Tuple of image, filename (None for image data) and the
+        original image data if it can be stored as is (see
+        :func:`original_data`)
+    """
+
+    timings = timings or StageTimings()
+    if isinstance(path, DATA_SOURCES):
+        with timings.measure('decode'):
+            img, data = load_image_data(path, max_size, proxy)
+        return (img, None, data)
     if isinstance(path, str):
-        path = os.path.normpath(path)
-        return (exif_rotated_image(path), path)
+        return _load_local_image(
+            os.path.normpath(path), timings, max_size, proxy)
     if path.isLocalFile():
-        path = os.path.normpath(path.toLocalFile())
-        return (exif_rotated_image(path), path)
+        return _load_local_image(
+            os.path.normpath(path.toLocalFile()), timings, max_size, proxy)
 
     img = exif_rotated_image()
+    data = None
     try:
-        imgdata = request.urlopen(path.url()).read()
-    except URLError as e:
-        logger.debug(f'Downloading image failed: {e.reason}')
+        with timings.measure('download'):
+            if fetcher:
+                imgdata = fetcher.fetch(path.url())
+            else:
+                with create_fetcher() as fetcher:
+                    imgdata = fetcher.fetch(path.url())
+    except FetchError as e:
+        logger.debug(f'Downloading image failed: {e}')
     else:
-        with tempfile.TemporaryDirectory() as tmp:
-            fname = os.path.join(tmp, 'img')
-            with open(fname, 'wb') as f:
-                f.write(imgdata)
-                logger.debug(f'Temporarily saved in: {fname}')
-            img = exif_rotated_image(fname)
-    return (img, path.url())
+        with timings.measure('decode'):
+            img, data = load_image_data(imgdata, max_size, proxy)
+    return (img, path.url(), data)
@@ -1,4 +1,4 @@
-USER_VERSION = 2
+USER_VERSION = 5
 APPLICATION_ID = 2060242126
 
 
@@ -13,29 +13,118 @@ SCHEMA = [
         scale REAL DEFAULT 1,
         rotation REAL DEFAULT 0,
         flip INTEGER DEFAULT 1,
-        data JSON
+        data JSON,
+        blob TEXT
     )
     """,
     """
     CREATE TABLE sqlar (
         name TEXT PRIMARY KEY,
-        item_id INTEGER NOT NULL,
         mode INT,
         mtime INT default current_timestamp,
         sz INT,
         data BLOB,
-        FOREIGN KEY (item_id)
-          REFERENCES items (id)
+        width INT,
+        height INT
+    )
+    """,
+    """
+    CREATE TABLE mipmaps (
+        blob TEXT NOT NULL,
+        level INTEGER NOT NULL,
+        data BLOB,
+        PRIMARY KEY (blob, level),
+        FOREIGN KEY (blob)
+          REFERENCES sqlar (name)
              ON DELETE CASCADE
              ON UPDATE NO ACTION
     )
     """,
+    "CREATE INDEX items_blob ON items (blob)",
 ]
 
 
+# Migrations may use the following SQL functions in addition to SQLite's
+# builtin ones:
+#
+# * blob_name(data, name): The content addressed name for image data
+#   that has been stored under the given name
+
 MIGRATIONS = {
     2: [
         "ALTER TABLE items ADD COLUMN data JSON",
         "UPDATE items SET data = json_object('filename', filename)",
     ],
+    3: [
+        "ALTER TABLE sqlar ADD COLUMN width INT",
+        "ALTER TABLE sqlar ADD COLUMN height INT",
+    ],
+    4: [
+        """
+        CREATE TABLE mipmaps (
+            item_id INTEGER NOT NULL,
+            level INTEGER NOT NULL,
+            data BLOB,
+            PRIMARY KEY (item_id, level),
+            FOREIGN KEY (item_id)
+              REFERENCES items (id)
+                 ON DELETE CASCADE
+                 ON UPDATE NO ACTION
+        )
+        """,
+    ],
+    5: [
+        "ALTER TABLE items ADD COLUMN blob TEXT",
+        """
+        UPDATE items SET blob = (
+            SELECT blob_name(data, name) FROM sqlar
+            WHERE sqlar.item_id = items.id AND data IS NOT NULL)
+        """,
+        """
+        CREATE TABLE sqlar_new (
+            name TEXT PRIMARY KEY,
+            mode INT,
+            mtime INT default current_timestamp,
+            sz INT,
+            data BLOB,
+            width INT,
+            height INT
+        )
+        """,
+        """
+        INSERT OR IGNORE INTO sqlar_new
+            (name, mode, mtime, sz, data, width, height)
+        SELECT blob_name(data, name), mode, mtime, sz, data, width, height
+        FROM sqlar
+        WHERE data IS NOT NULL
+        """,
+        """
+        CREATE TABLE mipmaps_new (
+            blob TEXT NOT NULL,
+            level INTEGER NOT NULL,
+            data BLOB,
+            PRIMARY KEY (blob, level),
+            FOREIGN KEY (blob)
+              REFERENCES sqlar_new (name)
+                 ON DELETE CASCADE
+                 ON UPDATE NO ACTION
+        )
+        """,
+        """
+        INSERT OR IGNORE INTO mipmaps_new (blob, level, data)
+        SELECT items.blob, level, mipmaps.data
+        FROM mipmaps INNER JOIN items ON items.id = mipmaps.item_id
+        WHERE items.blob IS NOT NULL
+        """,
+        "DROP TABLE mipmaps",
+        "DROP TABLE sqlar",
+        "ALTER TABLE sqlar_new RENAME TO sqlar",
+        "ALTER TABLE mipmaps_new RENAME TO mipmaps",
+        "CREATE INDEX items_blob ON items (blob)",
+    ],
 }
+
+# Migrations that copy image data into new tables. The space of the
+# dropped tables only gets returned to the file system by a VACUUM,
+# otherwise the file would stay twice its size:
+VACUUM_AFTER = {5}
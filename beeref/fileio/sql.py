@@ -23,6 +23,10 @@ https://www.sqlite.org/appfileformat.html
 https://www.sqlite.org/sqlar.html
 """
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import hashlib
 import json
 import logging
 import os
@@ -30,17 +34,24 @@ import pathlib
 import shutil
 import sqlite3
 import tempfile
+import threading
+import weakref
 
-from PyQt6 import QtGui
+from PyQt6 import QtCore, QtGui
 
 from beeref import constants
 from beeref.items import BeePixmapItem
 from .errors import BeeFileIOError
-from .schema import SCHEMA, USER_VERSION, MIGRATIONS, APPLICATION_ID
+from .schema import (
+    SCHEMA, USER_VERSION, MIGRATIONS, VACUUM_AFTER, APPLICATION_ID)
 
 
 logger = logging.getLogger(__name__)
 
+# How many images per CPU core to decode ahead of adding them to the
+# scene when reading a file:
+DECODE_AHEAD = 2
+
 
 def is_bee_file(path):
     """Check whether the file at the given path is a bee file."""
@@ -72,15 +83,151 @@ def handle_sqlite_errors(func):
     return wrapper
 
 
+def blob_name(data, ext):
+    """The name under which image data is stored in the sqlar table.
+
+    Image data is content addressed, so that identical images only get
+    stored once.
+    """
+
+    return f'{hashlib.sha256(data).hexdigest()}.{ext}'
+
+
+def _sql_blob_name(data, name):
+    # SQL function for migrations: content addressed name for data that
+    # has been stored under the given name
+    ext = os.path.splitext(name or '')[1][1:] or 'png'
+    return blob_name(data, ext)
+
+
+def connect(*args, **kwargs):
+    """Open an sqlite connection with our custom SQL functions."""
+
+    connection = sqlite3.connect(*args, **kwargs)
+    connection.create_function('blob_name', 2, _sql_blob_name)
+    return connection
+
+
+def decode_image(data):
+    """Decode image data into a QImage.
+
+    Unlike QPixmap, QImage is safe to use outside the main thread, so
+    this can be run by the decoder pool.
+    """
+
+    img = QtGui.QImage()
+    img.loadFromData(data)
+    return img
+
+
+class BlobReader:
+    """Reads image data from a bee file for items that load it lazily.
+
+    All items read from the same file share one reader, which opens a
+    single connection on first use and keeps it open. Reads mostly
+    happen on the GUI thread while painting, but saving reads through
+    it as well, so access to the connection is serialized.
+
+    :param tmpdir: Temporary directory holding the file, e.g. a migrated
+        copy of a readonly file; gets cleaned up along with the reader
+    """
+
+    _readers = weakref.WeakSet()
+
+    def __init__(self, filename, tmpdir=None):
+        self.filename = filename
+        self._tmpdir = tmpdir
+        self._connection = None
+        self._lock = threading.Lock()
+        self._readers.add(self)
+
+    def __del__(self):
+        self.close()
+        if self._tmpdir:
+            self._tmpdir.cleanup()
+
+    @classmethod
+    def close_all(cls, filename):
+        """Close the connections of all readers of the given file, e.g.
+        before replacing it. They get reopened when needed."""
+
+        path = os.path.realpath(filename)
+        for reader in list(cls._readers):
+            if os.path.realpath(reader.filename) == path:
+                reader.close()
+
+    def close(self):
+        with self._lock:
+            if self._connection:
+                self._connection.close()
+                self._connection = None
+
+    def pixmap_loader(self, name):
+        """Returns a function that reads the image data stored under the
+        given name, for loading pixmaps lazily."""
+
+        return partial(self.read_pixmap_data, name)
+
+    def mipmap_loader(self, name):
+        """Returns a function that reads the mipmap levels of the image
+        stored under the given name on demand."""
+
+        return partial(self.read_mipmap_data, name)
+
+    def _fetchone(self, query, params):
+        with self._lock:
+            try:
+                if self._connection is None:
+                    logger.debug(f'Opening {self.filename} for reading')
+                    uri = pathlib.Path(self.filename).resolve().as_uri()
+                    self._connection = connect(
+                        f'{uri}?mode=ro', uri=True, check_same_thread=False)
+                # Fetch all rows so that the statement gets reset right
+                # away and doesn't keep the file locked:
+                rows = self._connection.execute(query, params).fetchall()
+            except sqlite3.Error:
+                logger.exception(f'Error while reading {self.filename}')
+                return None
+        return rows[0] if rows else None
+
+    def read_pixmap_data(self, name):
+        """Reads the image data stored under the given name."""
+
+        row = self._fetchone('SELECT data FROM sqlar WHERE name=?', (name,))
+        return row[0] if row else None
+
+    def read_mipmap_data(self, name, level):
+        """Reads the data of the given mipmap level of the image stored
+        under the given name."""
+
+        row = self._fetchone(
+            'SELECT data FROM mipmaps WHERE blob=? AND level=?',
+            (name, level))
+        return row[0] if row else None
+
+
 class SQLiteIO:
 
+    JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+    SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
     def __init__(self, filename, scene, create_new=False, readonly=False,
-                 worker=None):
+                 lazy=False, worker=None, journal_mode=None,
+                 synchronous=None):
+        """
+        :param journal_mode: SQLite journal mode to use when writing,
+            e.g. ``WAL``. Uses SQLite's default when not given.
+        :param synchronous: SQLite synchronous level to use when writing,
+            e.g. ``NORMAL``. Uses SQLite's default when not given.
+        """
         self.scene = scene
         self.create_new = create_new
         self.filename = filename
         self.readonly = readonly
+        self.lazy = lazy
         self.worker = worker
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
 
     def __del__(self):
         self._close_connection()
@@ -99,6 +246,10 @@ class SQLiteIO:
         if (self.create_new
                 and not self.readonly
                 and os.path.exists(self.filename)):
+            # Items might still need to load their pixmaps from the
+            # file we are about to replace
+            self.scene.detach_items_from_file()
+            BlobReader.close_all(self.filename)
             os.remove(self.filename)
 
         if self.create_new:
@@ -107,11 +258,30 @@ class SQLiteIO:
         uri = pathlib.Path(self.filename).resolve().as_uri()
         if self.readonly:
             uri = f'{uri}?mode=rw'
-        self._connection = sqlite3.connect(uri, uri=True)
+        self._connection = connect(uri, uri=True)
         self._cursor = self.connection.cursor()
+        self._db_filename = self.filename
+        if not self.readonly:
+            self._set_pragmas()
         if not self.create_new:
             self._migrate()
 
+    def _set_pragmas(self):
+        """Apply the configured journal mode and synchronous level."""
+
+        # Pragmas can't be parametrized, so only allow known values:
+        if self.journal_mode:
+            if self.journal_mode.upper() in self.JOURNAL_MODES:
+                self.ex(f'PRAGMA journal_mode={self.journal_mode}')
+            else:
+                logger.warning(f'Unknown journal mode: {self.journal_mode}')
+        if self.synchronous:
+            if self.synchronous.upper() in self.SYNCHRONOUS_LEVELS:
+                self.ex(f'PRAGMA synchronous={self.synchronous}')
+            else:
+                logger.warning(
+                    f'Unknown synchronous level: {self.synchronous}')
+
     def _migrate(self):
         """Migrate database if necessary."""
 
@@ -132,8 +302,9 @@ class SQLiteIO:
                     prefix=constants.APPNAME)
                 tmpname = os.path.join(self._tmpdir.name, 'mig.bee')
                 shutil.copyfile(self.filename, tmpname)
-                self._connection = sqlite3.connect(tmpname)
+                self._connection = connect(tmpname)
                 self._cursor = self.connection.cursor()
+                self._db_filename = tmpname
 
         self.ex('BEGIN TRANSACTION')
         for i in range(version, USER_VERSION):
@@ -142,6 +313,9 @@ class SQLiteIO:
                 self.ex(migration)
         self.write_meta()
         self.connection.commit()
+        if VACUUM_AFTER.intersection(range(version + 1, USER_VERSION + 1)):
+            logger.debug('Reclaiming unused space...')
+            self.ex('VACUUM')
         logger.debug('Migration finished')
 
     @property
@@ -183,40 +357,98 @@ class SQLiteIO:
 
     @handle_sqlite_errors
     def read(self):
+        if self.lazy:
+            # We only need the image data right away if we don't know
+            # the image's size, i.e. for files from older versions
+            imgdata = 'CASE WHEN sqlar.width IS NULL THEN sqlar.data END'
+        else:
+            imgdata = 'sqlar.data'
         rows = self.fetchall(
             'SELECT items.id, type, x, y, z, scale, rotation, flip, '
-            'items.data, sqlar.data '
-            'FROM items LEFT OUTER JOIN sqlar on sqlar.item_id = items.id')
+            f'items.data, sqlar.width, sqlar.height, {imgdata}, blob '
+            'FROM items LEFT OUTER JOIN sqlar on sqlar.name = items.blob')
         if self.worker:
             self.worker.begin_processing.emit(len(rows))
+        # Lazily loaded data is read from the file we have actually
+        # read, which might be a migrated temporary copy that needs to
+        # stay around as long as the items do:
+        reader = BlobReader(self._db_filename,
+                            tmpdir=getattr(self, '_tmpdir', None))
+        if hasattr(self, '_tmpdir'):
+            delattr(self, '_tmpdir')
 
-        for i, row in enumerate(rows):
-            data = {
-                'save_id': row[0],
-                'type': row[1],
-                'x': row[2],
-                'y': row[3],
-                'z': row[4],
-                'scale': row[5],
-                'rotation': row[6],
-                'flip': row[7],
-                'data': json.loads(row[8]),
-            }
-
-            if data['type'] == 'pixmap':
-                data['item'] = BeePixmapItem(QtGui.QImage())
-                data['item'].pixmap_from_bytes(row[9])
-
-            self.scene.add_item_later(data)
-
-            if self.worker:
-                logger.trace(f'Emit progress: {i}')
-                self.worker.progress.emit(i)
-                if self.worker.canceled:
-                    self.worker.finished.emit('', [])
+        # Decoding the images is by far the most expensive part of
+        # loading, so we fan it out to a pool of threads. The results
+        # are collected in row order so that items get added to the
+        # scene in the same order as they would be when decoding one
+        # after the other. Images used by several items only get
+        # decoded once. Like when importing, only a few images are
+        # decoded ahead of the items that need them, so that decoded
+        # images don't pile up in memory faster than they get used.
+        blobs = {}
+        for row in rows:
+            if (row[1] == 'pixmap' and row[11] is not None
+                    and row[12] not in blobs):
+                blobs[row[12]] = row[11]
+        uses = Counter(row[12] for row in rows if row[12] in blobs)
+        to_decode = iter(blobs.items())
+        started = set()
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            images = {}
+
+            def decode_next():
+                for blob, imgdata in to_decode:
+                    images[blob] = pool.submit(decode_image, imgdata)
                     return
-                # Give main thread time to process items:
-                self.worker.msleep(10)
+
+            for i in range(DECODE_AHEAD * (os.cpu_count() or 1)):
+                decode_next()
+
+            for i, row in enumerate(rows):
+                data = {
+                    'save_id': row[0],
+                    'type': row[1],
+                    'x': row[2],
+                    'y': row[3],
+                    'z': row[4],
+                    'scale': row[5],
+                    'rotation': row[6],
+                    'flip': row[7],
+                    'data': json.loads(row[8]),
+                }
+
+                if data['type'] == 'pixmap':
+                    if row[12] in blobs:
+                        if row[12] not in started:
+                            # Keep the pool busy while we wait
+                            started.add(row[12])
+                            decode_next()
+                        data['item'] = BeePixmapItem(
+                            images[row[12]].result(), image_data=row[11])
+                        uses[row[12]] -= 1
+                        if not uses[row[12]]:
+                            del images[row[12]]
+                    else:
+                        data['item'] = BeePixmapItem(QtGui.QImage())
+                        if row[9] is not None:
+                            data['item'].defer_pixmap(
+                                QtCore.QSize(row[9], row[10]),
+                                reader.pixmap_loader(row[12]))
+                    if row[12]:
+                        data['item'].mipmap_loader = reader.mipmap_loader(
+                            row[12])
+
+                self.scene.add_item_later(data)
+
+                if self.worker:
+                    logger.trace(f'Emit progress: {i}')
+                    self.worker.progress.emit(i)
+                    if self.worker.canceled:
+                        for future in images.values():
+                            future.cancel()
+                        self.worker.finished.emit('', [])
+                        return
         if self.worker:
             self.worker.finished.emit(self.filename, [])
 
@@ -239,67 +471,160 @@ class SQLiteIO:
                 self.write()
 
     def write_data(self):
-        to_delete = self.fetchall('SELECT id from ITEMS')
+        existing = {row[0] for row in self.fetchall('SELECT id from ITEMS')}
+        next_id = max(existing, default=0) + 1
         to_save = list(self.scene.items_for_save())
+        # Items that are in the file but have been removed from the scene:
+        to_delete = existing - {item.save_id for item in to_save}
         if self.worker:
             self.worker.begin_processing.emit(len(to_save))
+
+        # Write everything in one transaction so that we don't sync to
+        # disk for every single item. Foreign key checks are deferred to
+        # the end of the transaction since image data gets inserted as
+        # we go, while the item rows are inserted at the end in one go.
+        self.ex('BEGIN TRANSACTION')
+        self.ex('PRAGMA defer_foreign_keys=1')
+        # Image data written by older versions lacks the image size and
+        # mipmaps, so it can't be loaded lazily:
+        incomplete = dict(self.fetchall(
+            'SELECT items.id, items.blob FROM items '
+            'INNER JOIN sqlar ON sqlar.name = items.blob '
+            'WHERE sqlar.width IS NULL'))
+        to_insert = []
+        to_update = []
         for i, item in enumerate(to_save):
-            logger.debug(f'Saving {item} with id {item.save_id}')
-            if item.save_id:
-                self.update_item(item)
-                to_delete.remove((item.save_id,))
+            if item.save_id in existing:
+                # Only write items that have changed since the last save
+                if item.dirty:
+                    to_update.append(item)
+                if item.save_id in incomplete:
+                    self.complete_blob(item, incomplete[item.save_id])
             else:
-                self.insert_item(item)
+                # New items, or items whose rows have been deleted from
+                # the file in the meantime (e.g. by undoing a deletion)
+                item.save_id = next_id
+                next_id += 1
+                to_insert.append(item)
+                self.insert_blobs(item)
             if self.worker:
                 self.worker.progress.emit(i)
                 if self.worker.canceled:
                     break
+        # Logging each item individually is noticeably slow for big
+        # scenes, so we only log totals:
+        logger.debug(f'Inserting {len(to_insert)} items, '
+                     f'updating {len(to_update)} items, '
+                     f'deleting {len(to_delete)} items')
+        self.insert_items(to_insert)
+        self.update_items(to_update)
         self.delete_items(to_delete)
         self.connection.commit()
+        for item in to_insert + to_update:
+            item.dirty = False
         if self.worker:
             self.worker.finished.emit(self.filename, [])
 
-    def delete_items(self, to_delete):
-        self.exmany('DELETE FROM items WHERE id=?', to_delete)
-        self.connection.commit()
+    def delete_items(self, ids):
+        rows = [(save_id,) for save_id in ids]
+        self.exmany('DELETE FROM items WHERE id=?', rows)
+        if rows:
+            self.delete_orphaned_blobs()
+
+    def delete_orphaned_blobs(self):
+        """Delete image data that isn't used by any item anymore.
+
+        Foreign keys are only enforced on connections to newly created
+        files, so we need to get rid of the mipmaps ourselves.
+        """
+
+        self.ex('DELETE FROM sqlar WHERE name NOT IN '
+                '(SELECT blob FROM items WHERE blob IS NOT NULL)')
+        self.ex('DELETE FROM mipmaps WHERE blob NOT IN '
+                '(SELECT name FROM sqlar)')
+
+    def insert_items(self, items):
+        """Insert item data of new items. The items need to have their
+        save_id set already."""
+
+        self.exmany(
+            'INSERT INTO items (id, type, x, y, z, scale, rotation, flip, '
+            'data, blob) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            ((item.save_id, item.TYPE, item.pos().x(), item.pos().y(),
+              item.zValue(), item.scale(), item.rotation(), item.flip(),
+              json.dumps(item.get_extra_save_data()),
+              getattr(item, 'blob', None))
+             for item in items))
+
+    def insert_blobs(self, item):
+        """Insert pixmap data and mipmaps of a new item, unless the file
+        already contains the same image data.
+
+        Sets the item's ``blob`` attribute to the name the data is
+        stored under.
+        """
+
+        if not hasattr(item, 'pixmap_to_bytes'):
+            return
 
-    def insert_item(self, item):
+        pixmap = item.pixmap_to_bytes()
+        item.blob = blob_name(pixmap, item.image_format(pixmap))
+        row = self.fetchone(
+            'SELECT width FROM sqlar WHERE name=?', (item.blob,))
+        if row:
+            if row[0] is None:
+                self.complete_blob(item, item.blob)
+            return
+
+        size = item.pixmap_size()
         self.ex(
-            'INSERT INTO items (type, x, y, z, scale, rotation, flip, '
-            'data) '
-            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-            (item.TYPE, item.pos().x(), item.pos().y(), item.zValue(),
-             item.scale(), item.rotation(), item.flip(),
-             json.dumps(item.get_extra_save_data())))
-        item.save_id = self.cursor.lastrowid
-
-        if hasattr(item, 'pixmap_to_bytes'):
-            pixmap = item.pixmap_to_bytes()
-
-            if item.filename:
-                basename = os.path.splitext(os.path.basename(item.filename))[0]
-                name = '%04d-%s.png' % (item.save_id, basename)
-            else:
-                name = '%04d.png' % item.save_id
+            'INSERT INTO sqlar (name, mode, sz, data, width, height) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (item.blob, 0o644, len(pixmap), pixmap,
+             size.width(), size.height()))
+        self.exmany(
+            'INSERT OR REPLACE INTO mipmaps (blob, level, data) '
+            'VALUES (?, ?, ?)',
+            ((item.blob, level, data)
+             for level, data in item.mipmaps_to_bytes()))
+
+    def complete_blob(self, item, name):
+        """Fill in the image size and mipmaps of image data that has
+        been written by an older version, so that it can be loaded
+        lazily from now on.
+
+        :param item: An item showing the image stored under ``name``
+        """
 
-            self.ex(
-                'INSERT INTO sqlar (item_id, name, mode, sz, data) '
-                'VALUES (?, ?, ?, ?, ?)',
-                (item.save_id, name, 0o644, len(pixmap), pixmap))
-        self.connection.commit()
+        size = item.pixmap_size()
+        if size.isEmpty():
+            return
+        cursor = self.ex(
+            'UPDATE sqlar SET width=?, height=? '
+            'WHERE name=? AND width IS NULL',
+            (size.width(), size.height(), name))
+        if not cursor.rowcount:
+            # Already done for another item showing the same image
+            return
+        logger.debug(f'Added size to {name}; adding mipmaps')
+        self.exmany(
+            'INSERT OR IGNORE INTO mipmaps (blob, level, data) '
+            'VALUES (?, ?, ?)',
+            ((name, level, data) for level, data in item.mipmaps_to_bytes()))
 
-    def update_item(self, item):
+    def update_items(self, items):
         """Update item data.
 
         We only update the item data, not the pixmap data, as pixmap
         data never changes and is also time-consuming to save.
         """
-        self.ex(
+        self.exmany(
             'UPDATE items SET x=?, y=?, z=?, scale=?, rotation=?, flip=?, '
             'data=? '
             'WHERE id=?',
-            (item.pos().x(), item.pos().y(), item.zValue(), item.scale(),
-             item.rotation(), item.flip(),
-             json.dumps(item.get_extra_save_data()),
-             item.save_id))
-        self.connection.commit()
+            ((item.pos().x(), item.pos().y(), item.zValue(), item.scale(),
+              item.rotation(), item.flip(),
+              json.dumps(item.get_extra_save_data()),
+              item.save_id)
+             for item in items))
@@ -0,0 +1,126 @@
+# This file is part of BeeRef.
+#
+# BeeRef is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BeeRef is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BeeRef.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Scene geometry of many items at once, for arranging and normalizing.
+
+Mapping an item's rect to the scene goes through Qt every time, so
+operations on whole selections measure each item once up front and
+do the rest of their calculations on plain arrays of numbers.
+"""
+
+import array
+import math
+
+from PyQt6 import QtCore
+
+
+class GeometrySnapshot:
+    """Scene bounding rects and positions of the given items.
+
+    The values are taken when the snapshot is created and don't follow
+    later changes to the items. Rects exclude selection handles, like
+    ``BeeGraphicsScene.itemsBoundingRect``.
+    """
+
+    def __init__(self, items):
+        self.items = list(items)
+        self.left = array.array('d')
+        self.top = array.array('d')
+        self.width = array.array('d')
+        self.height = array.array('d')
+        self.x = array.array('d')
+        self.y = array.array('d')
+
+        for item in self.items:
+            rect = item.mapRectToScene(item.bounding_rect_unselected())
+            pos = item.scenePos()
+            self.left.append(rect.left())
+            self.top.append(rect.top())
+            self.width.append(rect.width())
+            self.height.append(rect.height())
+            self.x.append(pos.x())
+            self.y.append(pos.y())
+
+    def __len__(self):
+        return len(self.items)
+
+    def rect(self, index):
+        """The scene bounding rect of the item at ``index``."""
+
+        return QtCore.QRectF(self.left[index], self.top[index],
+                             self.width[index], self.height[index])
+
+    def bounds(self):
+        """The bounding rect of all items."""
+
+        if not self.items:
+            return QtCore.QRectF(0, 0, 0, 0)
+
+        left = min(self.left)
+        top = min(self.top)
+        right = max(map(sum, zip(self.left, self.width)))
+        bottom = max(map(sum, zip(self.top, self.height)))
+        return QtCore.QRectF(left, top, right - left, bottom - top)
+
+    def center(self):
+        """The center of the bounding rect of all items."""
+
+        return self.bounds().center()
+
+    def areas(self):
+        return array.array(
+            'd', (w * h for w, h in zip(self.width, self.height)))
+
+    def normalize_factors(self, mode):
+        """Scale factors that bring all items to the average width,
+        height or size (area).
+
+        :param mode: "width", "height" or "size".
+        """
+
+        if mode == 'size':
+            areas = self.areas()
+            avg = sum(areas) / len(areas)
+            return [math.sqrt(avg / area) for area in areas]
+
+        values = getattr(self, mode)
+        avg = sum(values) / len(values)
+        return [avg / value for value in values]
+
+    def order(self, vertical=False):
+        """Item indices sorted from left to right, or from top to bottom
+        when ``vertical`` is set."""
+
+        keys = self.top if vertical else self.left
+        return sorted(range(len(self.items)), key=keys.__getitem__)
+
+    def origin_offsets(self):
+        """For each item, where its origin lies relative to the top
+        left corner of its scene bounding rect."""
+
+        return [QtCore.QPointF(x - left, y - top) for x, y, left, top
+                in zip(self.x, self.y, self.left, self.top)]
+
+    def scaled_positions(self, factors):
+        """The item positions after scaling each item by its factor
+        while keeping its center in place."""
+
+        positions = []
+        for i, factor in enumerate(factors):
+            cx = self.left[i] + self.width[i] / 2
+            cy = self.top[i] + self.height[i] / 2
+            positions.append((cx + (self.x[i] - cx) * factor,
+                              cy + (self.y[i] - cy) * factor))
+        return positions
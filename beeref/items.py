@@ -17,14 +17,24 @@
 text).
 """
 
+from functools import partial
 import logging
+import math
+import weakref
 
 from PyQt6 import QtCore, QtGui, QtWidgets
 from PyQt6.QtCore import Qt
 
 from beeref import commands
 from beeref.constants import COLORS
+from beeref.pixmapstore import (
+    key_from_data,
+    key_from_image,
+    pixmap_from_data,
+    pixmap_store,
+)
 from beeref.selection import SelectableMixin
+from beeref.spillstore import spill_store
 
 
 logger = logging.getLogger(__name__)
@@ -38,7 +48,63 @@ def register_item(cls):
 
 
 class BeeItemMixin(SelectableMixin):
-    """Base for all items added by the user."""
+    """Base for all items added by the user.
+
+    Items keep track of whether they have been changed since they were
+    last saved via their ``dirty`` attribute, so that saving only needs
+    to write the items that have actually changed.
+    """
+
+    # Changes that affect the item's extent in the scene:
+    GEOMETRY_CHANGES = (
+        QtWidgets.QGraphicsItem.GraphicsItemChange.ItemPositionHasChanged,
+        QtWidgets.QGraphicsItem.GraphicsItemChange.ItemTransformHasChanged,
+        QtWidgets.QGraphicsItem.GraphicsItemChange.ItemScaleHasChanged,
+        QtWidgets.QGraphicsItem.GraphicsItemChange.ItemRotationHasChanged,
+    )
+
+    def init_selectable(self):
+        super().init_selectable()
+        # Needed to keep the scene's cached bounding rect up to date
+        # when items get moved by Qt itself, e.g. when dragging:
+        self.setFlag(
+            QtWidgets.QGraphicsItem.GraphicsItemFlag.ItemSendsGeometryChanges)
+
+    def itemChange(self, change, value):
+        if change in self.GEOMETRY_CHANGES:
+            self.on_geometry_change()
+        # The scene emits selectionChanged before ItemSelectedHasChanged,
+        # so we need to notify it of the new state beforehand:
+        if (change == QtWidgets.QGraphicsItem.GraphicsItemChange
+                .ItemSelectedChange and self.scene()):
+            self.scene().on_item_selected_change(self, value)
+        return super().itemChange(change, value)
+
+    def on_geometry_change(self):
+        """Called when the item's extent in the scene has changed."""
+
+        if self.scene():
+            self.scene().invalidate_items_rect()
+
+    def setPos(self, *args):
+        super().setPos(*args)
+        self.dirty = True
+
+    def setScale(self, *args, **kwargs):
+        super().setScale(*args, **kwargs)
+        self.dirty = True
+
+    def setRotation(self, *args, **kwargs):
+        super().setRotation(*args, **kwargs)
+        self.dirty = True
+
+    def setZValue(self, value):
+        super().setZValue(value)
+        self.dirty = True
+
+    def do_flip(self, *args, **kwargs):
+        super().do_flip(*args, **kwargs)
+        self.dirty = True
 
     def set_pos_center(self, pos):
         """Sets the position using the item's center as the origin point."""
@@ -81,11 +147,38 @@ class BeePixmapItem(BeeItemMixin, QtWidgets.QGraphicsPixmapItem):
 
     TYPE = 'pixmap'
     CROP_HANDLE_SIZE = 15
+    MIPMAP_MIN_SIZE = 256
 
-    def __init__(self, image, filename=None):
-        super().__init__(QtGui.QPixmap.fromImage(image))
+    def __init__(self, image, filename=None, image_data=None):
+        """
+        :param image: The image as QImage
+        :param filename: The file the image was loaded from, if any
+        :param image_data: The image's original file content, if it
+            can be stored as is. Avoids re-encoding the image on save.
+
+        Pixmaps are shared via the pixmap store between all items
+        showing the same image.
+        """
+        super().__init__()
+        self.pixmap_key = None
+        self._pixmap_finalizer = None
+        self._spill_finalizer = None
+        if not image.isNull():
+            if image_data:
+                key = key_from_data(image_data)
+            else:
+                key = key_from_image(image)
+            pixmap = pixmap_store.acquire(
+                key, partial(QtGui.QPixmap.fromImage, image))
+            QtWidgets.QGraphicsPixmapItem.setPixmap(self, pixmap)
+            self._hold_stored_pixmap(key)
         self.save_id = None
+        self.dirty = True
         self.filename = filename
+        self.image_data = image_data
+        self.pixmap_loader = None
+        self.mipmap_loader = None
+        self.mipmaps = {}
         self.reset_crop()
         logger.debug(f'Initialized {self}')
         self.is_croppable = True
@@ -102,7 +195,7 @@ class BeePixmapItem(BeeItemMixin, QtWidgets.QGraphicsPixmapItem):
         return item
 
     def __str__(self):
-        size = self.pixmap().size()
+        size = self.pixmap_size()
         return (f'Image "{self.filename}" {size.width()} x {size.height()}')
 
     @property
@@ -114,6 +207,8 @@ class BeePixmapItem(BeeItemMixin, QtWidgets.QGraphicsPixmapItem):
         logger.debug(f'Setting crop for {self} to {value}')
         self.prepareGeometryChange()
         self._crop = value
+        self.dirty = True
+        self.on_geometry_change()
         self.update()
 
     def bounding_rect_unselected(self):
@@ -130,7 +225,21 @@ class BeePixmapItem(BeeItemMixin, QtWidgets.QGraphicsPixmapItem):
                          self.crop.height()]}
 
     def pixmap_to_bytes(self):
-        """Convert the pixmap data to PNG bytestring."""
+        """Convert the pixmap data to bytestring.
+
+        Returns the original image data if we have it, otherwise the
+        pixmap encoded as PNG. Deferred pixmaps aren't decoded; their
+        data is returned as it is read by the loader.
+        """
+        # This runs on the save thread while the GUI thread might load
+        # the deferred pixmap and reset the loader, so only read it once
+        loader = self.pixmap_loader
+        if loader:
+            data = loader()
+            if data:
+                return data
+        if self.image_data:
+            return self.image_data
         barray = QtCore.QByteArray()
         buffer = QtCore.QBuffer(barray)
         buffer.open(QtCore.QIODevice.OpenModeFlag.WriteOnly)
@@ -138,19 +247,343 @@ class BeePixmapItem(BeeItemMixin, QtWidgets.QGraphicsPixmapItem):
         img.save(buffer, 'PNG')
         return barray.data()
 
+    def image_format(self, data=None):
+        """The file format of the given data as returned by
+        ``pixmap_to_bytes``, e.g. ``png`` or ``jpg``.
+
+        :param data: Defaults to the original image data
+        """
+
+        data = data or self.image_data
+        if not data:
+            return 'png'
+        buffer = QtCore.QBuffer()
+        buffer.setData(data)
+        buffer.open(QtCore.QIODevice.OpenModeFlag.ReadOnly)
+        fmt = QtGui.QImageReader.imageFormat(buffer).data().decode()
+        if fmt == 'jpeg':
+            return 'jpg'
+        return fmt or 'png'
+
+    def mipmaps_to_bytes(self):
+        """Convert all mipmap levels to bytestrings.
+
+        Levels that haven't been generated yet are read from the bee
+        file if possible, otherwise generated from the next higher
+        level. Neither the generated levels nor the full resolution
+        image are kept, so that saving doesn't load deferred pixmaps
+        (e.g. of proxies) into memory and doesn't change the item
+        from the thread saving the file.
+
+        :returns: List of (level, bytestring) tuples
+        """
+
+        result = []
+        size = self.pixmap_size()
+        # The level before, as QImage or as encoded data:
+        previous = None
+        for level in range(1, self.max_mipmap_level() + 1):
+            data = None
+            if level in self.mipmaps:
+                previous = self.mipmaps[level].toImage()
+            else:
+                mipmap_loader = self.mipmap_loader
+                if mipmap_loader:
+                    data = mipmap_loader(level)
+                if data:
+                    previous = data
+                else:
+                    if isinstance(previous, bytes):
+                        previous = QtGui.QImage.fromData(previous)
+                    if previous is None or previous.isNull():
+                        previous = self._full_resolution_image()
+                    previous = previous.scaled(
+                        math.ceil(size.width() / 2**level),
+                        math.ceil(size.height() / 2**level),
+                        Qt.AspectRatioMode.IgnoreAspectRatio,
+                        Qt.TransformationMode.SmoothTransformation)
+            if not data:
+                barray = QtCore.QByteArray()
+                buffer = QtCore.QBuffer(barray)
+                buffer.open(QtCore.QIODevice.OpenModeFlag.WriteOnly)
+                if previous.hasAlphaChannel():
+                    previous.save(buffer, 'PNG')
+                else:
+                    previous.save(buffer, 'JPG', 90)
+                data = barray.data()
+            result.append((level, data))
+        return result
+
+    def _full_resolution_image(self):
+        """The full resolution image as QImage. Deferred pixmaps are
+        decoded without being loaded into the item."""
+
+        loader = self.pixmap_loader
+        if loader:
+            data = loader()
+            return QtGui.QImage.fromData(data) if data else QtGui.QImage()
+        return QtWidgets.QGraphicsPixmapItem.pixmap(self).toImage()
+
+    def pixmap(self):
+        self.load_deferred_pixmap()
+        return super().pixmap()
+
     def setPixmap(self, pixmap):
+        self._release_stored_pixmap()
+        self._release_spilled_data()
+        self.image_data = None
+        self.pixmap_loader = None
+        self.mipmap_loader = None
+        self.mipmaps = {}
         super().setPixmap(pixmap)
         self.reset_crop()
 
+    def _hold_stored_pixmap(self, key):
+        """Hold on to an acquired pixmap from the pixmap store until the
+        item gets a different pixmap or is garbage collected."""
+
+        self._release_stored_pixmap()
+        self.pixmap_key = key
+        self._pixmap_finalizer = weakref.finalize(
+            self, pixmap_store.release, key)
+        # Don't touch pixmaps anymore when the application is shutting
+        # down:
+        self._pixmap_finalizer.atexit = False
+
+    def _release_stored_pixmap(self):
+        if self._pixmap_finalizer:
+            self._pixmap_finalizer()
+        self._pixmap_finalizer = None
+        self.pixmap_key = None
+
+    def pixmap_size(self):
+        """The size of the pixmap. Doesn't trigger loading of deferred
+        pixmaps."""
+
+        if self.pixmap_loader:
+            return self.deferred_size
+        return super().pixmap().size()
+
+    def defer_pixmap(self, size, loader):
+        """Postpone loading the pixmap until it's actually needed, e.g.
+        when the item becomes visible for the first time.
+
+        :param size: The size of the pixmap as QSize
+        :param loader: Callable that returns the image data as bytestring
+        """
+
+        self.pixmap_loader = loader
+        self.deferred_size = size
+        self.reset_crop()
+
+    def set_proxy(self, image, data):
+        """Show a scaled down version of the image instead of the full
+        resolution pixmap, e.g. for large images on import. The full
+        resolution pixmap is loaded from ``data`` the same way as
+        deferred pixmaps once it's needed, e.g. when zooming in.
+
+        :param image: The image scaled down by a power of two as QImage
+        :param data: The original image data
+        """
+
+        buffer = QtCore.QBuffer()
+        buffer.setData(data)
+        size = QtGui.QImageReader(buffer).size()
+        level = round(math.log2(size.width() / image.width()))
+        if level < 1:
+            # Image hasn't been scaled down, nothing to defer
+            self.setPixmap(QtGui.QPixmap.fromImage(image))
+            self.image_data = data
+            return
+        logger.debug(f'Using proxy at mipmap level {level} for {self}')
+        self.setPixmap(QtGui.QPixmap())
+        self.defer_pixmap(size, lambda: data)
+        self.image_data = data
+        self.mipmaps[level] = QtGui.QPixmap.fromImage(image)
+
+    def load_deferred_pixmap(self):
+        """Load the pixmap if its loading has been deferred."""
+
+        if not self.pixmap_loader:
+            return
+        logger.debug(f'Loading deferred pixmap for {self}')
+        loader = self.pixmap_loader
+        self.pixmap_loader = None
+        data = loader()
+        self._release_spilled_data()
+        if data:
+            key = key_from_data(data)
+            pixmap = pixmap_store.acquire(
+                key, partial(pixmap_from_data, data))
+            self.image_data = data
+        else:
+            pixmap = QtGui.QPixmap()
+        # Not using self.setPixmap since we need to keep the crop:
+        QtWidgets.QGraphicsPixmapItem.setPixmap(self, pixmap)
+        if data:
+            self._hold_stored_pixmap(key)
+
+    def pixmap_bytes(self):
+        """The memory taken up by the full resolution pixmap, or 0 if it
+        isn't loaded."""
+
+        if self.pixmap_loader:
+            return 0
+        pixmap = QtWidgets.QGraphicsPixmapItem.pixmap(self)
+        return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+    def unload_pixmap(self):
+        """Free the full resolution pixmap and only keep the compressed
+        image data around. The pixmap gets loaded again the same way as
+        deferred pixmaps once it's needed.
+
+        :returns: True if the pixmap has been unloaded
+        """
+
+        if not self.pixmap_bytes() or self.crop_mode:
+            return False
+        logger.debug(f'Unloading pixmap for {self}')
+        data = self.pixmap_to_bytes()
+        size = self.pixmap_size()
+        self._release_stored_pixmap()
+        # Not using self.setPixmap/self.defer_pixmap since we need to
+        # keep the crop and mipmaps:
+        QtWidgets.QGraphicsPixmapItem.setPixmap(self, QtGui.QPixmap())
+        self.image_data = data
+        self.deferred_size = size
+        self.pixmap_loader = lambda: data
+        return True
+
+    def memory_bytes(self):
+        """The memory taken up by the full resolution pixmap, its
+        mipmaps and the compressed image data."""
+
+        mipmaps = sum(pixmap.width() * pixmap.height() * pixmap.depth() // 8
+                      for pixmap in self.mipmaps.values())
+        return (self.pixmap_bytes() + mipmaps + len(self.image_data or b''))
+
+    def spill_pixmap(self):
+        """Free all image data in memory and keep it in a temporary file
+        instead, for items that only live on in the undo history. The
+        pixmap gets loaded again the same way as deferred pixmaps once
+        it's needed.
+
+        :returns: The number of bytes freed
+        """
+
+        if self._spill_finalizer or self.crop_mode:
+            return 0
+        freed = self.memory_bytes()
+        if not freed:
+            return 0
+        logger.debug(f'Spilling pixmap for {self}')
+        data = self.pixmap_to_bytes()
+        size = self.pixmap_size()
+        key = spill_store.put(data)
+        self._release_stored_pixmap()
+        # Not using self.setPixmap/self.defer_pixmap since we need to
+        # keep the crop:
+        QtWidgets.QGraphicsPixmapItem.setPixmap(self, QtGui.QPixmap())
+        self.mipmaps = {}
+        self.image_data = None
+        self.deferred_size = size
+        self.pixmap_loader = partial(spill_store.get, key)
+        self._spill_finalizer = weakref.finalize(
+            self, spill_store.release, key)
+        self._spill_finalizer.atexit = False
+        return freed
+
+    def _release_spilled_data(self):
+        if self._spill_finalizer:
+            self._spill_finalizer()
+        self._spill_finalizer = None
+
+    def detach_from_file(self):
+        """Read everything that is still read lazily from the bee file,
+        so that the item doesn't depend on the file anymore.
+
+        Only the compressed image data is kept in memory; the pixmap
+        gets decoded from it once it's needed, the same way as unloaded
+        pixmaps. The pixmap itself isn't touched, so that this can be
+        called from the thread saving the file.
+        """
+
+        loader = self.pixmap_loader
+        # Spilled items don't depend on the bee file:
+        if loader and not self._spill_finalizer:
+            data = loader()
+            # Unless the pixmap has been loaded in the meantime:
+            if self.pixmap_loader is loader:
+                self.image_data = data
+                self.pixmap_loader = lambda: data
+        self.mipmap_loader = None
+
+    def max_mipmap_level(self):
+        """The number of mipmap levels below the full resolution pixmap.
+
+        Levels are generated until the longer side of the image would
+        drop below ``MIPMAP_MIN_SIZE``.
+        """
+
+        size = self.pixmap_size()
+        longest = max(size.width(), size.height())
+        if longest < 2 * self.MIPMAP_MIN_SIZE:
+            return 0
+        return int(math.log2(longest / self.MIPMAP_MIN_SIZE))
+
+    def mipmap_level(self, scale):
+        """The mipmap level best suited for painting at the given scale
+        (viewport pixels per image pixel)."""
+
+        if scale >= 1 or scale <= 0:
+            return 0
+        level = int(math.floor(math.log2(1 / scale)))
+        return min(level, self.max_mipmap_level())
+
+    def get_mipmap(self, level):
+        """The pixmap scaled down by a factor of ``2 ** level``.
+
+        Mipmaps are read from the bee file if possible, otherwise
+        generated from the next higher level.
+        """
+
+        if level == 0:
+            return self.pixmap()
+        if level not in self.mipmaps:
+            pixmap = QtGui.QPixmap()
+            # The loader might get dropped by another thread meanwhile:
+            mipmap_loader = self.mipmap_loader
+            if mipmap_loader:
+                data = mipmap_loader(level)
+                if data:
+                    pixmap.loadFromData(data)
+            if pixmap.isNull():
+                logger.debug(f'Generating mipmap level {level} for {self}')
+                size = self.pixmap_size()
+                pixmap = self.get_mipmap(level - 1).scaled(
+                    math.ceil(size.width() / 2**level),
+                    math.ceil(size.height() / 2**level),
+                    Qt.AspectRatioMode.IgnoreAspectRatio,
+                    Qt.TransformationMode.SmoothTransformation)
+            self.mipmaps[level] = pixmap
+        return self.mipmaps[level]
+
     def pixmap_from_bytes(self, data):
         """Set image pimap from a bytestring."""
-        pixmap = QtGui.QPixmap()
-        pixmap.loadFromData(data)
+        key = key_from_data(data)
+        pixmap = pixmap_store.acquire(key, partial(pixmap_from_data, data))
         self.setPixmap(pixmap)
+        self._hold_stored_pixmap(key)
+        if not pixmap.isNull():
+            self.image_data = data
 
     def create_copy(self):
         item = BeePixmapItem(QtGui.QImage(), self.filename)
         item.setPixmap(self.pixmap())
+        if self.pixmap_key:
+            pixmap_store.acquire(self.pixmap_key, self.pixmap)
+            item._hold_stored_pixmap(self.pixmap_key)
+        item.image_data = self.image_data
         item.setPos(self.pos())
         item.setZValue(self.zValue())
         item.setScale(self.scale())
@@ -158,14 +591,15 @@ class BeePixmapItem(BeeItemMixin, QtWidgets.QGraphicsPixmapItem):
         if self.flip() == -1:
             item.do_flip()
         item.crop = self.crop
+        item.mipmaps = dict(self.mipmaps)
         return item
 
     def copy_to_clipboard(self, clipboard):
         clipboard.setPixmap(self.pixmap())
 
     def reset_crop(self):
-        self.crop = QtCore.QRectF(
-            0, 0, self.pixmap().size().width(), self.pixmap().size().height())
+        size = self.pixmap_size()
+        self.crop = QtCore.QRectF(0, 0, size.width(), size.height())
 
     @property
     def crop_handle_size(self):
@@ -298,13 +732,32 @@ class BeePixmapItem(BeeItemMixin, QtWidgets.QGraphicsPixmapItem):
                 self.draw_crop_rect(painter, handle())
             self.draw_crop_rect(painter, self.crop_temp)
         else:
-            painter.drawPixmap(self.crop, self.pixmap(), self.crop)
+            level = 0
+            if self.scene() and self.scene().views():
+                level = self.mipmap_level(
+                    self.scene().views()[0].get_scale() * self.scale())
+            if level:
+                # Paint from a lower resolution version of the image
+                # to save on scaling and texture upload costs:
+                pixmap = self.get_mipmap(level)
+                size = self.pixmap_size()
+                factor_x = pixmap.width() / size.width()
+                factor_y = pixmap.height() / size.height()
+                source = QtCore.QRectF(self.crop.x() * factor_x,
+                                       self.crop.y() * factor_y,
+                                       self.crop.width() * factor_x,
+                                       self.crop.height() * factor_y)
+                painter.drawPixmap(self.crop, pixmap, source)
+            else:
+                painter.drawPixmap(self.crop, self.pixmap(), self.crop)
             self.paint_selectable(painter, option, widget)
 
     def enter_crop_mode(self):
         logger.debug(f'Entering crop mode on {self}')
+        self.load_deferred_pixmap()
         self.prepareGeometryChange()
         self.crop_mode = True
+        self.on_geometry_change()
         self.crop_temp = QtCore.QRectF(self.crop)
         self.crop_mode_move = None
         self.crop_mode_event_start = None
@@ -319,6 +772,7 @@ class BeePixmapItem(BeeItemMixin, QtWidgets.QGraphicsPixmapItem):
                 commands.CropItem(self, self.crop_temp))
         self.prepareGeometryChange()
         self.crop_mode = False
+        self.on_geometry_change()
         self.crop_temp = None
         self.crop_mode_move = None
         self.crop_mode_event_start = None
@@ -434,6 +888,8 @@ class BeeTextItem(BeeItemMixin, QtWidgets.QGraphicsTextItem):
     def __init__(self, text=None):
         super().__init__(text or "Text")
         self.save_id = None
+        self.dirty = True
+        self.document().contentsChanged.connect(self.on_contents_changed)
         logger.debug(f'Initialized {self}')
         self.is_croppable = False
         self.init_selectable()
@@ -454,6 +910,10 @@ class BeeTextItem(BeeItemMixin, QtWidgets.QGraphicsTextItem):
     def get_extra_save_data(self):
         return {'text': self.toPlainText()}
 
+    def on_contents_changed(self):
+        self.dirty = True
+        self.on_geometry_change()
+
     def contains(self, point):
         return self.boundingRect().contains(point)
 
@@ -0,0 +1,379 @@
+# This file is part of BeeRef.
+#
+# BeeRef is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BeeRef is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BeeRef.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Packing rectangles as tightly as possible, for arranging items.
+
+All algorithms pack into a strip of a given width and return the
+positions of the rectangles. ``PackingJob`` tries different strip
+widths until it runs out of time and keeps the layout that fits into
+the smallest square.
+"""
+
+import logging
+import math
+import time
+
+from PyQt6 import QtCore
+
+import rpack
+
+
+logger = logging.getLogger(__name__)
+
+
+class PackingInterrupted(Exception):
+    pass
+
+
+def _never_interrupted():
+    return False
+
+
+def _by_height(sizes):
+    """Indices of the given sizes, highest first."""
+
+    return sorted(range(len(sizes)),
+                  key=lambda i: (sizes[i][1], sizes[i][0]),
+                  reverse=True)
+
+
+def pack_shelf(sizes, width, interrupted=_never_interrupted):
+    """Shelf packing (first fit decreasing height): Rectangles are put
+    next to each other in rows, highest first. Each rectangle goes into
+    the first row it fits in. Fast, but leaves gaps above the lower
+    rectangles of each row."""
+
+    positions = [None] * len(sizes)
+    # Each shelf is a list of [y, height, used width]
+    shelves = []
+    bottom = 0
+    for i in _by_height(sizes):
+        if interrupted():
+            raise PackingInterrupted()
+        w, h = sizes[i]
+        for shelf in shelves:
+            if shelf[2] + w <= width:
+                break
+        else:
+            shelf = [bottom, h, 0]
+            shelves.append(shelf)
+            bottom += h
+        positions[i] = (shelf[2], shelf[0])
+        shelf[2] += w
+    return positions
+
+
+def pack_skyline(sizes, width, interrupted=_never_interrupted):
+    """Skyline packing: Keeps track of the upper outline of everything
+    packed so far, and puts each rectangle where its top ends up lowest.
+    Highest rectangles first."""
+
+    positions = [None] * len(sizes)
+    # Each segment of the skyline is a list of [x, y, width]
+    skyline = [[0, 0, width]]
+    for i in _by_height(sizes):
+        if interrupted():
+            raise PackingInterrupted()
+        w, h = sizes[i]
+        best = None
+        for start in range(len(skyline)):
+            x = skyline[start][0]
+            if x + w > width:
+                break
+            # The rectangle rests on the highest segment it spans
+            y = 0
+            end = start
+            while skyline[end][0] < x + w:
+                y = max(y, skyline[end][1])
+                end += 1
+                if end == len(skyline):
+                    break
+            if best is None or (y + h, x) < (best[1] + h, best[0]):
+                best = (x, y, start, end)
+
+        x, y, start, end = best
+        positions[i] = (x, y)
+        # Replace the covered segments with the top of the rectangle,
+        # keeping what's left of the last one
+        last = skyline[end - 1]
+        rest = last[0] + last[2] - (x + w)
+        new = [[x, y + h, w]]
+        if rest > 0:
+            new.append([x + w, last[1], rest])
+        skyline[start:end] = new
+        # Merge neighbouring segments of the same height
+        merged = [skyline[0]]
+        for segment in skyline[1:]:
+            if segment[1] == merged[-1][1]:
+                merged[-1][2] += segment[2]
+            else:
+                merged.append(segment)
+        skyline = merged
+    return positions
+
+
+def _contains(outer, inner):
+    return (outer[0] <= inner[0] and outer[1] <= inner[1]
+            and inner[0] + inner[2] <= outer[0] + outer[2]
+            and inner[1] + inner[3] <= outer[1] + outer[3])
+
+
+def pack_maxrects(sizes, width, interrupted=_never_interrupted):
+    """MaxRects packing: Keeps a list of all maximal free rectangles and
+    puts each rectangle into the free one where its top ends up lowest.
+    Usually packs tightest, but gets slow with many rectangles."""
+
+    positions = [None] * len(sizes)
+    # Free rectangles as (x, y, width, height); the strip is as high as
+    # all rectangles on top of each other:
+    free = [(0, 0, width, sum(h for w, h in sizes))]
+    for i in _by_height(sizes):
+        if interrupted():
+            raise PackingInterrupted()
+        w, h = sizes[i]
+        best = None
+        for fx, fy, fw, fh in free:
+            if w <= fw and h <= fh and (
+                    best is None or (fy + h, fx) < (best[1] + h, best[0])):
+                best = (fx, fy)
+
+        x, y = best
+        positions[i] = best
+        # Split all free rectangles that overlap the new one into the
+        # maximal rectangles left around it
+        kept = []
+        split = []
+        for fx, fy, fw, fh in free:
+            if (x >= fx + fw or x + w <= fx
+                    or y >= fy + fh or y + h <= fy):
+                kept.append((fx, fy, fw, fh))
+                continue
+            if x > fx:
+                split.append((fx, fy, x - fx, fh))
+            if x + w < fx + fw:
+                split.append((x + w, fy, fx + fw - x - w, fh))
+            if y > fy:
+                split.append((fx, fy, fw, y - fy))
+            if y + h < fy + fh:
+                split.append((fx, y + h, fw, fy + fh - y - h))
+        # Drop free rectangles that lie within others. The ones we kept
+        # didn't lie within each other before, so only the new ones
+        # need to be compared to everything.
+        split = [rect for j, rect in enumerate(split)
+                 if not any(_contains(other, rect) for other in kept)
+                 and not any(_contains(other, rect)
+                             and (other != rect or k < j)
+                             for k, other in enumerate(split) if k != j)]
+        free = [rect for rect in kept
+                if not any(_contains(other, rect) for other in split)]
+        free.extend(split)
+    return positions
+
+
+def pack_rpack(sizes, width, interrupted=_never_interrupted):
+    """Packing with the rectangle-packer library into a square of the
+    given width. Packs tightly, but is very slow with many rectangles
+    and can't be interrupted while it's running.
+
+    :returns: None if the rectangles don't fit into the square
+    """
+
+    try:
+        return rpack.pack(sizes, max_width=width, max_height=width)
+    except rpack.PackingImpossibleError:
+        return None
+
+
+ALGORITHMS = {
+    'skyline': pack_skyline,
+    'maxrects': pack_maxrects,
+    'shelf': pack_shelf,
+    'rpack': pack_rpack,
+}
+
+DEFAULT_ALGORITHM = 'skyline'
+# rpack packs more densely than the default algorithm, but can't be
+# interrupted and gets very slow with many items. Up to this many items,
+# it takes well below the time budget, so the default search tries it
+# as well:
+RPACK_MAX_ITEMS = 50
+# Seconds:
+DEFAULT_TIME_BUDGET = 1
+
+
+class Layout:
+    """The result of packing rectangles of the given sizes."""
+
+    def __init__(self, sizes, positions, algorithm):
+        self.sizes = sizes
+        self.positions = positions
+        self.algorithm = algorithm
+        self.width = max(x + w for (x, y), (w, h) in zip(positions, sizes))
+        self.height = max(y + h for (x, y), (w, h) in zip(positions, sizes))
+
+    def __repr__(self):
+        return (f'<Layout {self.algorithm} {self.width}x{self.height} '
+                f'density={self.density:.3f}>')
+
+    @property
+    def density(self):
+        """How much of the layout's bounding box is covered (0 to 1)."""
+
+        area = sum(w * h for w, h in self.sizes)
+        return area / (self.width * self.height) if area else 1
+
+    def score(self):
+        """Lower is better: We want the layout to fit into the smallest
+        possible square, like the items had been arranged before, and
+        among those the one with the smallest area."""
+
+        return (max(self.width, self.height), self.width * self.height)
+
+
+class PackingJob:
+    """Searches for a good layout of the given items.
+
+    Packs with the given algorithm into strips of increasing width,
+    starting at the side of the smallest square that could fit all
+    items, and keeps the best layout. Always tries shelf packing first,
+    which is fast and gives good results when the items have similar
+    heights, so that there is a result even if the time budget runs
+    out early. With the default algorithm, small selections are also
+    packed with rpack, which is denser.
+
+    :param items: The items to arrange; not used for packing
+    :param sizes: List of (width, height) tuples, one for each item
+    :param center: Where the arranged items should be centered
+    :param algorithm: One of ``ALGORITHMS``
+    :param time_budget: Maximum seconds to search for, None for no limit
+    """
+
+    # Strip widths to try, relative to the smallest square:
+    WIDTH_FACTORS = [1 + i * 0.025 for i in range(21)]
+
+    def __init__(self, items, sizes, center, algorithm=DEFAULT_ALGORITHM,
+                 time_budget=DEFAULT_TIME_BUDGET):
+        self.items = items
+        self.sizes = sizes
+        self.center = center
+        self.algorithm = algorithm
+        self.time_budget = time_budget
+        self.canceled = False
+        self.layout = None
+        self._deadline = None
+
+    def widths(self):
+        min_area = sum(w * h for w, h in self.sizes)
+        start = max(math.ceil(math.sqrt(min_area)),
+                    max(w for w, h in self.sizes))
+        widths = []
+        for factor in self.WIDTH_FACTORS:
+            width = math.ceil(start * factor)
+            if width not in widths:
+                widths.append(width)
+        return widths
+
+    def candidates(self):
+        """The (algorithm, strip width) combinations to try, in order."""
+
+        widths = self.widths()
+        candidates = [('shelf', width) for width in widths]
+        if self.algorithm != 'shelf':
+            candidates.extend((self.algorithm, width) for width in widths)
+        if (self.algorithm == DEFAULT_ALGORITHM
+                and len(self.sizes) <= RPACK_MAX_ITEMS):
+            candidates.extend(('rpack', width) for width in widths)
+        return candidates
+
+    def num_candidates(self):
+        return len(self.candidates())
+
+    def cancel(self):
+        self.canceled = True
+
+    def is_canceled(self):
+        return self.canceled
+
+    def interrupted(self):
+        return self.canceled or (
+            self._deadline is not None
+            and time.perf_counter() > self._deadline)
+
+    def run(self, on_improved=None, on_progress=None):
+        """Search for the best layout until all strip widths have been
+        tried, the time budget is used up or the job gets canceled.
+
+        :param on_improved: Called with each layout that's better than
+            all before
+        :param on_progress: Called with the number of strip widths tried
+        :returns: The best layout, or None when canceled
+        """
+
+        start = time.perf_counter()
+        if self.time_budget is not None:
+            self._deadline = start + self.time_budget
+        for i, (algorithm, width) in enumerate(self.candidates()):
+            # The first packing is always finished, unless canceled,
+            # so that we have a result even with a tiny time budget
+            interrupted = self.interrupted if i else self.is_canceled
+            try:
+                positions = ALGORITHMS[algorithm](
+                    self.sizes, width, interrupted=interrupted)
+            except PackingInterrupted:
+                break
+            if positions is not None:
+                layout = Layout(self.sizes, positions, algorithm)
+                if (self.layout is None
+                        or layout.score() < self.layout.score()):
+                    logger.debug(f'Found better layout: {layout}')
+                    self.layout = layout
+                    if on_improved:
+                        on_improved(layout)
+            if on_progress:
+                on_progress(i + 1)
+            if self.interrupted():
+                break
+
+        logger.debug(f'Packing took {time.perf_counter() - start:.3f}s, '
+                     f'best layout: {self.layout}')
+        if self.canceled:
+            self.layout = None
+        return self.layout
+
+
+class ThreadedPacking(QtCore.QThread):
+    """Runs a ``PackingJob`` in its own thread.
+
+    Offers the same signals as ``fileio.ThreadedIO``, so that it can
+    be used with ``widgets.BeeProgressDialog``.
+    """
+
+    progress = QtCore.pyqtSignal(int)
+    finished = QtCore.pyqtSignal(str, list)
+    begin_processing = QtCore.pyqtSignal(int)
+    improved = QtCore.pyqtSignal(object)
+
+    def __init__(self, job):
+        super().__init__()
+        self.job = job
+
+    def run(self):
+        self.begin_processing.emit(self.job.num_candidates())
+        self.job.run(on_improved=self.improved.emit,
+                     on_progress=self.progress.emit)
+        self.finished.emit('', [])
+
+    def on_canceled(self):
+        self.job.cancel()
@@ -0,0 +1,187 @@
+# This file is part of BeeRef.
+#
+# BeeRef is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BeeRef is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BeeRef.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Process-wide store for the pixmaps of image items.
+
+Pixmaps are keyed by a hash of their content, so that items showing
+the same image (copies, repeated pastes, loading the same image
+several times) share a single pixmap in memory.
+"""
+
+from collections import OrderedDict
+import hashlib
+import logging
+import threading
+
+from PyQt6 import QtGui
+
+
+logger = logging.getLogger(__name__)
+
+
+def key_from_data(data):
+    """The store key for an image given as encoded file content."""
+
+    return 'data:' + hashlib.sha256(data).hexdigest()
+
+
+def key_from_image(image):
+    """The store key for an image given as QImage."""
+
+    bits = image.constBits()
+    bits.setsize(image.sizeInBytes())
+    digest = hashlib.sha256(bits).hexdigest()
+    return (f'image:{image.width()}x{image.height()}:'
+            f'{image.format().value}:{digest}')
+
+
+def pixmap_from_data(data):
+    """Decode the given image file content into a pixmap."""
+
+    pixmap = QtGui.QPixmap()
+    pixmap.loadFromData(data)
+    return pixmap
+
+
+class StoreEntry:
+
+    def __init__(self, pixmap):
+        self.pixmap = pixmap
+        self.refs = 0
+        self.nbytes = pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+
+class PixmapStore:
+    """Refcounted pixmaps, keyed by content hash.
+
+    Every ``acquire`` of a key needs to be balanced by a ``release``.
+    Pixmaps that aren't referenced anymore are kept around for reuse
+    (e.g. when pasting an image again) and get evicted least recently
+    used first once they take up more than ``max_unused_bytes``.
+    """
+
+    MAX_UNUSED_BYTES = 256 * 1024 * 1024
+
+    def __init__(self, max_unused_bytes=None):
+        if max_unused_bytes is None:
+            max_unused_bytes = self.MAX_UNUSED_BYTES
+        self.max_unused_bytes = max_unused_bytes
+        self.unused_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @property
+    def resident_bytes(self):
+        """The memory taken up by all stored pixmaps."""
+
+        with self._lock:
+            return sum(entry.nbytes for entry in self._entries.values())
+
+    def refcount(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry.refs if entry else 0
+
+    def acquire(self, key, factory):
+        """Get the pixmap stored under the given key and increase its
+        refcount.
+
+        :param key: The content hash as returned by ``key_from_data`` or
+            ``key_from_image``
+        :param factory: Callable that creates the pixmap if it isn't
+            stored yet
+        """
+
+        pixmap = None
+        if key not in self._entries:
+            # Decoding can take a while, so don't block other threads
+            # meanwhile. If someone else stores the same image in the
+            # meantime, we use theirs instead.
+            pixmap = factory()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if pixmap is None:
+                    pixmap = factory()
+                logger.debug(f'Storing pixmap {key}')
+                entry = self._entries[key] = StoreEntry(pixmap)
+            elif entry.refs == 0:
+                self.unused_bytes -= entry.nbytes
+            entry.refs += 1
+            self._entries.move_to_end(key)
+            return QtGui.QPixmap(entry.pixmap)
+
+    def release(self, key):
+        """Decrease the refcount of the pixmap stored under the given
+        key."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.refs == 0:
+                logger.warning(f'Releasing unreferenced pixmap {key}')
+                return
+            entry.refs -= 1
+            if entry.refs == 0:
+                self.unused_bytes += entry.nbytes
+                self._entries.move_to_end(key)
+                self.evict()
+
+    def evict(self):
+        """Remove unreferenced pixmaps, least recently used first, until
+        they don't take up more than ``max_unused_bytes``."""
+
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if self.unused_bytes <= self.max_unused_bytes:
+                    break
+                if entry.refs == 0:
+                    logger.debug(f'Evicting pixmap {key}')
+                    del self._entries[key]
+                    self.unused_bytes -= entry.nbytes
+
+    def discard(self, key):
+        """Remove the pixmap stored under the given key right away if it
+        isn't referenced anymore.
+
+        :returns: True if the pixmap has been removed, else False
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.refs:
+                return False
+            logger.debug(f'Discarding pixmap {key}')
+            del self._entries[key]
+            self.unused_bytes -= entry.nbytes
+            return True
+
+    def clear(self):
+        """Remove all unreferenced pixmaps."""
+
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry.refs == 0:
+                    del self._entries[key]
+            self.unused_bytes = 0
+
+
+pixmap_store = PixmapStore()
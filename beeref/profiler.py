@@ -0,0 +1,135 @@
+# This file is part of BeeRef.
+#
+# BeeRef is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BeeRef is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BeeRef.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Collecting frame times and other timings for performance analysis.
+
+Enabled with the ``--profile`` command line option. Timings are shown
+in an overlay on the view and can be written to a trace file in the
+Chrome trace event format (viewable with chrome://tracing or Perfetto).
+"""
+
+from contextlib import contextmanager
+from functools import wraps
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class Profiler:
+    """Collects timings per frame and for the whole session."""
+
+    # Maximum number of trace events to keep, so that long sessions
+    # don't eat up all memory:
+    MAX_TRACE_EVENTS = 1000000
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_events = []
+        self.frame = {}
+        self.last_frame = {}
+        self.input_start = None
+        self._start = time.perf_counter()
+
+    def now(self):
+        """Microseconds since the profiler has been created."""
+
+        return (time.perf_counter() - self._start) * 1000000
+
+    def add_trace_event(self, name, start, duration):
+        if len(self.trace_events) < self.MAX_TRACE_EVENTS:
+            self.trace_events.append({
+                'name': name,
+                'ph': 'X',
+                'ts': start,
+                'dur': duration,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+            })
+
+    @contextmanager
+    def measure(self, name):
+        """Context manager that records how long its block takes.
+
+        Times of the same name add up until the end of the current
+        frame.
+        """
+
+        if not self.enabled:
+            yield
+            return
+
+        start = self.now()
+        try:
+            yield
+        finally:
+            duration = self.now() - start
+            self.frame[name] = self.frame.get(name, 0) + duration
+            self.add_trace_event(name, start, duration)
+
+    def mark_input(self):
+        """Called when an input event arrives. The time until the next
+        frame has been painted is the input latency."""
+
+        if self.enabled and self.input_start is None:
+            self.input_start = self.now()
+
+    def end_frame(self, **values):
+        """Called after a frame has been painted. Makes the timings of
+        the frame available in ``last_frame``.
+
+        :param values: Additional values to record for this frame
+        """
+
+        if not self.enabled:
+            return
+        self.frame.update(values)
+        if self.input_start is not None:
+            latency = self.now() - self.input_start
+            self.frame['input_latency'] = latency
+            self.add_trace_event('input_latency', self.input_start, latency)
+            self.input_start = None
+        self.last_frame = self.frame
+        self.frame = {}
+
+    def write_trace(self, filename):
+        """Write all recorded events as a Chrome trace JSON file."""
+
+        logger.info(f'Writing profiler trace to {filename}')
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': self.trace_events,
+                       'displayTimeUnit': 'ms'}, f)
+
+
+profiler = Profiler()
+
+
+def profiled(name):
+    """Decorator that records the run time of the decorated function
+    when profiling is enabled."""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            with profiler.measure(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
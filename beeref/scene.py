@@ -13,17 +13,19 @@
 # You should have received a copy of the GNU General Public License
 # along with BeeRef.  If not, see <https://www.gnu.org/licenses/>.
 
+from contextlib import contextmanager
 from queue import Queue
 import logging
-import math
 
 from PyQt6 import QtCore, QtWidgets
 from PyQt6.QtCore import Qt
 
-import rpack
-
 from beeref import commands
+from beeref import packing
+from beeref.geometry import GeometrySnapshot
 from beeref.items import item_registry
+from beeref.pixmapstore import pixmap_store
+from beeref.profiler import profiled
 from beeref.selection import MultiSelectItem, RubberbandItem
 
 
@@ -32,6 +34,20 @@ logger = logging.getLogger(__name__)
 
 class BeeGraphicsScene(QtWidgets.QGraphicsScene):
 
+    # How many items a loading thread may queue up before it has to
+    # wait for the main thread to catch up:
+    MAX_QUEUED_ITEMS = 50
+    # How long the main thread may spend on adding queued items in
+    # one go before it lets the event loop process other events (ms):
+    ADD_ITEMS_TIME_BUDGET = 8
+    # Minimum time between two selection updates while dragging the
+    # rubberband, so that we update at most once per frame (ms):
+    RUBBERBAND_UPDATE_INTERVAL = 16
+    # Share of all items that need to change at once before it's
+    # cheaper to rebuild Qt's item index afterwards than to update it
+    # for every single item:
+    BULK_INDEX_RATIO = 0.5
+
     def __init__(self, undo_stack):
         super().__init__()
         self.move_active = False
@@ -44,18 +60,103 @@ class BeeGraphicsScene(QtWidgets.QGraphicsScene):
         self.rubberband_item = RubberbandItem()
         self.selectionChanged.connect(self.on_selection_change)
         self.changed.connect(self.on_change)
-        self.items_to_add = Queue()
+        self.items_to_add = Queue(maxsize=self.MAX_QUEUED_ITEMS)
+        self.add_items_timer = QtCore.QTimer(self)
+        self.add_items_timer.setSingleShot(True)
+        self.add_items_timer.timeout.connect(self.add_queued_items_batch)
+        self.rubberband_timer = QtCore.QTimer(self)
+        self.rubberband_timer.setSingleShot(True)
+        self.rubberband_timer.setInterval(self.RUBBERBAND_UPDATE_INTERVAL)
+        self.rubberband_timer.timeout.connect(self.on_rubberband_timer)
+        self.rubberband_pending = False
         self.internal_clipboard = []
         self.edit_item = None
         self.crop_item = None
+        # Bounding rect of all user items, see itemsBoundingRect:
+        self._items_rect = None
+        # User items and selected user items, in the order they have
+        # been added/selected. Dicts as ordered sets:
+        self._user_items = {}
+        self._selected_user_items = {}
 
     def addItem(self, item):
         logger.debug(f'Adding item {item}')
+        # Update the registry first, since Qt might emit selectionChanged
+        # while adding/removing:
+        if self.is_user_item(item):
+            self._user_items[item] = None
+            if item.isSelected():
+                self._selected_user_items[item] = None
         super().addItem(item)
+        self.invalidate_items_rect()
 
     def removeItem(self, item):
         logger.debug(f'Removing item {item}')
+        self._user_items.pop(item, None)
+        self._selected_user_items.pop(item, None)
         super().removeItem(item)
+        self.invalidate_items_rect()
+
+    def clear(self):
+        # Reset our bookkeeping first: Qt emits selectionChanged while
+        # deleting the items, and we mustn't touch them anymore then.
+        self._user_items = {}
+        self._selected_user_items = {}
+        super().clear()
+        self.invalidate_items_rect()
+
+    @staticmethod
+    def is_user_item(item):
+        """User items are items added by the user (i.e. no multi select
+        outlines and other UI items). They have a ``save_id``
+        attribute."""
+
+        return hasattr(item, 'save_id')
+
+    def user_items(self):
+        """All user items in the scene, in the order they have been
+        added."""
+
+        return list(self._user_items)
+
+    def on_item_selected_change(self, item, value):
+        """Called by user items when they get selected or deselected."""
+
+        if value and item in self._user_items:
+            self._selected_user_items[item] = None
+        else:
+            self._selected_user_items.pop(item, None)
+
+    def invalidate_items_rect(self):
+        """Discard the cached bounding rect of all items. Needs to be
+        called whenever an item's extent in the scene changes."""
+
+        self._items_rect = None
+
+    @contextmanager
+    def bulk_transform(self, items):
+        """Context manager for changing the position or transformation
+        of many items at once.
+
+        Qt updates its item index with every single change, which
+        requires the item's bounding rect each time. When a large
+        part of the scene changes, the index gets switched off instead
+        and rebuilt once afterwards.
+        """
+
+        no_index = QtWidgets.QGraphicsScene.ItemIndexMethod.NoIndex
+        method = self.itemIndexMethod()
+        if (method == no_index
+                or len(items) < len(self._user_items) * self.BULK_INDEX_RATIO):
+            yield
+            return
+
+        logger.debug(f'Suspending item index for {len(items)} items')
+        self.setItemIndexMethod(no_index)
+        try:
+            yield
+        finally:
+            self.setItemIndexMethod(method)
 
     def cancel_crop_mode(self):
         """Cancels an ongoing crop mode, if there is any."""
@@ -95,29 +196,19 @@ class BeeGraphicsScene(QtWidgets.QGraphicsScene):
             item.setZValue(item.zValue() + delta)
 
     def normalize_width_or_height(self, mode):
-        """Scale the selected images to have the same width or height, as
-        specified by ``mode``.
+        """Scale the selected images to have the same width, height or
+        size, as specified by ``mode``.
 
-        :param mode: "width" or "height".
+        :param mode: "width", "height" or "size".
         """
 
         self.cancel_crop_mode()
-        values = []
         items = self.selectedItems(user_only=True)
-        for item in items:
-            rect = self.itemsBoundingRect(items=[item])
-            values.append(getattr(rect, mode)())
-        if len(values) < 2:
+        if len(items) < 2:
             return
-        avg = sum(values) / len(values)
-        logger.debug(f'Calculated average {mode} {avg}')
-
-        scale_factors = []
-        for item in items:
-            rect = self.itemsBoundingRect(items=[item])
-            scale_factors.append(avg / getattr(rect, mode)())
+        geometry = GeometrySnapshot(items)
         self.undo_stack.push(
-            commands.NormalizeItems(items, scale_factors))
+            commands.NormalizeItems(items, geometry.normalize_factors(mode)))
 
     def normalize_height(self):
         """Scale selected images to the same height."""
@@ -133,25 +224,7 @@ class BeeGraphicsScene(QtWidgets.QGraphicsScene):
         Size meaning the area = widh * height.
         """
 
-        self.cancel_crop_mode()
-        sizes = []
-        items = self.selectedItems(user_only=True)
-        for item in items:
-            rect = self.itemsBoundingRect(items=[item])
-            sizes.append(rect.width() * rect.height())
-
-        if len(sizes) < 2:
-            return
-
-        avg = sum(sizes) / len(sizes)
-        logger.debug(f'Calculated average size {avg}')
-
-        scale_factors = []
-        for item in items:
-            rect = self.itemsBoundingRect(items=[item])
-            scale_factors.append(math.sqrt(avg / rect.width() / rect.height()))
-        self.undo_stack.push(
-            commands.NormalizeItems(items, scale_factors))
+        return self.normalize_width_or_height('size')
 
     def arrange(self, vertical=False):
         """Arrange items in a line (horizontally or vertically)."""
@@ -162,73 +235,77 @@ class BeeGraphicsScene(QtWidgets.QGraphicsScene):
         if len(items) < 2:
             return
 
-        center = self.get_selection_center()
+        geometry = GeometrySnapshot(items)
+        center = geometry.center()
+        order = geometry.order(vertical)
         positions = []
-        rects = []
-        for item in items:
-            rects.append({
-                'rect': self.itemsBoundingRect(items=[item]),
-                'item': item})
 
         if vertical:
-            rects.sort(key=lambda r: r['rect'].topLeft().y())
-            sum_height = sum(map(lambda r: r['rect'].height(), rects))
-            y = round(center.y() - sum_height/2)
-            for rect in rects:
-                positions.append(
-                    QtCore.QPointF(
-                        round(center.x() - rect['rect'].width()/2), y))
-                y += rect['rect'].height()
-
+            y = round(center.y() - sum(geometry.height) / 2)
+            for i in order:
+                positions.append(QtCore.QPointF(
+                    round(center.x() - geometry.width[i] / 2), y))
+                y += geometry.height[i]
         else:
-            rects.sort(key=lambda r: r['rect'].topLeft().x())
-            sum_width = sum(map(lambda r: r['rect'].width(), rects))
-            x = round(center.x() - sum_width/2)
-            for rect in rects:
-                positions.append(
-                    QtCore.QPointF(
-                        x, round(center.y() - rect['rect'].height()/2)))
-                x += rect['rect'].width()
+            x = round(center.x() - sum(geometry.width) / 2)
+            for i in order:
+                positions.append(QtCore.QPointF(
+                    x, round(center.y() - geometry.height[i] / 2)))
+                x += geometry.width[i]
 
         self.undo_stack.push(
             commands.ArrangeItems(self,
-                                  [r['item'] for r in rects],
+                                  [items[i] for i in order],
                                   positions))
 
-    def arrange_optimal(self):
+    def create_packing_job(self, algorithm=packing.DEFAULT_ALGORITHM,
+                           time_budget=packing.DEFAULT_TIME_BUDGET):
+        """Prepare arranging the selected items as compactly as possible.
+
+        The returned job can be run in another thread; the result then
+        needs to be applied with ``apply_packing_job``.
+
+        :returns: A ``PackingJob``, or None if there is nothing to arrange
+        """
+
         self.cancel_crop_mode()
 
         items = self.selectedItems(user_only=True)
         if len(items) < 2:
-            return
+            return None
 
-        sizes = []
-        for item in items:
-            rect = self.itemsBoundingRect(items=[item])
-            sizes.append((round(rect.width()), round(rect.height())))
+        geometry = GeometrySnapshot(items)
+        sizes = [(round(w), round(h))
+                 for w, h in zip(geometry.width, geometry.height)]
+        return packing.PackingJob(items, sizes, geometry.center(),
+                                  algorithm=algorithm,
+                                  time_budget=time_budget)
 
-        center = self.get_selection_center()
+    def apply_packing_job(self, job):
+        """Move the items of a finished packing job into place."""
 
-        # The minimal area the items need if they could be packed optimally;
-        # we use this as a starting shape for the packing algorithm
-        min_area = sum(map(lambda s: s[0] * s[1], sizes))
-        width = math.ceil(math.sqrt(min_area))
-
-        positions = None
-        while not positions:
-            try:
-                positions = rpack.pack(
-                    sizes, max_width=width, max_height=width)
-            except rpack.PackingImpossibleError:
-                width = math.ceil(width * 1.2)
+        layout = job.layout
+        if layout is None:
+            logger.debug('Packing job has no result, not arranging')
+            return
 
         # We want the items to center around the selection's center,
         # not (0, 0)
-        bounds = rpack.bbox_size(sizes, positions)
-        diff = center - QtCore.QPointF(bounds[0]/2, bounds[1]/2)
-        positions = [QtCore.QPointF(*pos) + diff for pos in positions]
+        diff = job.center - QtCore.QPointF(layout.width/2, layout.height/2)
+        positions = [QtCore.QPointF(*pos) + diff
+                     for pos in layout.positions]
+        self.undo_stack.push(
+            commands.ArrangeItems(self, job.items, positions))
+
+    def arrange_optimal(self, algorithm=packing.DEFAULT_ALGORITHM,
+                        time_budget=packing.DEFAULT_TIME_BUDGET):
+        """Arrange the selected items as compactly as possible. Blocks
+        until the time budget (in seconds) is used up at most."""
 
-        self.undo_stack.push(commands.ArrangeItems(self, items, positions))
+        job = self.create_packing_job(algorithm, time_budget)
+        if job:
+            job.run()
+            self.apply_packing_job(job)
 
     def flip_items(self, vertical=False):
         """Flip selected items."""
@@ -257,24 +334,24 @@ class BeeGraphicsScene(QtWidgets.QGraphicsScene):
     def has_selection(self):
         """Checks whether there are currently items selected."""
 
-        return bool(self.selectedItems(user_only=True))
+        return bool(self._selected_user_items)
 
     def has_single_selection(self):
         """Checks whether there's currently exactly one item selected."""
 
-        return len(self.selectedItems(user_only=True)) == 1
+        return len(self._selected_user_items) == 1
 
     def has_multi_selection(self):
         """Checks whether there are currently more than one items selected."""
 
-        return len(self.selectedItems(user_only=True)) > 1
+        return len(self._selected_user_items) > 1
 
     def has_croppable_selection(self):
         """Checks whether the current selection is croppable, i.e. a
         single selection whose item is croppable."""
 
         if self.has_single_selection():
-            return self.selectedItems(user_only=True)[0].is_croppable
+            return next(iter(self._selected_user_items)).is_croppable
         return False
 
     def mousePressEvent(self, event):
@@ -330,12 +407,18 @@ class BeeGraphicsScene(QtWidgets.QGraphicsScene):
                 self.addItem(self.rubberband_item)
                 self.rubberband_item.bring_to_front()
             self.rubberband_item.fit(self.event_start, event.scenePos())
-            self.setSelectionArea(self.rubberband_item.shape())
+            if self.rubberband_timer.isActive():
+                self.rubberband_pending = True
+            else:
+                self.update_rubberband_selection()
             self.views()[0].reset_previous_transform()
         super().mouseMoveEvent(event)
 
     def mouseReleaseEvent(self, event):
         if self.rubberband_active:
+            if self.rubberband_pending:
+                self.update_rubberband_selection()
+            self.rubberband_timer.stop()
             if self.rubberband_item.scene():
                 logger.debug('Ending rubberband selection')
                 self.removeItem(self.rubberband_item)
@@ -353,80 +436,154 @@ class BeeGraphicsScene(QtWidgets.QGraphicsScene):
         self.move_active = False
         super().mouseReleaseEvent(event)
 
+    def update_rubberband_selection(self):
+        """Select the items within the rubberband.
+
+        Changing the selection is expensive with many items, and mouse
+        move events can come in much more often than we can draw, so
+        further updates are held back until ``rubberband_timer`` runs
+        out.
+        """
+
+        self.rubberband_pending = False
+        self.setSelectionArea(self.rubberband_item.shape())
+        self.rubberband_timer.start()
+
+    def on_rubberband_timer(self):
+        if self.rubberband_pending and self.rubberband_active:
+            self.update_rubberband_selection()
+
     def selectedItems(self, user_only=False):
         """If ``user_only`` is set to ``True``, only return items added
         by the user (i.e. no multi select outlines and other UI items).
 
-        User items are items that have a ``save_id`` attribute.
+        User items are kept track of as they get added and selected, so
+        this doesn't need to go through all items in the scene.
         """
 
-        items = super().selectedItems()
         if user_only:
-            return list(filter(lambda i: hasattr(i, 'save_id'), items))
-        return items
+            return list(self._selected_user_items)
+        return super().selectedItems()
 
     def items_for_save(self):
 
-        """Returns the items that are to be saved.
-
-        Items to be saved are items that have a save_id attribute.
+        """Returns the items that are to be saved, i.e. the user items,
+        in stacking order from bottom to top.
         """
 
-        return filter(lambda i: hasattr(i, 'save_id'),
-                      self.items(order=Qt.SortOrder.AscendingOrder))
+        # Stable sort, so items with the same z value stay in the
+        # order they have been added, same as Qt's stacking order:
+        return iter(sorted(self._user_items, key=lambda i: i.zValue()))
 
     def clear_save_ids(self):
-        for item in self.items_for_save():
+        for item in self._user_items:
             item.save_id = None
 
+    def detach_items_from_file(self):
+        """Load all data that items still read lazily from the bee file."""
+
+        for item in self._user_items:
+            if hasattr(item, 'detach_from_file'):
+                item.detach_from_file()
+
     def on_view_scale_change(self):
         for item in self.selectedItems():
             item.on_view_scale_change()
 
+    def pixmap_bytes(self):
+        """The memory taken up by the full resolution pixmaps of the
+        items in the scene. Pixmaps shared by several items are only
+        counted once."""
+
+        pixmaps = {}
+        for item in self._user_items:
+            if hasattr(item, 'pixmap_bytes'):
+                pixmaps[item.pixmap_key or id(item)] = item.pixmap_bytes()
+        return sum(pixmaps.values())
+
+    def enforce_memory_budget(self, budget, visible_rect):
+        """Unload the pixmaps of items far outside the visible area,
+        farthest away first, until the pixmaps in the scene take up no
+        more than ``budget`` bytes.
+
+        Items closer to the visible area than its own width/height are
+        kept, so that panning around doesn't reload them right away.
+
+        :returns: The number of unloaded pixmaps
+        """
+
+        resident = self.pixmap_bytes()
+        if resident <= budget:
+            return 0
+
+        keep_rect = visible_rect.adjusted(
+            -visible_rect.width(), -visible_rect.height(),
+            visible_rect.width(), visible_rect.height())
+        center = visible_rect.center()
+        candidates = []
+        for item in self._user_items:
+            if hasattr(item, 'unload_pixmap') and item.pixmap_bytes():
+                rect = item.sceneBoundingRect()
+                if not rect.intersects(keep_rect):
+                    dist = rect.center() - center
+                    candidates.append(
+                        (dist.x()**2 + dist.y()**2, item))
+        candidates.sort(key=lambda c: c[0], reverse=True)
+
+        unloaded = 0
+        for dist, item in candidates:
+            if resident <= budget:
+                break
+            nbytes = item.pixmap_bytes()
+            key = item.pixmap_key
+            if item.unload_pixmap():
+                unloaded += 1
+                # Shared pixmaps are only freed with their last user:
+                if key is None or pixmap_store.refcount(key) == 0:
+                    resident -= nbytes
+                    # Make sure the memory actually gets freed instead
+                    # of the pixmap staying around for reuse:
+                    pixmap_store.discard(key)
+        logger.debug(f'Unloaded {unloaded} pixmaps, '
+                     f'{resident} bytes still resident')
+        return unloaded
+
+    @profiled('itemsBoundingRect')
     def itemsBoundingRect(self, selection_only=False, items=None):
         """Returns the bounding rect of the scene's items; either all of them
         or only selected ones, or the items givin in ``items``.
 
         Re-implemented to not include the items's selection handles.
-        """
 
-        def filter_user_items(ilist):
-            return list(filter(lambda i: hasattr(i, 'save_id'), ilist))
+        The bounding rect of all items is needed on every zoom step, so
+        it gets cached until an item is added, removed or transformed.
+        """
 
         if selection_only:
-            base = filter_user_items(self.selectedItems())
+            return self._bounding_rect(self._selected_user_items)
         elif items:
-            base = items
-        else:
-            base = filter_user_items(self.items())
-
-        if not base:
-            return QtCore.QRectF(0, 0, 0, 0)
+            return self._bounding_rect(items)
 
-        x = []
-        y = []
+        if self._items_rect is None:
+            self._items_rect = self._bounding_rect(self._user_items)
+        return QtCore.QRectF(self._items_rect)
 
-        for item in base:
-            for corner in item.corners_scene_coords:
-                x.append(corner.x())
-                y.append(corner.y())
-
-        return QtCore.QRectF(
-            QtCore.QPointF(min(x), min(y)),
-            QtCore.QPointF(max(x), max(y)))
+    def _bounding_rect(self, items):
+        return GeometrySnapshot(items).bounds()
 
     def get_selection_center(self):
         rect = self.itemsBoundingRect(selection_only=True)
         return (rect.topLeft() + rect.bottomRight()) / 2
 
     def on_selection_change(self):
-        if self.has_multi_selection():
+        multi = self.has_multi_selection()
+        if multi:
             self.multi_select_item.fit_selection_area(
                 self.itemsBoundingRect(selection_only=True))
-        if self.has_multi_selection() and not self.multi_select_item.scene():
+        if multi and not self.multi_select_item.scene():
             self.addItem(self.multi_select_item)
             self.multi_select_item.bring_to_front()
-        if not self.has_multi_selection() and self.multi_select_item.scene():
+        if not multi and self.multi_select_item.scene():
             self.removeItem(self.multi_select_item)
 
     def on_change(self, region):
@@ -439,16 +596,34 @@ class BeeGraphicsScene(QtWidgets.QGraphicsScene):
     def add_item_later(self, itemdata, selected=False):
         """Keep an item for adding later via ``add_queued_items``
 
+        When called from a loading thread, this blocks while the queue
+        is full until the main thread has caught up.
+
         :param dict itemdata: Defines the item's data
         :param bool selected: Whether the item is initialised as selected
         """
 
+        if (self.items_to_add.full()
+                and QtCore.QThread.currentThread() == self.thread()):
+            # Nobody else is going to empty the queue for us
+            self.add_queued_items()
         self.items_to_add.put((itemdata, selected))
 
-    def add_queued_items(self):
-        """Adds items added via ``add_items_later``"""
+    def add_queued_items(self, time_budget=None):
+        """Adds items added via ``add_items_later``
 
+        :param time_budget: If given, stop adding items after this
+            many milliseconds and add the remaining ones in a later
+            event loop iteration.
+        """
+
+        timer = QtCore.QElapsedTimer()
+        timer.start()
         while not self.items_to_add.empty():
+            if time_budget is not None and timer.elapsed() >= time_budget:
+                logger.trace('Time budget for adding items exceeded')
+                self.add_items_timer.start(0)
+                return
             data, selected = self.items_to_add.get()
             typ = data.pop('type')
             cls = item_registry.get(typ)
@@ -462,6 +637,14 @@ class BeeGraphicsScene(QtWidgets.QGraphicsScene):
             self.addItem(item)
             # Force recalculation of min/max z values:
             item.setZValue(item.zValue())
+            # Items read from a file don't need to be written back
+            # until they get changed:
+            item.dirty = False
             if selected:
                 item.setSelected(True)
                 item.bring_to_front()
+
+    def add_queued_items_batch(self):
+        """Adds queued items within the time budget of one frame."""
+
+        self.add_queued_items(time_budget=self.ADD_ITEMS_TIME_BUDGET)
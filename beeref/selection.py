@@ -98,6 +98,31 @@ class BaseItemMixin:
         if vertical:
             self.setRotation(self.rotation() + 180)
 
+    def transform_state(self):
+        """Returns position, scale, rotation and flip as a tuple."""
+
+        pos = self.pos()
+        return (pos.x(), pos.y(), self.scale(), self.rotation(), self.flip())
+
+    def set_transform_state(self, x, y, scale, rotation, flip):
+        """Sets position, scale, rotation and flip as returned by
+        ``transform_state``.
+
+        Unlike the individual setters, this doesn't keep an anchor
+        point fixed, and only sets values that actually change.
+        """
+
+        if scale != self.scale():
+            self.prepareGeometryChange()
+            super().setScale(scale)
+        if rotation != self.rotation():
+            super().setRotation(rotation)
+        if flip != self.flip():
+            self.setTransform(QtGui.QTransform.fromScale(flip, 1))
+        pos = self.pos()
+        if x != pos.x() or y != pos.y():
+            super().setPos(x, y)
+
     def bounding_rect_unselected(self):
         return super().boundingRect()
 
@@ -0,0 +1,106 @@
+# This file is part of BeeRef.
+#
+# BeeRef is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BeeRef is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BeeRef.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Temporary file storage for image data that isn't needed right now.
+
+Used for images of items that only live on in the undo history (e.g.
+deleted items), so that they don't need to be kept in memory.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class SpillStore:
+    """Refcounted image data in temporary files, keyed by content hash.
+
+    Every ``put`` needs to be balanced by a ``release``. Files get
+    deleted once they aren't referenced anymore; the whole directory
+    gets removed when the application exits.
+    """
+
+    def __init__(self):
+        self._tmpdir = None
+        self._refs = {}
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._refs)
+
+    def __contains__(self, key):
+        return key in self._refs
+
+    @property
+    def disk_bytes(self):
+        """The disk space taken up by all stored files."""
+
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def path(self, key):
+        if self._tmpdir is None:
+            self._tmpdir = tempfile.TemporaryDirectory(prefix='beeref-')
+        return os.path.join(self._tmpdir.name, key)
+
+    def put(self, data):
+        """Store the given image data.
+
+        :returns: The key under which the data has been stored
+        """
+
+        key = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            if key not in self._refs:
+                logger.debug(f'Spilling {len(data)} bytes to {key}')
+                with open(self.path(key), 'wb') as f:
+                    f.write(data)
+                self._refs[key] = 0
+                self._sizes[key] = len(data)
+            self._refs[key] += 1
+        return key
+
+    def get(self, key):
+        """Read the data stored under the given key."""
+
+        with open(self.path(key), 'rb') as f:
+            return f.read()
+
+    def release(self, key):
+        """Decrease the refcount of the given key and remove its file
+        when it isn't referenced anymore."""
+
+        with self._lock:
+            if not self._refs.get(key):
+                logger.warning(f'Releasing unreferenced spill file {key}')
+                return
+            self._refs[key] -= 1
+            if self._refs[key] == 0:
+                logger.debug(f'Removing spill file {key}')
+                del self._refs[key]
+                del self._sizes[key]
+                try:
+                    os.remove(self.path(key))
+                except OSError as e:
+                    logger.warning(f'Could not remove spill file: {e}')
+
+
+spill_store = SpillStore()
@@ -29,7 +29,11 @@ from beeref import fileio
 from beeref import widgets
 from beeref.items import BeePixmapItem, BeeTextItem
 from beeref.main_controls import MainControlsMixin
+from beeref import packing
+from beeref.pixmapstore import pixmap_store
+from beeref.profiler import profiled, profiler
 from beeref.scene import BeeGraphicsScene
+from beeref.spillstore import spill_store
 
 
 commandline_args = CommandlineArgs()
@@ -40,6 +44,31 @@ class BeeGraphicsView(MainControlsMixin,
                       QtWidgets.QGraphicsView,
                       ActionsMixin):
 
+    # Default for how much memory the full resolution pixmaps of the
+    # scene may take up before pixmaps outside the visible area get
+    # unloaded (MB):
+    PIXMAP_BUDGET = 2048
+    # Default for how much memory deleted images may take up in the
+    # undo history before they get moved to temporary files (MB):
+    UNDO_BUDGET = 512
+    # Default for how long to search for the most compact layout when
+    # arranging items (ms):
+    ARRANGE_TIME_BUDGET = 1000
+    # Default for the longer side of large images on import when they
+    # get scaled down (px):
+    IMPORT_MAX_SIZE = 4096
+    # How long to wait after painting before checking the budget (ms):
+    MEMORY_CHECK_DELAY = 1000
+    # Events that count as input for measuring input latency when
+    # profiling:
+    INPUT_EVENTS = (
+        QtCore.QEvent.Type.MouseButtonPress,
+        QtCore.QEvent.Type.MouseButtonRelease,
+        QtCore.QEvent.Type.MouseMove,
+        QtCore.QEvent.Type.Wheel,
+        QtCore.QEvent.Type.KeyPress,
+    )
+
     def __init__(self, app, parent=None):
         super().__init__(parent)
         self.app = app
@@ -51,8 +80,9 @@ class BeeGraphicsView(MainControlsMixin,
             QtGui.QBrush(QtGui.QColor(*constants.COLORS['Scene:Canvas'])))
         self.setFrameShape(QtWidgets.QFrame.Shape.NoFrame)
 
-        self.undo_stack = QtGui.QUndoStack(self)
+        self.undo_stack = commands.BeeUndoStack(self)
         self.undo_stack.setUndoLimit(100)
+        self.undo_stack.indexChanged.connect(self.enforce_undo_budget)
         self.undo_stack.canRedoChanged.connect(self.on_can_redo_changed)
         self.undo_stack.canUndoChanged.connect(self.on_can_undo_changed)
         self.undo_stack.cleanChanged.connect(self.on_undo_clean_changed)
@@ -63,6 +93,13 @@ class BeeGraphicsView(MainControlsMixin,
         self.zoom_active = False
         self.movewin_active = False
 
+        # Check the memory budget once things have calmed down after
+        # painting:
+        self.memory_timer = QtCore.QTimer(self)
+        self.memory_timer.setSingleShot(True)
+        self.memory_timer.setInterval(self.MEMORY_CHECK_DELAY)
+        self.memory_timer.timeout.connect(self.enforce_memory_budget)
+
         self.scene = BeeGraphicsScene(self.undo_stack)
         self.scene.changed.connect(self.on_scene_changed)
         self.scene.selectionChanged.connect(self.on_selection_changed)
@@ -73,6 +110,10 @@ class BeeGraphicsView(MainControlsMixin,
         self.control_target = self
         self.init_main_controls()
 
+        if commandline_args.profile or commandline_args.profile_trace:
+            profiler.enabled = True
+            self.profiler_overlay = widgets.ProfilerOverlay(self)
+
         # Load file given via command line
         if commandline_args.filename:
             self.open_from_file(commandline_args.filename)
@@ -264,8 +305,38 @@ class BeeGraphicsView(MainControlsMixin,
     def on_action_arrange_vertical(self):
         self.scene.arrange(vertical=True)
 
+    def get_arrange_options(self):
+        """The packing algorithm and time budget (in seconds) for
+        arranging items optimally."""
+
+        algorithm = self.settings.value(
+            'Arrange/algorithm', packing.DEFAULT_ALGORITHM)
+        if algorithm not in packing.ALGORITHMS:
+            logger.warning(f'Unknown packing algorithm: {algorithm}')
+            algorithm = packing.DEFAULT_ALGORITHM
+        time_budget = self.settings.value(
+            'Arrange/time_budget', self.ARRANGE_TIME_BUDGET, type=int)
+        return {'algorithm': algorithm, 'time_budget': time_budget / 1000}
+
     def on_action_arrange_optimal(self):
-        self.scene.arrange_optimal()
+        job = self.scene.create_packing_job(**self.get_arrange_options())
+        if job is None:
+            return
+        self.worker = packing.ThreadedPacking(job)
+        self.worker.improved.connect(self.on_arrange_optimal_improved)
+        self.worker.finished.connect(self.on_arrange_optimal_finished)
+        self.progress = widgets.BeeProgressDialog(
+            'Arranging images',
+            worker=self.worker,
+            parent=self)
+        self.worker.start()
+
+    def on_arrange_optimal_improved(self, layout):
+        self.progress.setLabelText(
+            f'Arranging images ({layout.density:.0%} filled)')
+
+    def on_arrange_optimal_finished(self, filename, errors):
+        self.scene.apply_packing_job(self.worker.job)
 
     def on_action_crop(self):
         self.scene.crop_items()
@@ -303,7 +374,7 @@ class BeeGraphicsView(MainControlsMixin,
 
     def on_items_loaded(self, value):
         logger.debug('On items loaded: add queued items')
-        self.scene.add_queued_items()
+        self.scene.add_queued_items_batch()
 
     def on_loading_finished(self, filename, errors):
         if errors:
@@ -320,8 +391,9 @@ class BeeGraphicsView(MainControlsMixin,
     def open_from_file(self, filename):
         logger.info(f'Opening file {filename}')
         self.clear_scene()
+        lazy = self.settings.value('FileIO/lazy_loading', True, type=bool)
         self.worker = fileio.ThreadedIO(
-            fileio.load_bee, filename, self.scene)
+            fileio.load_bee, filename, self.scene, lazy=lazy)
         self.worker.progress.connect(self.on_items_loaded)
         self.worker.finished.connect(self.on_loading_finished)
         self.progress = widgets.BeeProgressDialog(
@@ -356,7 +428,9 @@ class BeeGraphicsView(MainControlsMixin,
         if not filename.endswith('.bee'):
             filename = f'{filename}.bee'
         self.worker = fileio.ThreadedIO(
-            fileio.save_bee, filename, self.scene, create_new=create_new)
+            fileio.save_bee, filename, self.scene, create_new=create_new,
+            journal_mode=self.settings.value('FileIO/journal_mode'),
+            synchronous=self.settings.value('FileIO/synchronous'))
         self.worker.finished.connect(self.on_saving_finished)
         self.progress = widgets.BeeProgressDialog(
             'Saving %s' % filename,
@@ -400,6 +474,51 @@ class BeeGraphicsView(MainControlsMixin,
     def on_action_debuglog(self):
         widgets.DebugLogDialog(self)
 
+    def on_action_memory_usage(self):
+        items = [item for item in self.scene.user_items()
+                 if hasattr(item, 'pixmap_bytes')]
+        loaded = [item for item in items if item.pixmap_bytes()]
+        mb = 1024 * 1024
+        QtWidgets.QMessageBox.information(
+            self,
+            'Memory Usage',
+            (f'<p>Images in memory: {len(loaded)} of {len(items)}</p>'
+             f'<p>Resident: {self.scene.pixmap_bytes() / mb:.1f} MB '
+             f'(budget: {self.get_pixmap_budget()} MB)</p>'
+             f'<p>Pixmap cache: {pixmap_store.resident_bytes / mb:.1f} MB, '
+             f'of which unused: {pixmap_store.unused_bytes / mb:.1f} MB</p>'
+             '<p>Undo history: '
+             f'{self.undo_stack.retained_bytes() / mb:.1f} MB '
+             f'(budget: {self.get_undo_budget()} MB), '
+             f'on disk: {spill_store.disk_bytes / mb:.1f} MB</p>'))
+
+    def get_pixmap_budget(self):
+        """The memory budget for full resolution pixmaps in MB. 0 means
+        no limit."""
+
+        return self.settings.value(
+            'Memory/pixmap_budget', self.PIXMAP_BUDGET, type=int)
+
+    def enforce_memory_budget(self):
+        budget = self.get_pixmap_budget()
+        if budget <= 0:
+            return
+        rect = self.mapToScene(self.viewport().rect()).boundingRect()
+        self.scene.enforce_memory_budget(budget * 1024 * 1024, rect)
+
+    def get_undo_budget(self):
+        """The memory budget for images kept alive by the undo history
+        in MB. 0 means no limit."""
+
+        return self.settings.value(
+            'Memory/undo_budget', self.UNDO_BUDGET, type=int)
+
+    def enforce_undo_budget(self):
+        budget = self.get_undo_budget()
+        if budget <= 0:
+            return
+        self.undo_stack.enforce_memory_budget(budget * 1024 * 1024)
+
     def on_insert_images_finished(self, new_scene, filename, errors):
         """Callback for when loading of images is finished.
 
@@ -421,27 +540,48 @@ class BeeGraphicsView(MainControlsMixin,
                 'Problem loading images',
                 msg + errornames)
         self.scene.add_queued_items()
-        self.scene.arrange_optimal()
+        self.scene.arrange_optimal(**self.get_arrange_options())
         self.undo_stack.endMacro()
         if new_scene:
             self.on_action_fit_scene()
 
+    def get_import_options(self):
+        """What to do with large images on import and the size they get
+        scaled down to (see ``fileio.load_images``)."""
+
+        policy = self.settings.value('Import/policy', fileio.IMPORT_ORIGINAL)
+        if policy not in fileio.IMPORT_POLICIES:
+            logger.warning(f'Unknown import policy: {policy}')
+            policy = fileio.IMPORT_ORIGINAL
+        max_size = self.settings.value(
+            'Import/max_size', self.IMPORT_MAX_SIZE, type=int)
+        return {'policy': policy, 'max_size': max_size}
+
     def do_insert_images(self, filenames, pos=None):
         if not pos:
             pos = self.get_view_center()
         self.scene.clearSelection()
         self.undo_stack.beginMacro('Insert Images')
+        options = self.get_import_options()
         self.worker = fileio.ThreadedIO(
             fileio.load_images,
             filenames,
             self.mapToScene(pos),
-            self.scene)
+            self.scene,
+            **options)
         self.worker.progress.connect(self.on_items_loaded)
         self.worker.finished.connect(
             partial(self.on_insert_images_finished,
                     not self.scene.items()))
+        label = 'Loading images'
+        if options['policy'] == fileio.IMPORT_CAP:
+            label += (' (larger images are scaled down to '
+                      f'{options["max_size"]} px)')
+        elif options['policy'] == fileio.IMPORT_PROXY:
+            label += (' (larger images are shown scaled down to '
+                      f'{options["max_size"]} px until zoomed in)')
         self.progress = widgets.BeeProgressDialog(
-            'Loading images',
+            label,
             worker=self.worker,
             parent=self)
         self.worker.start()
@@ -523,8 +663,9 @@ class BeeGraphicsView(MainControlsMixin,
                                      self.scene.has_selection())
         self.actiongroup_set_enabled('active_when_croppable',
                                      self.scene.has_croppable_selection())
-        self.viewport().repaint()
+        self.viewport().update()
 
+    @profiled('recalc_scene_rect')
     def recalc_scene_rect(self):
         """Resize the scene rectangle so that it is always one view width
         wider than all items' bounding box at each side and one view
@@ -697,6 +838,27 @@ class BeeGraphicsView(MainControlsMixin,
 
         super().mouseReleaseEvent(event)
 
+    def viewportEvent(self, event):
+        if profiler.enabled and event.type() in self.INPUT_EVENTS:
+            profiler.mark_input()
+        return super().viewportEvent(event)
+
+    def paintEvent(self, event):
+        with profiler.measure('paint'):
+            # Items whose pixmaps haven't been loaded yet need to load
+            # them now that they become visible, unless they are zoomed
+            # out far enough to be painted from a mipmap:
+            items = self.items(
+                event.rect(), Qt.ItemSelectionMode.IntersectsItemBoundingRect)
+            for item in items:
+                if (hasattr(item, 'load_deferred_pixmap')
+                        and item.mipmap_level(
+                            self.get_scale() * item.scale()) == 0):
+                    item.load_deferred_pixmap()
+            super().paintEvent(event)
+        profiler.end_frame(items_painted=len(items))
+        self.memory_timer.start()
+
     def resizeEvent(self, event):
         super().resizeEvent(event)
         self.recalc_scene_rect()
@@ -22,6 +22,7 @@ from PyQt6.QtCore import Qt
 from beeref import constants
 from beeref.config import logfile_name, BeeSettings
 from beeref.main_controls import MainControlsMixin
+from beeref.profiler import profiler
 
 
 logger = logging.getLogger(__name__)
@@ -123,6 +124,47 @@ class WelcomeOverlay(MainControlsMixin, QtWidgets.QWidget):
         super().show()
 
 
+class ProfilerOverlay(QtWidgets.QLabel):
+    """Shows the profiler's timings of the last painted frame."""
+
+    # How often to refresh the displayed values (ms):
+    UPDATE_INTERVAL = 250
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.setAttribute(Qt.WidgetAttribute.WA_TransparentForMouseEvents)
+        self.setStyleSheet('background-color: rgba(0, 0, 0, 160);'
+                           'color: white;'
+                           'font-family: monospace;'
+                           'padding: 4px;')
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(self.UPDATE_INTERVAL)
+        self.timer.timeout.connect(self.update_text)
+        self.timer.start()
+        self.update_text()
+        self.show()
+
+    @staticmethod
+    def format_time(frame, key):
+        if key in frame:
+            return f'{frame[key] / 1000:.2f} ms'
+        return '-'
+
+    def update_text(self):
+        frame = profiler.last_frame
+        lines = [
+            f'Paint: {self.format_time(frame, "paint")}',
+            f'Items painted: {frame.get("items_painted", "-")}',
+            ('itemsBoundingRect: '
+             f'{self.format_time(frame, "itemsBoundingRect")}'),
+            ('recalc_scene_rect: '
+             f'{self.format_time(frame, "recalc_scene_rect")}'),
+            f'Input latency: {self.format_time(frame, "input_latency")}',
+        ]
+        self.setText('\n'.join(lines))
+        self.adjustSize()
+
+
 class BeeProgressDialog(QtWidgets.QProgressDialog):
 
     def __init__(self, label, worker, maximum=0, parent=None):
@@ -0,0 +1,141 @@
+# This file is part of BeeRef.
+#
+# BeeRef is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BeeRef is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BeeRef.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Benchmark comparing the packing algorithms for arranging items.
+
+Packs random rectangles with each algorithm, once into a single strip
+and once with the full search ``arrange_optimal`` does, and reports
+time taken and packing density. Run from the repository root with::
+
+  python -m benchmarks.bench_packing --sizes 100 1000 --output result.json
+
+Times are in seconds. ``side`` is the side of the smallest square the
+layout fits into, ``density`` the share of the layout's bounding box
+covered by rectangles.
+"""
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+from beeref import packing
+from beeref.constants import VERSION
+
+
+def random_sizes(count, seed):
+    """Sizes like those of images on a board after normalizing: varying
+    aspect ratios, but similar areas."""
+
+    rnd = random.Random(seed)
+    sizes = []
+    for i in range(count):
+        ratio = rnd.uniform(0.5, 2)
+        sizes.append((round(200 * ratio ** 0.5), round(200 / ratio ** 0.5)))
+    return sizes
+
+
+def describe(layout, seconds):
+    return {
+        'time': seconds,
+        'width': layout.width,
+        'height': layout.height,
+        'side': max(layout.width, layout.height),
+        'density': layout.density,
+    }
+
+
+def bench_single(sizes, algorithm):
+    """Pack once into a strip as wide as the smallest square."""
+
+    job = packing.PackingJob(None, sizes, None)
+    width = job.widths()[0]
+    start = time.perf_counter()
+    positions = packing.ALGORITHMS[algorithm](sizes, width)
+    seconds = time.perf_counter() - start
+    if positions is None:
+        return {'time': seconds}
+    return describe(packing.Layout(sizes, positions, algorithm), seconds)
+
+
+def bench_search(sizes, algorithm, time_budget):
+    """Search for the best layout like ``arrange_optimal`` does."""
+
+    job = packing.PackingJob(None, sizes, None, algorithm=algorithm,
+                             time_budget=time_budget)
+    tried = []
+    start = time.perf_counter()
+    layout = job.run(on_progress=tried.append)
+    result = describe(layout, time.perf_counter() - start)
+    result['tried'] = tried[-1]
+    result['candidates'] = job.num_candidates()
+    result['winner'] = layout.algorithm
+    return result
+
+
+def run(sizes, algorithms, time_budget, seed):
+    results = []
+    for size in sizes:
+        rects = random_sizes(size, seed)
+        result = {'items': size}
+        for algorithm in algorithms:
+            print(f'{size} items: {algorithm}', file=sys.stderr)
+            result[algorithm] = {
+                'single': bench_single(rects, algorithm),
+                'search': bench_search(rects, algorithm, time_budget),
+            }
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 1000, 10000])
+    parser.add_argument('--algorithms', nargs='+',
+                        choices=packing.ALGORITHMS,
+                        default=['shelf', 'skyline', 'maxrects'],
+                        help='which algorithms to compare (default: all '
+                        'except rpack, which can take minutes for large '
+                        'sizes)')
+    parser.add_argument('--time-budget', type=float,
+                        default=packing.DEFAULT_TIME_BUDGET,
+                        help='time budget for the search in seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output',
+                        help='write results to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = {
+        'version': VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time_budget': args.time_budget,
+        'results': run(args.sizes, args.algorithms, args.time_budget,
+                       args.seed),
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# This file is part of BeeRef.
+#
+# BeeRef is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BeeRef is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BeeRef.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Benchmark for saving bee files.
+
+Measures saves per second for boards of different sizes, both for
+saving to a new file and for re-saving a file after every item has been
+changed. Run from the repository root with::
+
+  python -m benchmarks.bench_save
+"""
+
+import argparse
+import os.path
+import tempfile
+import time
+
+from benchmarks import utils
+from beeref.fileio.sql import SQLiteIO
+
+
+def bench_save(scene, filename, repeat, **kwargs):
+    """Returns saves per second for new files and updated files."""
+
+    start = time.perf_counter()
+    for i in range(repeat):
+        SQLiteIO(filename, scene, create_new=True, **kwargs).write()
+    new = repeat / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(repeat):
+        for item in scene.items_for_save():
+            item.setPos(item.pos().x() + 1, item.pos().y())
+        SQLiteIO(filename, scene, **kwargs).write()
+    update = repeat / (time.perf_counter() - start)
+    return new, update
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--journal-mode', default=None)
+    parser.add_argument('--synchronous', default=None)
+    args = parser.parse_args()
+
+    kwargs = {}
+    if args.journal_mode:
+        kwargs['journal_mode'] = args.journal_mode
+    if args.synchronous:
+        kwargs['synchronous'] = args.synchronous
+
+    utils.init_app()
+    print(f'{"items":>8} {"new saves/s":>12} {"updates/s":>12}')
+    for size in args.sizes:
+        scene = utils.create_scene(text_items=size)
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = os.path.join(dirname, 'bench.bee')
+            new, update = bench_save(scene, filename, args.repeat, **kwargs)
+        print(f'{size:>8} {new:>12.2f} {update:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+# This file is part of BeeRef.
+#
+# BeeRef is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BeeRef is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BeeRef.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Benchmarks for common operations on scenes of different sizes.
+
+Builds synthetic boards with pixmap and text items, displays them
+headless and times loading, saving, arranging, normalizing, rubberband
+selection, undo/redo and zooming/panning. Results are written as JSON
+so that they can be compared across versions. Run from the repository
+root with::
+
+  python -m benchmarks.bench_scene --sizes 100 1000 --output result.json
+
+All times are in seconds. Each benchmark is run ``--repeat`` times;
+the minimum and the mean are reported.
+"""
+
+import argparse
+import json
+import os.path
+import platform
+import sys
+import tempfile
+import time
+
+from PyQt6 import QtCore
+
+from benchmarks import utils
+from beeref import commands
+from beeref.constants import VERSION
+from beeref.fileio.sql import SQLiteIO
+
+
+def timed(func, repeat, setup=None):
+    """Run ``func`` ``repeat`` times and return the minimum and mean
+    time taken. ``setup`` is called before each run without being
+    timed."""
+
+    times = []
+    for i in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'mean': sum(times) / len(times)}
+
+
+def select_all(view):
+    view.scene.set_selected_all_items(True)
+
+
+def deselect_all(view):
+    view.scene.set_selected_all_items(False)
+
+
+def bench_save(view, repeat, tmpdir):
+    filename = os.path.join(tmpdir, 'bench.bee')
+
+    def save():
+        SQLiteIO(filename, view.scene, create_new=True).write()
+
+    return timed(save, repeat)
+
+
+def bench_load(view, repeat, tmpdir):
+    filename = os.path.join(tmpdir, 'bench.bee')
+    SQLiteIO(filename, view.scene, create_new=True).write()
+    scene = utils.create_scene()
+
+    def load():
+        SQLiteIO(filename, scene, readonly=True).read()
+        scene.add_queued_items()
+
+    return timed(load, repeat, setup=scene.clear)
+
+
+def bench_rubberband(view, repeat, tmpdir, steps=20):
+    """Drag a rubberband from the top left corner of the board to the
+    bottom right corner in ``steps`` mouse moves."""
+
+    scene = view.scene
+    rect = scene.itemsBoundingRect()
+
+    def drag():
+        scene.rubberband_active = True
+        for i in range(1, steps + 1):
+            end = rect.topLeft() + QtCore.QPointF(
+                rect.width() * i / steps, rect.height() * i / steps)
+            scene.rubberband_item.fit(rect.topLeft(), end)
+            scene.update_rubberband_selection()
+        scene.rubberband_active = False
+        scene.rubberband_timer.stop()
+
+    return timed(drag, repeat, setup=lambda: deselect_all(view))
+
+
+def bench_normalize_size(view, repeat, tmpdir):
+    select_all(view)
+    return timed(view.scene.normalize_size, repeat)
+
+
+def bench_arrange_optimal(view, repeat, tmpdir):
+    select_all(view)
+    return timed(view.scene.arrange_optimal, repeat)
+
+
+def bench_undo_redo(view, repeat, tmpdir):
+    """Move all items at once, then undo and redo the move."""
+
+    select_all(view)
+    items = view.scene.selectedItems(user_only=True)
+    stack = view.undo_stack
+
+    def push():
+        stack.push(commands.MoveItemsBy(items, QtCore.QPointF(10, 10)))
+
+    def push_and_undo():
+        push()
+        stack.undo()
+
+    return {
+        'push': timed(push, repeat),
+        'undo': timed(stack.undo, repeat, setup=push),
+        'redo': timed(stack.redo, repeat, setup=push_and_undo),
+    }
+
+
+def bench_zoom_pan(view, repeat, tmpdir, steps=20):
+    """Zoom out and in again, then pan across the board, painting after
+    each step. Reports the time for all steps."""
+
+    anchor = view.viewport().rect().center()
+    deselect_all(view)
+
+    def paint():
+        view.viewport().repaint()
+
+    def zoom():
+        view.fit_rect(view.scene.itemsBoundingRect())
+        for delta in [-120] * steps + [120] * steps:
+            view.zoom(delta, anchor)
+            paint()
+
+    def pan():
+        view.fit_rect(view.scene.itemsBoundingRect())
+        view.scale(4, 4)
+        for i in range(steps):
+            view.pan(QtCore.QPoint(50, 30))
+            paint()
+
+    return {
+        'zoom': timed(zoom, repeat),
+        'pan': timed(pan, repeat),
+    }
+
+
+BENCHMARKS = {
+    'save': bench_save,
+    'load': bench_load,
+    'rubberband': bench_rubberband,
+    'normalize_size': bench_normalize_size,
+    'arrange_optimal': bench_arrange_optimal,
+    'undo_redo': bench_undo_redo,
+    'zoom_pan': bench_zoom_pan,
+}
+
+
+def run(sizes, benchmarks, repeat, text_ratio):
+    results = []
+    for size in sizes:
+        text_items = round(size * text_ratio)
+        view = utils.create_view()
+        utils.create_scene(text_items=text_items,
+                           pixmap_items=size - text_items,
+                           pixmap_size=(40, 30),
+                           vary_sizes=True,
+                           scene=view.scene)
+        view.fit_rect(view.scene.itemsBoundingRect())
+        result = {'items': size, 'text_items': text_items}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in benchmarks:
+                print(f'{size} items: {name}', file=sys.stderr)
+                result[name] = BENCHMARKS[name](view, repeat, tmpdir)
+                utils._app.processEvents()
+        results.append(result)
+        view.clear_scene()
+        view.parent.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 1000, 10000])
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS,
+                        default=list(BENCHMARKS),
+                        help='which benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--text-ratio', type=float, default=0.1,
+                        help='fraction of text items (default: 0.1)')
+    parser.add_argument('--output',
+                        help='write results to this file instead of stdout')
+    args = parser.parse_args()
+
+    app = utils.init_app()
+    results = {
+        'version': VERSION,
+        'python': platform.python_version(),
+        'qt': QtCore.QT_VERSION_STR,
+        'platform': platform.platform(),
+        'qpa_platform': app.platformName(),
+        'repeat': args.repeat,
+        'results': run(args.sizes, args.benchmarks, args.repeat,
+                       args.text_ratio),
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# This file is part of BeeRef.
+#
+# BeeRef is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BeeRef is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BeeRef.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Helpers for setting up scenes for benchmarks."""
+
+import os
+from unittest.mock import MagicMock, patch
+
+from PyQt6 import QtGui, QtWidgets
+
+from beeref.items import BeePixmapItem, BeeTextItem
+from beeref.scene import BeeGraphicsScene
+
+
+_app = None
+
+
+def init_app():
+    """Creates the QApplication needed for pixmaps etc. Runs headless
+    unless a platform has been configured explicitly."""
+
+    global _app
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    _app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    return _app
+
+
+def create_scene(text_items=0, pixmap_items=0, pixmap_size=(100, 100),
+                 vary_sizes=False, scene=None):
+    """Creates a scene filled with the given number of items, laid out
+    in a grid.
+
+    :param vary_sizes: If ``True``, the width and height of pixmaps vary
+        between one and four times the given ``pixmap_size``
+    :param scene: Fill this scene instead of creating a new one
+    """
+
+    if scene is None:
+        scene = BeeGraphicsScene(MagicMock())
+    columns = max(int((text_items + pixmap_items) ** 0.5), 1)
+    for i in range(text_items):
+        item = BeeTextItem(f'Text {i}')
+        item.setPos((i % columns) * 200, (i // columns) * 200)
+        scene.addItem(item)
+    for i in range(pixmap_items):
+        width, height = pixmap_size
+        if vary_sizes:
+            width *= 1 + i % 4
+            height *= 1 + (i // 4) % 4
+        img = QtGui.QImage(width, height, QtGui.QImage.Format.Format_RGB32)
+        img.fill(QtGui.QColor(i % 256, 100, 100))
+        item = BeePixmapItem(img)
+        j = text_items + i
+        item.setPos((j % columns) * 200, (j // columns) * 200)
+        scene.addItem(item)
+    return scene
+
+
+def create_view(width=1600, height=1000):
+    """Creates a view with an empty scene in a shown main window, for
+    benchmarks that need the scene to be displayed."""
+
+    from beeref.view import BeeGraphicsView
+
+    # Don't let BeeRef interpret the benchmark's command line arguments
+    with patch('beeref.view.commandline_args') as args:
+        args.filename = None
+        args.profile = False
+        args.profile_trace = None
+        window = QtWidgets.QMainWindow()
+        view = BeeGraphicsView(_app, window)
+    window.setCentralWidget(view)
+    window.resize(width, height)
+    window.show()
+    return view
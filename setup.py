@@ -12,7 +12,6 @@ setup(
         'pyQt6>=6.2.0',
         'pyQt6-Qt6>=6.2.0',
         'rectangle-packer>=2.0.1',
-        'exif',
     ],
     packages=[
         'beeref',
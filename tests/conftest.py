@@ -1,6 +1,11 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import os.path
 import pytest
+import shutil
+import threading
+import time
 import uuid
+from urllib.parse import urlsplit
 
 from unittest.mock import MagicMock, patch
 
@@ -27,6 +32,8 @@ def commandline_args():
     config_patcher = patch('beeref.view.commandline_args')
     config_mock = config_patcher.start()
     config_mock.filename = None
+    config_mock.profile = False
+    config_mock.profile_trace = None
     yield config_mock
     config_patcher.stop()
 
@@ -82,6 +89,17 @@ def imgdata3x3(imgfilename3x3):
     yield imgdata3x3
 
 
+@pytest.fixture
+def beefilename1item(tmpdir):
+    """A copy of a bee file containing one item, since opening older
+    bee files migrates them in place."""
+
+    root = os.path.dirname(__file__)
+    filename = os.path.join(tmpdir, 'test1item.bee')
+    shutil.copyfile(os.path.join(root, 'assets', 'test1item.bee'), filename)
+    yield filename
+
+
 @pytest.fixture
 def tmpfile(tmpdir):
     yield os.path.join(tmpdir, str(uuid.uuid4()))
@@ -97,3 +115,70 @@ def item():
 def qapp():
     from beeref.__main__ import BeeRefApplication
     yield BeeRefApplication([])
+
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    """Serves the 3x3 test image under various paths, also when used
+    as HTTP proxy:
+
+    * ``/slow/...``: after a delay
+    * ``/noetag/...``: without an ETag
+    * ``/redirect/...``: redirects to the image without the prefix
+    * ``/missing/...``: 404
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.clients.add(self.client_address)
+        # Requests through a proxy have the full URL as path:
+        path = urlsplit(self.path).path
+        if path.startswith('/missing/'):
+            self.respond(404)
+        elif path.startswith('/redirect/'):
+            self.respond(302, {'Location': path[len('/redirect'):]})
+        elif path.startswith('/noetag/'):
+            self.respond(200, body=server.imgdata)
+        else:
+            if path.startswith('/slow/'):
+                time.sleep(server.delay)
+            etag = '"etag1"'
+            if self.headers.get('If-None-Match') == etag:
+                self.respond(304, {'ETag': etag})
+            else:
+                self.respond(200, {'ETag': etag}, server.imgdata)
+
+    def respond(self, status, headers=None, body=b''):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def image_server(imgdata3x3):
+    """Local HTTP server serving the 3x3 test image, see
+    ``ImageRequestHandler``."""
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ImageRequestHandler)
+    server.daemon_threads = True
+    server.imgdata = imgdata3x3
+    server.delay = 0.3
+    server.requests = []
+    server.clients = set()
+    server.lock = threading.Lock()
+    server.url = lambda path: f'http://127.0.0.1:{server.server_port}{path}'
+    thread = threading.Thread(
+        target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,212 @@
+import base64
+import os.path
+import time
+
+import pytest
+
+from beeref.fileio.fetch import Fetcher, FetchError, HTTPCache
+
+
+@pytest.fixture
+def cache(tmpdir):
+    yield HTTPCache(os.path.join(tmpdir, 'cache'))
+
+
+def test_fetch(image_server, imgdata3x3):
+    with Fetcher() as fetcher:
+        assert fetcher.fetch(image_server.url('/foo.png')) == imgdata3x3
+    assert image_server.requests == ['/foo.png']
+
+
+def test_fetch_reuses_connection(image_server, imgdata3x3):
+    with Fetcher() as fetcher:
+        for i in range(3):
+            assert fetcher.fetch(image_server.url(f'/{i}.png')) == imgdata3x3
+    assert len(image_server.requests) == 3
+    assert len(image_server.clients) == 1
+
+
+def test_fetch_retries_when_reused_connection_closed(
+        image_server, imgdata3x3):
+    with Fetcher() as fetcher:
+        fetcher.fetch(image_server.url('/foo.png'))
+        for conns in fetcher.connections._idle.values():
+            for conn in conns:
+                conn.sock.close()
+        assert fetcher.fetch(image_server.url('/bar.png')) == imgdata3x3
+
+
+def test_fetch_follows_redirects(image_server, imgdata3x3):
+    with Fetcher() as fetcher:
+        data = fetcher.fetch(image_server.url('/redirect/foo.png'))
+    assert data == imgdata3x3
+    assert image_server.requests == ['/redirect/foo.png', '/foo.png']
+
+
+def test_fetch_too_many_redirects(image_server):
+    path = '/redirect' * 10 + '/foo.png'
+    with Fetcher() as fetcher:
+        with pytest.raises(FetchError):
+            fetcher.fetch(image_server.url(path))
+
+
+def test_fetch_http_error(image_server):
+    with Fetcher() as fetcher:
+        with pytest.raises(FetchError):
+            fetcher.fetch(image_server.url('/missing/foo.png'))
+
+
+def test_fetch_connection_refused(image_server):
+    url = image_server.url('/foo.png')
+    image_server.shutdown()
+    image_server.server_close()
+    with Fetcher() as fetcher:
+        with pytest.raises(FetchError):
+            fetcher.fetch(url)
+
+
+def test_fetch_uses_proxy(image_server, imgdata3x3, monkeypatch):
+    for name in ('no_proxy', 'NO_PROXY', 'HTTP_PROXY'):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('http_proxy', image_server.url(''))
+    with Fetcher() as fetcher:
+        assert fetcher.fetch('http://example.invalid/foo.png') == imgdata3x3
+    assert image_server.requests == ['http://example.invalid/foo.png']
+
+
+def test_fetch_uses_cache_with_proxy(
+        image_server, cache, monkeypatch):
+    for name in ('no_proxy', 'NO_PROXY', 'HTTP_PROXY'):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('http_proxy', image_server.url(''))
+    url = 'http://example.invalid/foo.png'
+    cache.put(url, '"etag1"', b'cached')
+    with Fetcher(cache=cache) as fetcher:
+        assert fetcher.fetch(url) == b'cached'
+
+
+def test_fetch_bypasses_proxy(image_server, imgdata3x3, monkeypatch):
+    for name in ('NO_PROXY', 'HTTP_PROXY'):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('http_proxy', 'http://127.0.0.1:9')
+    monkeypatch.setenv('no_proxy', '127.0.0.1')
+    with Fetcher() as fetcher:
+        assert fetcher.fetch(image_server.url('/foo.png')) == imgdata3x3
+    assert image_server.requests == ['/foo.png']
+
+
+def test_fetch_proxy_error(image_server, monkeypatch):
+    for name in ('no_proxy', 'NO_PROXY', 'HTTP_PROXY'):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('http_proxy', image_server.url(''))
+    with Fetcher() as fetcher:
+        with pytest.raises(FetchError):
+            fetcher.fetch('http://example.invalid/missing/foo.png')
+
+
+def test_fetch_data_url(imgdata3x3):
+    url = f'data:image/png;base64,{base64.b64encode(imgdata3x3).decode()}'
+    with Fetcher() as fetcher:
+        assert fetcher.fetch(url) == imgdata3x3
+
+
+def test_fetch_unsupported_url():
+    with Fetcher() as fetcher:
+        with pytest.raises(FetchError):
+            fetcher.fetch('foo:bar')
+
+
+def test_prefetch_downloads_concurrently(image_server, imgdata3x3):
+    urls = [image_server.url(f'/slow/{i}.png') for i in range(6)]
+    start = time.perf_counter()
+    with Fetcher(concurrency=6) as fetcher:
+        fetcher.prefetch(urls)
+        for url in urls:
+            assert fetcher.fetch(url) == imgdata3x3
+    assert time.perf_counter() - start < 6 * image_server.delay
+    assert len(image_server.requests) == 6
+
+
+def test_prefetch_downloads_once(image_server):
+    url = image_server.url('/foo.png')
+    with Fetcher() as fetcher:
+        fetcher.prefetch([url, url])
+        fetcher.fetch(url)
+        fetcher.fetch(url)
+    assert image_server.requests == ['/foo.png']
+
+
+def test_prefetch_error_raised_on_fetch(image_server):
+    url = image_server.url('/missing/foo.png')
+    with Fetcher() as fetcher:
+        fetcher.prefetch([url])
+        with pytest.raises(FetchError):
+            fetcher.fetch(url)
+
+
+def test_close_cancels_pending_prefetches(image_server):
+    urls = [image_server.url(f'/slow/{i}.png') for i in range(3)]
+    fetcher = Fetcher(concurrency=1)
+    fetcher.prefetch(urls)
+    fetcher.close()
+    assert fetcher._futures[urls[1]].cancelled()
+    assert fetcher._futures[urls[2]].cancelled()
+
+
+def test_fetch_stores_in_cache(image_server, imgdata3x3, cache):
+    url = image_server.url('/foo.png')
+    with Fetcher(cache=cache) as fetcher:
+        fetcher.fetch(url)
+    entry = cache.get(url)
+    assert entry.etag == '"etag1"'
+    assert entry.data == imgdata3x3
+
+
+def test_fetch_uses_cache_when_not_modified(image_server, cache):
+    url = image_server.url('/foo.png')
+    cache.put(url, '"etag1"', b'cached')
+    with Fetcher(cache=cache) as fetcher:
+        assert fetcher.fetch(url) == b'cached'
+    assert image_server.requests == ['/foo.png']
+
+
+def test_fetch_ignores_cache_when_modified(image_server, imgdata3x3, cache):
+    url = image_server.url('/foo.png')
+    cache.put(url, '"etag0"', b'cached')
+    with Fetcher(cache=cache) as fetcher:
+        assert fetcher.fetch(url) == imgdata3x3
+    assert cache.get(url).etag == '"etag1"'
+    assert cache.get(url).data == imgdata3x3
+
+
+def test_fetch_doesnt_cache_without_etag(image_server, cache):
+    url = image_server.url('/noetag/foo.png')
+    with Fetcher(cache=cache) as fetcher:
+        fetcher.fetch(url)
+    assert cache.get(url) is None
+
+
+def test_cache_get_when_empty(cache):
+    assert cache.get('http://example.com/foo.png') is None
+
+
+def test_cache_get_when_corrupt(cache):
+    url = 'http://example.com/foo.png'
+    cache.put(url, '"etag1"', b'foo')
+    with open(f'{cache.path(url)}.json', 'w') as f:
+        f.write('{foo')
+    assert cache.get(url) is None
+
+
+def test_cache_prunes_least_recently_used(tmpdir):
+    cache = HTTPCache(os.path.join(tmpdir, 'cache'), max_bytes=25)
+    cache.put('http://example.com/1', '"1"', b'1' * 10)
+    os.utime(f'{cache.path("http://example.com/1")}.data', (1, 1))
+    cache.put('http://example.com/2', '"2"', b'2' * 10)
+    os.utime(f'{cache.path("http://example.com/2")}.data', (2, 2))
+    cache.touch('http://example.com/1')
+    cache.put('http://example.com/3', '"3"', b'3' * 10)
+    assert cache.get('http://example.com/1').data == b'1' * 10
+    assert cache.get('http://example.com/2') is None
+    assert cache.get('http://example.com/3').data == b'3' * 10
+    assert not os.path.exists(f'{cache.path("http://example.com/2")}.json')
@@ -1,15 +1,20 @@
 import math
 import os.path
-from unittest.mock import patch
+from unittest.mock import MagicMock, mock_open, patch
 
 import httpretty
 import pytest
 
-import plum
-
 from PyQt6 import QtCore, QtGui
 
-from beeref.fileio.image import exif_rotated_image, load_image
+from beeref.fileio.image import (
+    exif_rotated_image,
+    load_image,
+    load_image_data,
+    original_data,
+    scaled_size,
+    StageTimings,
+)
 
 
 def test_exif_rotated_image_without_path(qapp):
@@ -22,11 +27,12 @@ def test_exif_rotated_image_not_a_file(qapp):
     assert img.isNull() is True
 
 
-def test_exif_rotated_image_exif_unpack_error(qapp, imgfilename3x3):
-    with patch('beeref.fileio.image.exif.Image',
-               side_effect=plum.exceptions.UnpackError()):
-        img = exif_rotated_image(imgfilename3x3)
-        assert img.isNull() is False
+def test_exif_rotated_image_not_an_image(qapp, tmpdir):
+    fname = os.path.join(tmpdir, 'foo.png')
+    with open(fname, 'w') as f:
+        f.write('foo')
+    img = exif_rotated_image(fname)
+    assert img.isNull() is True
 
 
 @pytest.mark.parametrize('path,expected',
@@ -59,21 +65,263 @@ def test_exif_rotated_image(path, expected, qapp):
             assert math.sqrt(sum(diff)) < 3
 
 
+def get_asset_fname(p):
+    root = os.path.dirname(__file__)
+    return os.path.join(root, '..', 'assets', p)
+
+
+@pytest.mark.parametrize('path,expected',
+                         [('test3x3.png', True),
+                          ('test3x3_orientation1.jpg', True),
+                          ('test3x3_orientation2.jpg', False),
+                          ('test3x3_orientation6.jpg', False)])
+def test_original_data(path, expected, qapp):
+    fname = get_asset_fname(path)
+    with open(fname, 'rb') as f:
+        expected = f.read() if expected else None
+    assert original_data(fname) == expected
+
+
+@pytest.mark.parametrize('path,keeps_data',
+                         [('test3x3.png', True),
+                          ('test3x3_orientation1.jpg', True),
+                          ('test3x3_orientation2.jpg', False),
+                          ('test3x3_orientation6.jpg', False)])
+def test_load_image_data(path, keeps_data, qapp):
+    with open(get_asset_fname(path), 'rb') as f:
+        data = f.read()
+    img, original = load_image_data(data)
+    assert img.size() == QtCore.QSize(3, 3)
+    assert original == (data if keeps_data else None)
+
+
+def image_data(width, height, fmt='PNG', exif_from=None):
+    """Create image data of the given size.
+
+    :param exif_from: Copy the EXIF data from this JPEG asset, since
+        Qt doesn't write EXIF orientation itself.
+    """
+
+    img = QtGui.QImage(width, height, QtGui.QImage.Format.Format_RGB32)
+    img.fill(QtGui.QColor(255, 0, 0))
+    barray = QtCore.QByteArray()
+    buffer = QtCore.QBuffer(barray)
+    buffer.open(QtCore.QIODevice.OpenModeFlag.WriteOnly)
+    img.save(buffer, fmt)
+    data = barray.data()
+    if exif_from:
+        with open(get_asset_fname(exif_from), 'rb') as f:
+            exif = f.read()
+        start = exif.index(b'\xff\xe1')
+        length = int.from_bytes(exif[start + 2:start + 4], 'big')
+        data = data[:2] + exif[start:start + 2 + length] + data[2:]
+    return data
+
+
+@pytest.mark.parametrize('size,max_size,proxy,expected',
+                         [((400, 200), None, False, None),
+                          ((400, 200), 400, False, None),
+                          ((400, 200), 100, False, (100, 50)),
+                          ((200, 400), 100, False, (50, 100)),
+                          ((1000, 3), 100, False, (100, 1)),
+                          ((400, 200), 400, True, None),
+                          ((400, 200), 300, True, (200, 100)),
+                          ((400, 200), 100, True, (100, 50)),
+                          ((401, 201), 100, True, (51, 26)),
+                          ((400, 200), 99, True, (50, 25))])
+def test_scaled_size(size, max_size, proxy, expected):
+    result = scaled_size(QtCore.QSize(*size), max_size, proxy=proxy)
+    if expected:
+        expected = QtCore.QSize(*expected)
+    assert result == expected
+
+
+def test_load_image_data_max_size_smaller_image(qapp):
+    data = image_data(40, 20)
+    img, original = load_image_data(data, max_size=50)
+    assert img.size() == QtCore.QSize(40, 20)
+    assert original == data
+
+
+@pytest.mark.parametrize('fmt,expected_fmt', [('PNG', b'jpeg'),
+                                              ('JPG', b'jpeg')])
+def test_load_image_data_max_size(fmt, expected_fmt, qapp):
+    data = image_data(400, 200, fmt)
+    img, original = load_image_data(data, max_size=300)
+    assert img.size() == QtCore.QSize(300, 150)
+    buffer = QtCore.QBuffer()
+    buffer.setData(original)
+    reader = QtGui.QImageReader(buffer)
+    assert reader.format() == expected_fmt
+    assert reader.size() == QtCore.QSize(300, 150)
+
+
+def test_load_image_data_max_size_keeps_alpha(qapp):
+    img = QtGui.QImage(400, 200, QtGui.QImage.Format.Format_ARGB32)
+    img.fill(QtGui.QColor(255, 0, 0, 100))
+    barray = QtCore.QByteArray()
+    buffer = QtCore.QBuffer(barray)
+    buffer.open(QtCore.QIODevice.OpenModeFlag.WriteOnly)
+    img.save(buffer, 'PNG')
+    img, original = load_image_data(barray.data(), max_size=300)
+    assert img.size() == QtCore.QSize(300, 150)
+    assert original.startswith(b'\x89PNG')
+
+
+def test_load_image_data_max_size_with_exif_orientation(qapp):
+    data = image_data(400, 200, 'JPG', 'test3x3_orientation6.jpg')
+    img, original = load_image_data(data, max_size=300)
+    assert img.size() == QtCore.QSize(150, 300)
+    assert QtGui.QImage.fromData(original).size() == QtCore.QSize(150, 300)
+
+
+def test_load_image_data_max_size_proxy(qapp):
+    data = image_data(400, 200)
+    img, original = load_image_data(data, max_size=300, proxy=True)
+    assert img.size() == QtCore.QSize(200, 100)
+    assert original == data
+
+
+def test_load_image_data_max_size_proxy_with_exif_orientation(qapp):
+    data = image_data(400, 200, 'JPG', 'test3x3_orientation6.jpg')
+    img, original = load_image_data(data, max_size=300, proxy=True)
+    assert img.size() == QtCore.QSize(200, 400)
+    assert original is None
+
+
+def test_load_image_max_size(qapp, tmpdir):
+    fname = os.path.join(tmpdir, 'large.png')
+    with open(fname, 'wb') as f:
+        f.write(image_data(400, 200))
+    img, filename, data = load_image(fname, max_size=100)
+    assert img.size() == QtCore.QSize(100, 50)
+
+
+def qbuffer(data):
+    buffer = QtCore.QBuffer()
+    buffer.setData(data)
+    return buffer
+
+
+def opened_qbuffer(data):
+    buffer = qbuffer(data)
+    buffer.open(QtCore.QIODevice.OpenModeFlag.ReadOnly)
+    buffer.read(10)
+    return buffer
+
+
+@pytest.mark.parametrize('to_source', [bytearray,
+                                       memoryview,
+                                       QtCore.QByteArray,
+                                       qbuffer,
+                                       opened_qbuffer])
+@pytest.mark.parametrize('path,keeps_data',
+                         [('test3x3.png', True),
+                          ('test3x3_orientation6.jpg', False)])
+def test_load_image_data_from_sources(path, keeps_data, to_source, qapp):
+    with open(get_asset_fname(path), 'rb') as f:
+        data = f.read()
+    img, original = load_image_data(to_source(data))
+    assert img.size() == QtCore.QSize(3, 3)
+    assert original == (data if keeps_data else None)
+    assert original is None or type(original) is bytes
+
+
+def test_load_image_data_from_source_applies_exif_orientation(qapp):
+    data = image_data(400, 200, 'JPG', 'test3x3_orientation6.jpg')
+    img, original = load_image_data(memoryview(data))
+    assert img.size() == QtCore.QSize(200, 400)
+
+
+@pytest.mark.parametrize('to_source', [bytes, memoryview, qbuffer])
+def test_exif_rotated_image_from_data(to_source, qapp):
+    with open(get_asset_fname('test3x3_orientation6.jpg'), 'rb') as f:
+        data = f.read()
+    img = exif_rotated_image(to_source(data))
+    expected = QtGui.QImage(get_asset_fname('test3x3.jpg'))
+    col_img = img.pixelColor(0, 0).getRgb()
+    col_expected = expected.pixelColor(0, 0).getRgb()
+    diff = [(col_img[i] - col_expected[i])**2 for i in range(4)]
+    assert math.sqrt(sum(diff)) < 3
+
+
+@pytest.mark.parametrize('path,expected',
+                         [('test3x3.png', True),
+                          ('test3x3_orientation6.jpg', False)])
+def test_original_data_from_data(path, expected, qapp):
+    with open(get_asset_fname(path), 'rb') as f:
+        data = f.read()
+    result = original_data(memoryview(data))
+    assert result == (data if expected else None)
+
+
+def test_original_data_from_data_not_an_image(qapp):
+    assert original_data(b'foo') is None
+
+
+@pytest.mark.parametrize('to_source', [bytes, memoryview, qbuffer])
+def test_load_image_from_data(to_source, qapp, imgdata3x3):
+    timings = StageTimings()
+    with patch('beeref.fileio.image.open') as open_mock:
+        img, filename, data = load_image(to_source(imgdata3x3), timings)
+    open_mock.assert_not_called()
+    assert img.size() == QtCore.QSize(3, 3)
+    assert filename is None
+    assert data == imgdata3x3
+    assert set(timings.totals) == {'decode'}
+
+
+def test_load_image_data_not_an_image(qapp):
+    img, original = load_image_data(b'foo')
+    assert img.isNull() is True
+    assert original is None
+
+
+def test_original_data_nonexisting_file(qapp):
+    assert original_data('foo.png') is None
+
+
+def test_original_data_not_an_image(qapp, tmpdir):
+    fname = os.path.join(tmpdir, 'foo.png')
+    with open(fname, 'w') as f:
+        f.write('foo')
+    assert original_data(fname) is None
+
+
 def test_load_image_loads_from_filename(view, imgfilename3x3):
-    img, filename = load_image(imgfilename3x3)
+    img, filename, data = load_image(imgfilename3x3)
     assert img.isNull() is False
     assert filename == imgfilename3x3
+    with open(imgfilename3x3, 'rb') as f:
+        assert data == f.read()
+
+
+def test_load_image_reads_file_once(view, imgdata3x3):
+    with patch('beeref.fileio.image.open',
+               mock_open(read_data=imgdata3x3)) as open_mock:
+        img, filename, data = load_image('foo.png')
+    open_mock.assert_called_once_with('foo.png', 'rb')
+    assert img.isNull() is False
+    assert data == imgdata3x3
+
+
+def test_load_image_adds_timings(view, imgfilename3x3):
+    timings = StageTimings()
+    load_image(imgfilename3x3, timings)
+    assert set(timings.totals) == {'decode', 'read'}
+    assert timings.totals['decode'] > 0
 
 
 def test_load_image_loads_from_nonexisting_filename(view, imgfilename3x3):
-    img, filename = load_image('foo.png')
+    img, filename, data = load_image('foo.png')
     assert img.isNull() is True
     assert filename == 'foo.png'
+    assert data is None
 
 
 def test_load_image_loads_from_existing_local_url(view, imgfilename3x3):
     url = QtCore.QUrl.fromLocalFile(imgfilename3x3)
-    img, filename = load_image(url)
+    img, filename, data = load_image(url)
     assert img.isNull() is False
     assert filename == imgfilename3x3
 
@@ -86,9 +334,10 @@ def test_load_image_loads_from_existing_web_url(view, imgdata3x3):
         url,
         body=imgdata3x3,
     )
-    img, filename = load_image(QtCore.QUrl(url))
+    img, filename, data = load_image(QtCore.QUrl(url))
     assert img.isNull() is False
     assert filename == url
+    assert data == imgdata3x3
 
 
 @httpretty.activate
@@ -99,6 +348,52 @@ def test_load_image_loads_from_web_url_errors(view, imgfilename3x3):
         url,
         status=500,
     )
-    img, filename = load_image(QtCore.QUrl(url))
+    img, filename, data = load_image(QtCore.QUrl(url))
     assert img.isNull() is True
     assert filename == url
+    assert data is None
+
+
+def test_load_image_loads_from_web_url_with_fetcher(qapp, imgdata3x3):
+    url = 'http://example.com/foo.png'
+    fetcher = MagicMock()
+    fetcher.fetch.return_value = imgdata3x3
+    timings = StageTimings()
+    img, filename, data = load_image(QtCore.QUrl(url), timings,
+                                     fetcher=fetcher)
+    fetcher.fetch.assert_called_once_with(url)
+    assert img.size() == QtCore.QSize(3, 3)
+    assert filename == url
+    assert data == imgdata3x3
+    assert set(timings.totals) == {'download', 'decode'}
+
+
+def test_load_image_from_web_url_uses_http_cache(
+        qapp, image_server, imgdata3x3):
+    url = image_server.url('/foo.png')
+    load_image(QtCore.QUrl(url))
+    with patch('beeref.fileio.fetch.HTTPCache.put') as put_mock:
+        img, filename, data = load_image(QtCore.QUrl(url))
+    put_mock.assert_not_called()
+    assert data == imgdata3x3
+    assert image_server.requests == ['/foo.png', '/foo.png']
+
+
+def test_stage_timings_adds_up():
+    timings = StageTimings()
+    with patch('beeref.fileio.image.time.perf_counter',
+               side_effect=[1, 3, 10, 10.5]):
+        with timings.measure('decode'):
+            pass
+        with timings.measure('decode'):
+            pass
+    assert timings.totals == {'decode': 2.5}
+    assert str(timings) == 'decode: 2.500s'
+
+
+def test_stage_timings_measures_when_failing():
+    timings = StageTimings()
+    with pytest.raises(ValueError):
+        with timings.measure('decode'):
+            raise ValueError()
+    assert 'decode' in timings.totals
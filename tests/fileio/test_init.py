@@ -1,8 +1,9 @@
 import os.path
 import tempfile
+import time
 from unittest.mock import MagicMock, patch
 
-from PyQt6 import QtCore
+from PyQt6 import QtCore, QtGui
 
 from beeref import fileio
 from beeref import commands
@@ -43,6 +44,21 @@ def test_load_images_loads(view, imgfilename3x3):
     assert cmd.scene == view.scene
     assert cmd.ignore_first_redo is True
     assert item.pos() == QtCore.QPointF(3.5, 4.5)
+    with open(imgfilename3x3, 'rb') as f:
+        assert item.image_data == f.read()
+
+
+def test_load_images_loads_data(view, imgdata3x3):
+    view.scene.undo_stack = MagicMock()
+    worker = MagicMock(canceled=False)
+    fileio.load_images([imgdata3x3, QtCore.QByteArray(imgdata3x3)],
+                       QtCore.QPointF(5, 6), view.scene, worker)
+    worker.finished.emit.assert_called_once_with('', [])
+    itemdata = queue2list(view.scene.items_to_add)
+    assert len(itemdata) == 2
+    for data, selected in itemdata:
+        assert data['item'].width == 3
+        assert data['item'].image_data == imgdata3x3
 
 
 def test_load_images_canceled(view, imgfilename3x3):
@@ -84,3 +100,134 @@ def test_load_images_error(view, imgfilename3x3):
     assert cmd.scene == view.scene
     assert cmd.ignore_first_redo is True
     assert item.pos() == QtCore.QPointF(3.5, 4.5)
+
+
+def test_load_images_keeps_order(view):
+    # Images that are decoded first still get added in the given order
+    def load_image(filename, *args):
+        time.sleep(0.05 if filename == 'slow.png' else 0)
+        img = QtGui.QImage(1, 1, QtGui.QImage.Format.Format_RGB32)
+        return (img, filename, None)
+
+    view.scene.undo_stack = MagicMock()
+    worker = MagicMock(canceled=False)
+    filenames = ['slow.png'] + [f'{i}.png' for i in range(20)]
+    with patch('beeref.fileio.load_image', side_effect=load_image):
+        fileio.load_images(filenames, QtCore.QPointF(5, 6), view.scene,
+                           worker)
+    itemdata = queue2list(view.scene.items_to_add)
+    assert [data[0]['item'].filename for data in itemdata] == filenames
+    assert [c.args for c in worker.progress.emit.call_args_list] == [
+        (i,) for i in range(21)]
+    cmd = view.scene.undo_stack.push.call_args_list[0][0][0]
+    assert cmd.items == [data[0]['item'] for data in itemdata]
+
+
+def test_load_images_canceled_stops_decoding(view):
+    view.scene.undo_stack = MagicMock()
+    worker = MagicMock(canceled=True)
+    img = QtGui.QImage(1, 1, QtGui.QImage.Format.Format_RGB32)
+    filenames = [f'{i}.png' for i in range(100)]
+    with patch('beeref.fileio.load_image',
+               side_effect=lambda f, *args: (img, f, None)) as load_mock:
+        fileio.load_images(filenames, QtCore.QPointF(5, 6), view.scene,
+                           worker)
+    assert load_mock.call_count < 100
+    assert len(queue2list(view.scene.items_to_add)) == 1
+
+
+@patch('beeref.fileio.IMPORT_AHEAD', 1)
+@patch('beeref.fileio.os.cpu_count', return_value=2)
+def test_load_images_limits_images_in_flight(cpu_mock, view):
+    in_flight = []
+    img = QtGui.QImage(1, 1, QtGui.QImage.Format.Format_RGB32)
+
+    def load_image(filename, *args):
+        in_flight.append(len(view.scene.items_to_add.queue))
+        return (img, filename, None)
+
+    view.scene.undo_stack = MagicMock()
+    worker = MagicMock(canceled=False)
+    with patch('beeref.fileio.load_image', side_effect=load_image):
+        fileio.load_images([f'{i}.png' for i in range(10)],
+                           QtCore.QPointF(5, 6), view.scene, worker)
+    # Decoding of an image only starts when the one two places before
+    # it has been added to the scene
+    assert all(queued >= i - 2 for i, queued in enumerate(in_flight))
+
+
+def test_load_images_original_policy_ignores_max_size(view, tmpdir):
+    fname = os.path.join(tmpdir, 'large.png')
+    QtGui.QImage(1200, 600, QtGui.QImage.Format.Format_RGB32).save(fname)
+    view.scene.undo_stack = MagicMock()
+    worker = MagicMock(canceled=False)
+    fileio.load_images([fname], QtCore.QPointF(5, 6), view.scene, worker,
+                       policy='original', max_size=500)
+    item = queue2list(view.scene.items_to_add)[0][0]['item']
+    assert item.pixmap_size() == QtCore.QSize(1200, 600)
+
+
+def test_load_images_cap_policy(view, tmpdir):
+    fname = os.path.join(tmpdir, 'large.png')
+    QtGui.QImage(1200, 600, QtGui.QImage.Format.Format_RGB32).save(fname)
+    view.scene.undo_stack = MagicMock()
+    worker = MagicMock(canceled=False)
+    fileio.load_images([fname], QtCore.QPointF(5, 6), view.scene, worker,
+                       policy='cap', max_size=500)
+    item = queue2list(view.scene.items_to_add)[0][0]['item']
+    assert item.pixmap_size() == QtCore.QSize(500, 250)
+    assert QtGui.QImage.fromData(item.image_data).width() == 500
+
+
+def test_load_images_proxy_policy(view, tmpdir):
+    fname = os.path.join(tmpdir, 'large.png')
+    QtGui.QImage(2400, 1200, QtGui.QImage.Format.Format_RGB32).save(fname)
+    view.scene.undo_stack = MagicMock()
+    worker = MagicMock(canceled=False)
+    fileio.load_images([fname], QtCore.QPointF(5, 6), view.scene, worker,
+                       policy='proxy', max_size=1000)
+    item = queue2list(view.scene.items_to_add)[0][0]['item']
+    assert item.pixmap_size() == QtCore.QSize(2400, 1200)
+    assert item.pixmap_bytes() == 0
+    assert item.mipmaps[2].size() == QtCore.QSize(600, 300)
+    with open(fname, 'rb') as f:
+        assert item.image_data == f.read()
+
+
+def test_load_images_proxy_policy_without_max_size(view, tmpdir):
+    fname = os.path.join(tmpdir, 'large.png')
+    QtGui.QImage(2400, 1200, QtGui.QImage.Format.Format_RGB32).save(fname)
+    view.scene.undo_stack = MagicMock()
+    worker = MagicMock(canceled=False)
+    fileio.load_images([fname], QtCore.QPointF(5, 6), view.scene, worker,
+                       policy='proxy')
+    worker.finished.emit.assert_called_once_with('', [])
+    item = queue2list(view.scene.items_to_add)[0][0]['item']
+    assert item.pixmap_size() == QtCore.QSize(2400, 1200)
+    assert item.pixmap_bytes() == 2400 * 1200 * 4
+
+
+def test_load_images_proxy_policy_small_image(view, imgfilename3x3):
+    view.scene.undo_stack = MagicMock()
+    worker = MagicMock(canceled=False)
+    fileio.load_images([imgfilename3x3], QtCore.QPointF(5, 6), view.scene,
+                       worker, policy='proxy', max_size=1000)
+    item = queue2list(view.scene.items_to_add)[0][0]['item']
+    assert item.pixmap_bytes() > 0
+    assert item.mipmaps == {}
+    with open(imgfilename3x3, 'rb') as f:
+        assert item.image_data == f.read()
+
+
+def test_load_images_downloads_concurrently(view, image_server):
+    view.scene.undo_stack = MagicMock()
+    worker = MagicMock(canceled=False)
+    urls = [QtCore.QUrl(image_server.url(f'/slow/{i}.png'))
+            for i in range(6)]
+    start = time.perf_counter()
+    fileio.load_images(urls, QtCore.QPointF(5, 6), view.scene, worker)
+    assert time.perf_counter() - start < 6 * image_server.delay
+    itemdata = queue2list(view.scene.items_to_add)
+    assert [data[0]['item'].filename for data in itemdata] == [
+        url.url() for url in urls]
+    worker.finished.emit.assert_called_once_with('', [])
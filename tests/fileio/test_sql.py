@@ -7,10 +7,11 @@ from unittest.mock import MagicMock, patch
 from PyQt6 import QtCore, QtGui
 import pytest
 
-from beeref.fileio import schema, is_bee_file
+from beeref.fileio import schema, is_bee_file, sql
 from beeref.fileio.errors import BeeFileIOError
-from beeref.fileio.sql import SQLiteIO
+from beeref.fileio.sql import blob_name, BlobReader, SQLiteIO
 from beeref.items import BeePixmapItem, BeeTextItem
+from ..utils import queue2list
 
 
 @pytest.mark.parametrize('filename,expected',
@@ -71,6 +72,31 @@ def test_sqliteio_migrate_migrates_when_file_not_writable(tmpfile):
     assert os.path.exists(newdir) is False
 
 
+@patch('beeref.fileio.sql.USER_VERSION', 3)
+@patch('beeref.fileio.sql.VACUUM_AFTER', {2})
+@patch('beeref.fileio.sql.MIGRATIONS', {
+    2: ['CREATE TABLE foo_new (data BLOB)',
+        'INSERT INTO foo_new (data) SELECT data FROM foo',
+        'DROP TABLE foo',
+        'ALTER TABLE foo_new RENAME TO foo'],
+    3: ['CREATE TABLE bar (baz INT)']})
+def test_sqliteio_migrate_reclaims_space_of_copied_tables(tmpfile):
+    io = SQLiteIO(tmpfile, MagicMock(), create_new=True)
+    io.ex('PRAGMA user_version=1')
+    io.ex('CREATE TABLE foo (data BLOB)')
+    io.ex('INSERT INTO foo (data) VALUES (?)', (b'x' * 1000000,))
+    io.connection.commit()
+    del(io)
+    size = os.path.getsize(tmpfile)
+
+    io = SQLiteIO(tmpfile, MagicMock())
+    assert io.fetchone('PRAGMA user_version')[0] == 3
+    assert io.fetchone('SELECT length(data) FROM foo')[0] == 1000000
+    assert io.fetchone('PRAGMA freelist_count')[0] == 0
+    del(io)
+    assert os.path.getsize(tmpfile) < size * 1.1
+
+
 def test_all_migrations(tmpfile):
     io = SQLiteIO(tmpfile, MagicMock(), create_new=True)
 
@@ -105,6 +131,10 @@ def test_all_migrations(tmpfile):
           ('pixmap', 22.2, 33.3, 0.22, 3.4, 45, -1, 'bee.png'))
     io.ex('INSERT INTO sqlar (item_id, data) VALUES (?, ?)',
           (1, b'bla'))
+    io.ex('INSERT INTO items (type, filename) VALUES (?, ?) ',
+          ('pixmap', 'copy.png'))
+    io.ex('INSERT INTO sqlar (item_id, data) VALUES (?, ?)',
+          (2, b'bla'))
     io.connection.commit()
     del(io)
 
@@ -112,12 +142,21 @@ def test_all_migrations(tmpfile):
     result = io.fetchone('PRAGMA user_version')
     assert result[0] == schema.USER_VERSION
     result = io.fetchone(
-        'SELECT x, y, items.data, sqlar.data FROM items '
-        'LEFT OUTER JOIN sqlar on sqlar.item_id = items.id')
+        'SELECT x, y, items.data, sqlar.data, sqlar.name FROM items '
+        'LEFT OUTER JOIN sqlar on sqlar.name = items.blob')
     assert result[0] == 22.2
     assert result[1] == 33.3
     assert json.loads(result[2]) == {'filename': 'bee.png'}
     assert result[3] == b'bla'
+    assert result[4] == blob_name(b'bla', 'png')
+    result = io.fetchall('SELECT blob FROM items')
+    assert result == [(blob_name(b'bla', 'png'),)] * 2
+    result = io.fetchone('SELECT COUNT(*) FROM sqlar')
+    assert result[0] == 1
+    result = io.fetchone('SELECT COUNT(*) FROM mipmaps')
+    assert result[0] == 0
+    result = io.fetchone('PRAGMA freelist_count')
+    assert result[0] == 0
 
 
 def test_sqliteio_ẁrite_meta_application_id(tmpfile):
@@ -148,7 +187,7 @@ def test_sqliteio_create_schema_on_new_when_create_new(tmpfile):
     result = io.fetchone(
         'SELECT COUNT(*) FROM sqlite_master '
         'WHERE type="table" AND name NOT LIKE "sqlite_%"')
-    assert result[0] == 2
+    assert result[0] == 3
     scene_mock.clear_save_ids.assert_called_once()
 
 
@@ -212,7 +251,7 @@ def test_sqliteio_write_inserts_new_text_item(tmpfile, view):
         'SELECT x, y, z, scale, rotation, flip, items.data, type, '
         'sqlar.data, sqlar.name '
         'FROM items '
-        'LEFT OUTER JOIN sqlar on sqlar.item_id = items.id')
+        'LEFT OUTER JOIN sqlar on sqlar.name = items.blob')
     assert result[0] == 44.0
     assert result[1] == 55.0
     assert result[2] == 0.22
@@ -243,7 +282,7 @@ def test_sqliteio_write_inserts_new_pixmap_item(tmpfile, view):
         'SELECT x, y, z, scale, rotation, flip, items.data, type, '
         'sqlar.data, sqlar.name '
         'FROM items '
-        'INNER JOIN sqlar on sqlar.item_id = items.id')
+        'INNER JOIN sqlar on sqlar.name = items.blob')
     assert result[0] == 44.0
     assert result[1] == 55.0
     assert result[2] == 0.22
@@ -256,7 +295,103 @@ def test_sqliteio_write_inserts_new_pixmap_item(tmpfile, view):
     }
     assert result[7] == 'pixmap'
     assert result[8] == b'abc'
-    assert result[9] == '0001-bee.png'
+    assert result[9] == blob_name(b'abc', 'png')
+
+
+def test_sqliteio_write_inserts_original_data(tmpfile, view):
+    root = os.path.dirname(__file__)
+    fname = os.path.join(root, '..', 'assets', 'test3x3.jpg')
+    with open(fname, 'rb') as f:
+        data = f.read()
+    item = BeePixmapItem(QtGui.QImage(fname), 'test3x3.jpg', image_data=data)
+    view.scene.addItem(item)
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.write()
+    result = io.fetchone('SELECT name, sz, data FROM sqlar')
+    assert result == (blob_name(data, 'jpg'), len(data), data)
+
+
+def test_sqliteio_write_inserts_pixmap_size(tmpfile, view, imgfilename3x3):
+    item = BeePixmapItem(QtGui.QImage(imgfilename3x3))
+    view.scene.addItem(item)
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.write()
+    result = io.fetchone('SELECT width, height FROM sqlar')
+    assert result == (3, 3)
+
+
+def test_sqliteio_write_inserts_mipmaps(tmpfile, view):
+    item = BeePixmapItem(
+        QtGui.QImage(1024, 600, QtGui.QImage.Format.Format_RGB32))
+    view.scene.addItem(item)
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.write()
+    result = io.fetchall(
+        'SELECT blob, level FROM mipmaps ORDER BY level')
+    assert result == [(item.blob, 1), (item.blob, 2)]
+
+
+def test_sqliteio_write_removes_mipmaps_of_nonexisting_item(tmpfile, view):
+    item = BeePixmapItem(
+        QtGui.QImage(600, 600, QtGui.QImage.Format.Format_RGB32))
+    view.scene.addItem(item)
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.write()
+    assert io.fetchone('SELECT COUNT(*) from mipmaps') == (1,)
+    del(io)
+
+    view.scene.removeItem(item)
+    io = SQLiteIO(tmpfile, view.scene)
+    io.write()
+    assert io.fetchone('SELECT COUNT(*) from mipmaps') == (0,)
+
+
+def test_sqliteio_write_stores_duplicate_images_once(tmpfile, view):
+    img = QtGui.QImage(600, 600, QtGui.QImage.Format.Format_RGB32)
+    img.fill(QtGui.QColor(255, 0, 0))
+    item1 = BeePixmapItem(img)
+    view.scene.addItem(item1)
+    item2 = BeePixmapItem(img)
+    view.scene.addItem(item2)
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.write()
+
+    assert item1.blob == item2.blob
+    result = io.fetchall('SELECT blob FROM items')
+    assert result == [(item1.blob,), (item1.blob,)]
+    assert io.fetchone('SELECT COUNT(*) FROM sqlar') == (1,)
+    assert io.fetchone('SELECT COUNT(*) FROM mipmaps') == (1,)
+
+
+def test_sqliteio_write_keeps_images_still_in_use(tmpfile, view):
+    img = QtGui.QImage(600, 600, QtGui.QImage.Format.Format_RGB32)
+    img.fill(QtGui.QColor(255, 0, 0))
+    item1 = BeePixmapItem(img)
+    view.scene.addItem(item1)
+    item2 = BeePixmapItem(img)
+    view.scene.addItem(item2)
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.write()
+
+    view.scene.removeItem(item1)
+    io.create_new = False
+    io.write()
+    assert io.fetchone('SELECT COUNT(*) FROM sqlar') == (1,)
+    assert io.fetchone('SELECT COUNT(*) FROM mipmaps') == (1,)
+
+    view.scene.removeItem(item2)
+    io.write()
+    assert io.fetchone('SELECT COUNT(*) FROM sqlar') == (0,)
+    assert io.fetchone('SELECT COUNT(*) FROM mipmaps') == (0,)
+
+
+def test_sqliteio_write_create_new_loads_deferred_pixmaps(tmpfile, view):
+    with open(tmpfile, 'w') as f:
+        f.write('foobar')
+    view.scene.detach_items_from_file = MagicMock()
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.write()
+    view.scene.detach_items_from_file.assert_called_once_with()
 
 
 def test_sqliteio_write_inserts_new_pixmap_item_without_filename(
@@ -268,9 +403,10 @@ def test_sqliteio_write_inserts_new_pixmap_item_without_filename(
     assert item.save_id == 1
     result = io.fetchone(
         'SELECT items.data, sqlar.name FROM items '
-        'INNER JOIN sqlar on sqlar.item_id = items.id')
+        'INNER JOIN sqlar on sqlar.name = items.blob')
     assert json.loads(result[0])['filename'] is None
-    assert result[1] == '0001.png'
+    assert result[1] == item.blob
+    assert result[1].endswith('.png')
 
 
 def test_sqliteio_write_updates_existing_text_item(tmpfile, view):
@@ -296,7 +432,7 @@ def test_sqliteio_write_updates_existing_text_item(tmpfile, view):
     result = io.fetchone(
         'SELECT x, y, z, scale, rotation, flip, items.data, sqlar.data '
         'FROM items '
-        'LEFT OUTER JOIN sqlar on sqlar.item_id = items.id')
+        'LEFT OUTER JOIN sqlar on sqlar.name = items.blob')
     assert result[0] == 20
     assert result[1] == 30
     assert result[2] == 0.33
@@ -334,7 +470,7 @@ def test_sqliteio_write_updates_existing_pixmap_item(tmpfile, view):
     result = io.fetchone(
         'SELECT x, y, z, scale, rotation, flip, items.data, sqlar.data '
         'FROM items '
-        'INNER JOIN sqlar on sqlar.item_id = items.id')
+        'INNER JOIN sqlar on sqlar.name = items.blob')
     assert result[0] == 20
     assert result[1] == 30
     assert result[2] == 0.33
@@ -348,6 +484,236 @@ def test_sqliteio_write_updates_existing_pixmap_item(tmpfile, view):
     assert result[7] == b'abc'
 
 
+def test_sqliteio_write_skips_unchanged_items(tmpfile, view):
+    item = BeeTextItem(text='foo bar')
+    view.scene.addItem(item)
+    item.setPos(44, 55)
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.write()
+    assert item.dirty is False
+    io.ex('UPDATE items SET x=?', (1,))
+    io.connection.commit()
+    io.create_new = False
+    io.update_items = MagicMock()
+    io.write()
+
+    io.update_items.assert_called_once_with([])
+    assert io.fetchone('SELECT x FROM items') == (1,)
+
+
+def test_sqliteio_write_updates_changed_items_only(tmpfile, view):
+    item1 = BeeTextItem(text='foo')
+    view.scene.addItem(item1)
+    item2 = BeeTextItem(text='bar')
+    view.scene.addItem(item2)
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.write()
+    item2.setPos(20, 30)
+    assert item1.dirty is False
+    assert item2.dirty is True
+    io.create_new = False
+    io.write()
+
+    assert item2.dirty is False
+    result = io.fetchall('SELECT id, x, y FROM items ORDER BY id')
+    assert result == [(item1.save_id, 0, 0), (item2.save_id, 20, 30)]
+
+
+def test_sqliteio_write_assigns_ids_after_existing_ones(
+        tmpfile, view, imgfilename3x3):
+    item1 = BeeTextItem(text='foo')
+    view.scene.addItem(item1)
+    item2 = BeeTextItem(text='bar')
+    view.scene.addItem(item2)
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.write()
+    view.scene.removeItem(item1)
+    item3 = BeePixmapItem(QtGui.QImage(imgfilename3x3))
+    view.scene.addItem(item3)
+    io.create_new = False
+    io.write()
+
+    assert item3.save_id == 3
+    result = io.fetchall(
+        'SELECT items.id, type, sqlar.width FROM items '
+        'LEFT OUTER JOIN sqlar on sqlar.name = items.blob '
+        'ORDER BY items.id')
+    assert result == [(2, 'text', None), (3, 'pixmap', 3)]
+
+
+def test_sqliteio_write_commits_once(tmpfile, view):
+    for i in range(3):
+        view.scene.addItem(BeeTextItem(text=f'foo {i}'))
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.create_schema_on_new()
+    io._connection = MagicMock(wraps=io._connection)
+    io.write_data()
+    io._connection.commit.assert_called_once_with()
+    assert io.fetchone('SELECT COUNT(*) FROM items') == (3,)
+
+
+def test_sqliteio_write_canceled_keeps_processed_items(tmpfile, view):
+    worker = MagicMock(canceled=False)
+    item1 = BeeTextItem(text='foo')
+    view.scene.addItem(item1)
+    item2 = BeeTextItem(text='bar')
+    view.scene.addItem(item2)
+    io = SQLiteIO(tmpfile, view.scene, create_new=True, worker=worker)
+    worker.progress.emit.side_effect = lambda i: setattr(
+        worker, 'canceled', True)
+    io.write()
+
+    assert io.fetchall('SELECT type FROM items') == [('text',)]
+    assert item1.save_id == 1
+    assert item1.dirty is False
+    assert item2.save_id is None
+    assert item2.dirty is True
+
+
+@pytest.mark.parametrize('journal_mode,synchronous,expected',
+                         [(None, None, ('delete', 2)),
+                          ('WAL', 'NORMAL', ('wal', 1)),
+                          ('wal', 'off', ('wal', 0)),
+                          ('foo; DROP TABLE items', 'bar', ('delete', 2))])
+def test_sqliteio_journal_mode_and_synchronous(
+        journal_mode, synchronous, expected, tmpfile, view):
+    io = SQLiteIO(tmpfile, view.scene, create_new=True,
+                  journal_mode=journal_mode, synchronous=synchronous)
+    io.write()
+    assert io.fetchone('PRAGMA journal_mode')[0] == expected[0]
+    assert io.fetchone('PRAGMA synchronous')[0] == expected[1]
+
+
+def test_sqliteio_journal_mode_not_set_when_readonly(tmpfile, view):
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.write()
+    del(io)
+    io = SQLiteIO(tmpfile, view.scene, readonly=True, journal_mode='WAL')
+    assert io.fetchone('PRAGMA journal_mode')[0] == 'delete'
+
+
+def test_sqliteio_write_reinserts_items_missing_from_file(tmpfile, view):
+    item = BeeTextItem(text='foo')
+    view.scene.addItem(item)
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.write()
+    view.scene.removeItem(item)
+    io.create_new = False
+    io.write()
+    assert io.fetchone('SELECT COUNT(*) FROM items') == (0,)
+
+    # e.g. undoing the deletion:
+    view.scene.addItem(item)
+    io.write()
+    assert io.fetchall('SELECT id, type FROM items') == [
+        (item.save_id, 'text')]
+
+
+def test_sqliteio_write_canceled_doesnt_delete_unprocessed_items(
+        tmpfile, view):
+    item1 = BeeTextItem(text='foo')
+    view.scene.addItem(item1)
+    item2 = BeeTextItem(text='bar')
+    view.scene.addItem(item2)
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.write()
+    del(io)
+
+    worker = MagicMock(canceled=True)
+    io = SQLiteIO(tmpfile, view.scene, worker=worker)
+    io.write()
+    assert io.fetchone('SELECT COUNT(*) FROM items') == (2,)
+
+
+class FakeItem:
+    """Lightweight stand-in for scene items, so that we can save
+    huge scenes quickly."""
+
+    TYPE = 'text'
+
+    def __init__(self, save_id):
+        self.save_id = save_id
+        self.dirty = True
+
+    def pos(self):
+        return QtCore.QPointF(1, 2)
+
+    def zValue(self):
+        return 0
+
+    def scale(self):
+        return 1
+
+    def rotation(self):
+        return 0
+
+    def flip(self):
+        return 1
+
+    def get_extra_save_data(self):
+        return {'text': 'foo'}
+
+
+def count_write_data_statements(filename, count):
+    items = [FakeItem(save_id=None) for i in range(count)]
+    scene = MagicMock()
+    scene.items_for_save.side_effect = lambda: iter(items)
+    io = SQLiteIO(filename, scene, create_new=True)
+    io.create_schema_on_new()
+    io.write_data()
+    for item in items:
+        item.dirty = True
+    del items[::10]
+
+    with patch.object(io, 'ex', wraps=io.ex) as ex_mock, \
+            patch.object(io, 'exmany', wraps=io.exmany) as exmany_mock:
+        io.write_data()
+    return ex_mock.call_count + exmany_mock.call_count
+
+
+def test_sqliteio_write_data_batches_statements(tmpdir):
+    small = count_write_data_statements(
+        os.path.join(tmpdir, 'small.bee'), 50)
+    big = count_write_data_statements(os.path.join(tmpdir, 'big.bee'), 500)
+    # Inserts, updates and deletes are batched, so the number of
+    # statements doesn't grow with the number of items:
+    assert big == small
+
+
+class CountingId(int):
+    """Save id that counts how often it gets compared or hashed."""
+
+    calls = 0
+
+    def __eq__(self, other):
+        CountingId.calls += 1
+        return int(self) == other
+
+    def __hash__(self):
+        CountingId.calls += 1
+        return int.__hash__(self)
+
+
+def test_sqliteio_write_data_bookkeeping_is_linear(tmpfile):
+    count = 2000
+    items = [FakeItem(save_id=None) for i in range(count)]
+    scene = MagicMock()
+    scene.items_for_save.side_effect = lambda: iter(items)
+    io = SQLiteIO(tmpfile, scene, create_new=True)
+    io.create_schema_on_new()
+    io.write_data()
+    for item in items:
+        item.save_id = CountingId(item.save_id)
+    del items[::10]
+
+    CountingId.calls = 0
+    io.write_data()
+    # Looking up ids in lists instead of sets would compare each id
+    # with about half of all others:
+    assert CountingId.calls < 10 * count
+    assert io.fetchone('SELECT COUNT(*) FROM items') == (len(items),)
+
+
 def test_sqliteio_write_removes_nonexisting_text_item(tmpfile, view):
     item = BeeTextItem('foo bar')
     item.setScale(1.3)
@@ -453,8 +819,9 @@ def test_sqliteio_read_reads_readonly_pixmap_item(tmpfile, view, imgdata3x3):
           'VALUES (?, ?, ?, ?, ?, ?, ?, ?) ',
           ('pixmap', 22.2, 33.3, 0.22, 3.4, 45, -1,
            json.dumps({'filename': 'bee.png'})))
-    io.ex('INSERT INTO sqlar (item_id, data) VALUES (?, ?)',
-          (1, imgdata3x3))
+    io.ex('UPDATE items SET blob=?', ('bee.png',))
+    io.ex('INSERT INTO sqlar (name, data) VALUES (?, ?)',
+          ('bee.png', imgdata3x3))
     io.connection.commit()
     del(io)
 
@@ -474,19 +841,377 @@ def test_sqliteio_read_reads_readonly_pixmap_item(tmpfile, view, imgdata3x3):
     assert item.filename == 'bee.png'
     assert item.width == 3
     assert item.height == 3
+    assert item.image_data == imgdata3x3
     assert view.scene.items_to_add.empty() is True
 
 
+def test_sqliteio_read_lazy_defers_pixmap(tmpfile, view, imgdata3x3):
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.create_schema_on_new()
+    io.ex('INSERT INTO items (type, x, y, z, scale, data, blob) '
+          'VALUES (?, ?, ?, ?, ?, ?, ?) ',
+          ('pixmap', 0, 0, 0, 1, json.dumps({'filename': 'bee.png'}),
+           'bee.png'))
+    io.ex('INSERT INTO sqlar (name, data, width, height) '
+          'VALUES (?, ?, ?, ?)',
+          ('bee.png', imgdata3x3, 3, 3))
+    io.connection.commit()
+    del(io)
+
+    io = SQLiteIO(tmpfile, view.scene, readonly=True, lazy=True)
+    io.read()
+    view.scene.add_queued_items()
+    item = view.scene.items()[0]
+    assert item.pixmap_loader is not None
+    assert item.width == 3
+    assert item.height == 3
+    assert item.pixmap().size() == QtCore.QSize(3, 3)
+    assert item.pixmap_loader is None
+
+
+def test_sqliteio_write_keeps_data_of_lazy_items(tmpfile, tmpdir, view):
+    path = os.path.join(os.path.dirname(__file__), '..', 'assets',
+                        'test3x3.jpg')
+    with open(path, 'rb') as f:
+        imgdata = f.read()
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.create_schema_on_new()
+    io.ex('INSERT INTO items (type, x, y, z, scale, data, blob) '
+          'VALUES (?, ?, ?, ?, ?, ?, ?) ',
+          ('pixmap', 0, 0, 0, 1, json.dumps({'filename': 'bee.jpg'}),
+           'bee.jpg'))
+    io.ex('INSERT INTO sqlar (name, data, width, height) '
+          'VALUES (?, ?, ?, ?)',
+          ('bee.jpg', imgdata, 3, 3))
+    io.connection.commit()
+    del(io)
+
+    io = SQLiteIO(tmpfile, view.scene, readonly=True, lazy=True)
+    io.read()
+    view.scene.add_queued_items()
+    item = view.scene.items()[0]
+    assert item.pixmap_loader is not None
+
+    newfile = os.path.join(tmpdir, 'new.bee')
+    io = SQLiteIO(newfile, view.scene, create_new=True)
+    io.write()
+    name, data = io.fetchone('SELECT name, data FROM sqlar')
+    assert name == blob_name(imgdata, 'jpg')
+    assert data == imgdata
+    assert item.pixmap_loader is not None
+
+
+def test_sqliteio_read_lazy_when_size_unknown(tmpfile, view, imgdata3x3):
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.create_schema_on_new()
+    io.ex('INSERT INTO items (type, x, y, z, scale, data, blob) '
+          'VALUES (?, ?, ?, ?, ?, ?, ?) ',
+          ('pixmap', 0, 0, 0, 1, json.dumps({'filename': 'bee.png'}),
+           'bee.png'))
+    io.ex('INSERT INTO sqlar (name, data) VALUES (?, ?)',
+          ('bee.png', imgdata3x3))
+    io.connection.commit()
+    del(io)
+
+    io = SQLiteIO(tmpfile, view.scene, readonly=True, lazy=True)
+    io.read()
+    view.scene.add_queued_items()
+    item = view.scene.items()[0]
+    assert item.pixmap_loader is None
+    assert item.width == 3
+    assert item.height == 3
+
+
+def test_sqliteio_read_pixmap_data(tmpfile, view):
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.create_schema_on_new()
+    io.ex('INSERT INTO items (type, blob) VALUES (?, ?)',
+          ('pixmap', 'bee.png'))
+    io.ex('INSERT INTO sqlar (name, data) VALUES (?, ?)',
+          ('bee.png', b'abc'))
+    io.connection.commit()
+    del(io)
+
+    loader = BlobReader(tmpfile).pixmap_loader('bee.png')
+    assert loader() == b'abc'
+
+
+def test_sqliteio_write_completes_blobs_of_migrated_file(
+        beefilename1item, view):
+    io = SQLiteIO(beefilename1item, view.scene)
+    io.read()
+    del(io)
+    view.scene.add_queued_items()
+    item = view.scene.items()[0]
+    item.setPos(20, 30)
+    io = SQLiteIO(beefilename1item, view.scene, create_new=False)
+    io.write()
+    assert io.fetchall('SELECT width, height FROM sqlar') == [(3, 3)]
+    del(io)
+
+    view.scene.clear()
+    io = SQLiteIO(beefilename1item, view.scene, readonly=True, lazy=True)
+    io.read()
+    view.scene.add_queued_items()
+    item = view.scene.items()[0]
+    assert item.pixmap_loader is not None
+    assert item.pixmap_bytes() == 0
+    assert item.width == 3
+    assert item.pos() == QtCore.QPointF(20, 30)
+
+
+def test_sqliteio_write_adds_mipmaps_to_migrated_blobs(tmpfile, view):
+    img = QtGui.QImage(1000, 500, QtGui.QImage.Format.Format_RGB32)
+    img.fill(QtGui.QColor(12, 34, 56))
+    item = BeePixmapItem(img)
+    view.scene.addItem(item)
+    view.scene.addItem(item.create_copy())
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.write()
+    # Make it look like the file has been written by an older version:
+    io.ex('UPDATE sqlar SET width=NULL, height=NULL')
+    io.ex('DELETE FROM mipmaps')
+    io.connection.commit()
+    del(io)
+
+    view.scene.clear()
+    io = SQLiteIO(tmpfile, view.scene)
+    io.read()
+    view.scene.add_queued_items()
+    io = SQLiteIO(tmpfile, view.scene, create_new=False)
+    with patch('beeref.items.BeePixmapItem.mipmaps_to_bytes',
+               autospec=True,
+               side_effect=BeePixmapItem.mipmaps_to_bytes) as mipmaps_mock:
+        io.write()
+    mipmaps_mock.assert_called_once()
+    assert io.fetchall('SELECT width, height FROM sqlar') == [(1000, 500)]
+    levels = io.fetchall('SELECT level FROM mipmaps ORDER BY level')
+    assert levels == [(1,)]
+
+
+def test_sqliteio_write_completes_blob_when_inserting_same_image(
+        tmpfile, view, imgdata3x3):
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.create_schema_on_new()
+    io.ex('INSERT INTO sqlar (name, data) VALUES (?, ?)',
+          (blob_name(imgdata3x3, 'png'), imgdata3x3))
+    io.connection.commit()
+    del(io)
+
+    item = BeePixmapItem(QtGui.QImage.fromData(imgdata3x3),
+                         image_data=imgdata3x3)
+    view.scene.addItem(item)
+    io = SQLiteIO(tmpfile, view.scene, create_new=False)
+    io.write()
+    assert io.fetchall('SELECT name, width, height FROM sqlar') == [
+        (blob_name(imgdata3x3, 'png'), 3, 3)]
+
+
+def test_sqliteio_read_sets_mipmap_loader(tmpfile, view, imgdata3x3):
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.create_schema_on_new()
+    io.ex('INSERT INTO items (type, x, y, z, scale, data, blob) '
+          'VALUES (?, ?, ?, ?, ?, ?, ?) ',
+          ('pixmap', 0, 0, 0, 1, json.dumps({'filename': 'bee.png'}),
+           'bee.png'))
+    io.ex('INSERT INTO sqlar (name, data, width, height) '
+          'VALUES (?, ?, ?, ?)',
+          ('bee.png', imgdata3x3, 3, 3))
+    io.ex('INSERT INTO mipmaps (blob, level, data) VALUES (?, ?, ?)',
+          ('bee.png', 1, b'abc'))
+    io.connection.commit()
+    del(io)
+
+    io = SQLiteIO(tmpfile, view.scene, readonly=True, lazy=True)
+    io.read()
+    view.scene.add_queued_items()
+    item = view.scene.items()[0]
+    assert item.mipmap_loader(1) == b'abc'
+    assert item.pixmap_loader is not None
+
+
+def test_sqliteio_read_mipmap_data(tmpfile, view):
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.create_schema_on_new()
+    io.ex('INSERT INTO sqlar (name, data) VALUES (?, ?)',
+          ('bee.png', b''))
+    io.ex('INSERT INTO mipmaps (blob, level, data) VALUES (?, ?, ?)',
+          ('bee.png', 1, b'abc'))
+    io.ex('INSERT INTO mipmaps (blob, level, data) VALUES (?, ?, ?)',
+          ('bee.png', 2, b'def'))
+    io.connection.commit()
+    del(io)
+
+    loader = BlobReader(tmpfile).mipmap_loader('bee.png')
+    assert loader(1) == b'abc'
+    assert loader(2) == b'def'
+    assert loader(3) is None
+
+
+def test_sqliteio_read_loaders_share_connection(tmpfile, view, imgdata3x3):
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.create_schema_on_new()
+    for name in ('bee.png', 'bee-0001.png'):
+        io.ex('INSERT INTO items (type, x, y, z, scale, data, blob) '
+              'VALUES (?, ?, ?, ?, ?, ?, ?) ',
+              ('pixmap', 0, 0, 0, 1, json.dumps({'filename': name}), name))
+        io.ex('INSERT INTO sqlar (name, data, width, height) '
+              'VALUES (?, ?, ?, ?)',
+              (name, imgdata3x3, 3, 3))
+    io.connection.commit()
+    del(io)
+
+    io = SQLiteIO(tmpfile, view.scene, readonly=True, lazy=True)
+    io.read()
+    del(io)
+    view.scene.add_queued_items()
+    with patch('beeref.fileio.sql.connect', wraps=sql.connect) as connect_mock:
+        for item in view.scene.items():
+            assert item.pixmap_loader() == imgdata3x3
+            assert item.mipmap_loader(1) is None
+        connect_mock.assert_called_once()
+
+
+def test_blob_reader_close_all_reopens_on_demand(tmpfile, view):
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.create_schema_on_new()
+    io.ex('INSERT INTO sqlar (name, data) VALUES (?, ?)',
+          ('bee.png', b'abc'))
+    io.connection.commit()
+    del(io)
+
+    reader = BlobReader(tmpfile)
+    other = BlobReader(tmpfile + '.other')
+    assert reader.read_pixmap_data('bee.png') == b'abc'
+    other.read_pixmap_data('bee.png')
+    other._connection = MagicMock()
+    BlobReader.close_all(tmpfile)
+    assert reader._connection is None
+    assert other._connection is not None
+    assert reader.read_pixmap_data('bee.png') == b'abc'
+
+
+def test_sqliteio_read_mipmap_data_when_file_borked(tmpfile, view):
+    with open(tmpfile, 'w') as f:
+        f.write('foobar')
+
+    assert BlobReader(tmpfile).read_mipmap_data('bee.png', 1) is None
+
+
+def test_sqliteio_read_pixmap_data_when_no_data(tmpfile, view):
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.create_schema_on_new()
+    io.connection.commit()
+    del(io)
+
+    assert BlobReader(tmpfile).read_pixmap_data('bee.png') is None
+
+
+def test_sqliteio_read_pixmap_data_when_file_borked(tmpfile, view):
+    with open(tmpfile, 'w') as f:
+        f.write('foobar')
+
+    assert BlobReader(tmpfile).read_pixmap_data('bee.png') is None
+
+
+def test_sqliteio_read_reads_many_pixmap_items_in_order(tmpfile, view):
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.create_schema_on_new()
+    for i in range(1, 11):
+        img = QtGui.QImage(i, i + 1, QtGui.QImage.Format.Format_RGB32)
+        barray = QtCore.QByteArray()
+        buffer = QtCore.QBuffer(barray)
+        buffer.open(QtCore.QIODevice.OpenModeFlag.WriteOnly)
+        img.save(buffer, 'PNG')
+        io.ex('INSERT INTO items (type, x, y, z, scale, data, blob) '
+              'VALUES (?, ?, ?, ?, ?, ?, ?) ',
+              ('pixmap', i, 0, 0, 1, json.dumps({'filename': f'{i}.png'}),
+               f'{i}.png'))
+        io.ex('INSERT INTO sqlar (name, data) VALUES (?, ?)',
+              (f'{i}.png', barray.data()))
+    io.ex('INSERT INTO items (type, x, data) VALUES (?, ?, ?) ',
+          ('text', 11, json.dumps({'text': 'foo'})))
+    io.connection.commit()
+    del(io)
+
+    io = SQLiteIO(tmpfile, view.scene, readonly=True)
+    io.read()
+    itemdata = queue2list(view.scene.items_to_add)
+    assert [d[0]['save_id'] for d in itemdata] == list(range(1, 12))
+    for i, (data, selected) in enumerate(itemdata[:10], start=1):
+        assert data['x'] == i
+        assert data['item'].width == i
+        assert data['item'].height == i + 1
+    assert 'item' not in itemdata[10][0]
+
+
+def test_sqliteio_read_decodes_duplicate_images_once(
+        tmpfile, view, imgdata3x3):
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.create_schema_on_new()
+    for i in range(3):
+        io.ex('INSERT INTO items (type, x, y, z, scale, data, blob) '
+              'VALUES (?, ?, ?, ?, ?, ?, ?) ',
+              ('pixmap', i, 0, 0, 1, json.dumps({'filename': 'bee.png'}),
+               'bee.png'))
+    io.ex('INSERT INTO sqlar (name, data) VALUES (?, ?)',
+          ('bee.png', imgdata3x3))
+    io.connection.commit()
+    del(io)
+
+    io = SQLiteIO(tmpfile, view.scene, readonly=True)
+    with patch('beeref.fileio.sql.decode_image',
+               wraps=sql.decode_image) as decode_mock:
+        io.read()
+    decode_mock.assert_called_once_with(imgdata3x3)
+    itemdata = queue2list(view.scene.items_to_add)
+    assert len(itemdata) == 3
+    for data, selected in itemdata:
+        assert data['item'].width == 3
+        assert data['item'].image_data == imgdata3x3
+
+
+@patch('beeref.fileio.sql.DECODE_AHEAD', 1)
+@patch('os.cpu_count', return_value=1)
+def test_sqliteio_read_limits_decodes_in_flight(
+        cpu_mock, tmpfile, view, imgdata3x3):
+    io = SQLiteIO(tmpfile, view.scene, create_new=True)
+    io.create_schema_on_new()
+    for i in range(5):
+        io.ex('INSERT INTO items (type, x, y, z, scale, data, blob) '
+              'VALUES (?, ?, ?, ?, ?, ?, ?) ',
+              ('pixmap', i, 0, 0, 1, json.dumps({'filename': f'{i}.png'}),
+               f'{i}.png'))
+        io.ex('INSERT INTO sqlar (name, data) VALUES (?, ?)',
+              (f'{i}.png', imgdata3x3))
+    io.connection.commit()
+    del(io)
+
+    io = SQLiteIO(tmpfile, view.scene, readonly=True)
+    decoded = []
+    with patch('beeref.fileio.sql.decode_image',
+               wraps=sql.decode_image) as decode_mock:
+        with patch.object(view.scene, 'add_item_later',
+                          side_effect=lambda d: decoded.append(
+                              decode_mock.call_count)):
+            io.read()
+    assert decode_mock.call_count == 5
+    assert len(decoded) == 5
+    for i, count in enumerate(decoded, start=1):
+        assert count <= i + 1
+
+
 def test_sqliteio_read_updates_progress(tmpfile, view):
     worker = MagicMock(canceled=False)
     io = SQLiteIO(tmpfile, view.scene, create_new=True,
                   worker=worker)
 
     io.create_schema_on_new()
-    io.ex('INSERT INTO items (type, x, y, z, scale, data) '
-          'VALUES (?, ?, ?, ?, ?, ?) ',
-          ('pixmap', 0, 0, 0, 1, json.dumps({'filename': 'bee.png'})))
-    io.ex('INSERT INTO sqlar (item_id, data) VALUES (?, ?)', (1, b''))
+    io.ex('INSERT INTO items (type, x, y, z, scale, data, blob) '
+          'VALUES (?, ?, ?, ?, ?, ?, ?) ',
+          ('pixmap', 0, 0, 0, 1, json.dumps({'filename': 'bee.png'}),
+           'bee.png'))
+    io.ex('INSERT INTO sqlar (name, data) VALUES (?, ?)', ('bee.png', b''))
     io.connection.commit()
 
     io.read()
@@ -499,14 +1224,17 @@ def test_sqliteio_read_canceled(tmpfile, view):
     worker = MagicMock(canceled=True)
     io = SQLiteIO(tmpfile, view.scene, create_new=True, worker=worker)
     io.create_schema_on_new()
-    io.ex('INSERT INTO items (type, x, y, z, scale, data) '
-          'VALUES (?, ?, ?, ?, ?, ?) ',
-          ('pixmap', 0, 0, 0, 1, json.dumps({'filename': 'bee.png'})))
-    io.ex('INSERT INTO sqlar (item_id, data) VALUES (?, ?)', (1, b''))
-    io.ex('INSERT INTO items (type, x, y, z, scale, data) '
-          'VALUES (?, ?, ?, ?, ?, ?) ',
-          ('pixmap', 50, 50, 0, 1, json.dumps({'filename': 'bee2.png'})))
-    io.ex('INSERT INTO sqlar (item_id, data) VALUES (?, ?)', (2, b''))
+    io.ex('INSERT INTO items (type, x, y, z, scale, data, blob) '
+          'VALUES (?, ?, ?, ?, ?, ?, ?) ',
+          ('pixmap', 0, 0, 0, 1, json.dumps({'filename': 'bee.png'}),
+           'bee.png'))
+    io.ex('INSERT INTO sqlar (name, data) VALUES (?, ?)', ('bee.png', b''))
+    io.ex('INSERT INTO items (type, x, y, z, scale, data, blob) '
+          'VALUES (?, ?, ?, ?, ?, ?, ?) ',
+          ('pixmap', 50, 50, 0, 1, json.dumps({'filename': 'bee2.png'}),
+           'bee2.png'))
+    io.ex('INSERT INTO sqlar (name, data) VALUES (?, ?)',
+          ('bee2.png', b''))
     io.connection.commit()
 
     io.read()
@@ -1,3 +1,5 @@
+import os.path
+
 import pytest
 from unittest.mock import patch, MagicMock
 
@@ -5,6 +7,8 @@ from PyQt6 import QtCore, QtGui, QtWidgets
 from PyQt6.QtCore import Qt
 
 from beeref.items import BeePixmapItem, item_registry
+from beeref.pixmapstore import key_from_data, pixmap_store
+from beeref.spillstore import spill_store
 
 
 def test_in_item_registry():
@@ -59,6 +63,12 @@ def test_set_crop(qapp, item):
     item.prepareGeometryChange.assert_called_once_with()
 
 
+def test_set_crop_marks_item_dirty(qapp, item):
+    item.dirty = False
+    item.crop = QtCore.QRectF(10, 20, 30, 40)
+    assert item.dirty is True
+
+
 def test_bounding_rect_unselected(qapp, imgfilename3x3):
     item = BeePixmapItem(QtGui.QImage(imgfilename3x3))
     item.crop = QtCore.QRectF(1, 1, 2, 2)
@@ -93,6 +103,462 @@ def test_pixmap_from_bytes(qapp, item, imgfilename3x3):
     assert item.width == 3
     assert item.height == 3
     assert item.crop == QtCore.QRectF(0, 0, 3, 3)
+    assert item.image_data == imgdata
+
+
+def test_pixmap_to_bytes_returns_original_data(qapp, imgfilename3x3):
+    item = BeePixmapItem(QtGui.QImage(imgfilename3x3), image_data=b'abc')
+    assert item.pixmap_to_bytes() == b'abc'
+
+
+def test_pixmap_to_bytes_when_deferred(qapp, item, imgfilename3x3):
+    path = os.path.join(os.path.dirname(__file__), '..', 'assets',
+                        'test3x3.jpg')
+    with open(path, 'rb') as f:
+        data = f.read()
+    item.defer_pixmap(QtCore.QSize(3, 3), lambda: data)
+    assert item.pixmap_to_bytes() == data
+    assert item.pixmap_loader is not None
+    assert item.pixmap_bytes() == 0
+    assert item.image_format(item.pixmap_to_bytes()) == 'jpg'
+
+
+def test_image_format_when_no_original_data(qapp, item):
+    assert item.image_format() == 'png'
+
+
+@pytest.mark.parametrize('fname,expected',
+                         [('test3x3.png', 'png'),
+                          ('test3x3.jpg', 'jpg')])
+def test_image_format_with_original_data(fname, expected, qapp):
+    path = os.path.join(os.path.dirname(__file__), '..', 'assets', fname)
+    with open(path, 'rb') as f:
+        data = f.read()
+    item = BeePixmapItem(QtGui.QImage(path), image_data=data)
+    assert item.image_format() == expected
+
+
+def test_image_format_with_given_data(qapp, item, imgdata3x3):
+    item.image_data = b'foo'
+    assert item.image_format(imgdata3x3) == 'png'
+
+
+def test_image_format_with_unknown_data(qapp, item):
+    item.image_data = b'foo'
+    assert item.image_format() == 'png'
+
+
+def test_init_shares_pixmap_of_same_image(qapp, imgfilename3x3):
+    item1 = BeePixmapItem(QtGui.QImage(imgfilename3x3))
+    item2 = BeePixmapItem(QtGui.QImage(imgfilename3x3))
+    assert item1.pixmap_key is not None
+    assert item1.pixmap_key == item2.pixmap_key
+    assert item1.pixmap().cacheKey() == item2.pixmap().cacheKey()
+
+
+def test_init_shares_pixmap_of_same_image_data(qapp, imgdata3x3):
+    img = QtGui.QImage.fromData(imgdata3x3)
+    item1 = BeePixmapItem(img, image_data=imgdata3x3)
+    item2 = BeePixmapItem(img, image_data=imgdata3x3)
+    assert item1.pixmap_key == key_from_data(imgdata3x3)
+    assert item1.pixmap().cacheKey() == item2.pixmap().cacheKey()
+
+
+def test_pixmap_from_bytes_shares_pixmap(qapp, imgdata3x3):
+    item1 = BeePixmapItem(QtGui.QImage())
+    item1.pixmap_from_bytes(imgdata3x3)
+    refs = pixmap_store.refcount(item1.pixmap_key)
+    item2 = BeePixmapItem(QtGui.QImage())
+    item2.pixmap_from_bytes(imgdata3x3)
+    assert item1.pixmap().cacheKey() == item2.pixmap().cacheKey()
+    assert pixmap_store.refcount(item1.pixmap_key) == refs + 1
+
+
+def test_load_deferred_pixmap_shares_pixmap(qapp, imgdata3x3):
+    item1 = BeePixmapItem(QtGui.QImage())
+    item1.pixmap_from_bytes(imgdata3x3)
+    item2 = BeePixmapItem(QtGui.QImage())
+    item2.defer_pixmap(QtCore.QSize(3, 3), MagicMock(return_value=imgdata3x3))
+    assert item1.pixmap().cacheKey() == item2.pixmap().cacheKey()
+    assert item2.pixmap_key == key_from_data(imgdata3x3)
+
+
+def test_set_pixmap_releases_stored_pixmap(qapp, imgdata3x3):
+    item = BeePixmapItem(QtGui.QImage())
+    item.pixmap_from_bytes(imgdata3x3)
+    key = item.pixmap_key
+    refs = pixmap_store.refcount(key)
+    item.setPixmap(QtGui.QPixmap())
+    assert item.pixmap_key is None
+    assert pixmap_store.refcount(key) == refs - 1
+
+
+def test_garbage_collected_item_releases_stored_pixmap(qapp, imgdata3x3):
+    item = BeePixmapItem(QtGui.QImage())
+    item.pixmap_from_bytes(imgdata3x3)
+    key = item.pixmap_key
+    refs = pixmap_store.refcount(key)
+    del item
+    assert pixmap_store.refcount(key) == refs - 1
+
+
+def test_set_pixmap_discards_original_data(qapp, item, imgfilename3x3):
+    item.image_data = b'abc'
+    item.setPixmap(QtGui.QPixmap(imgfilename3x3))
+    assert item.image_data is None
+
+
+def test_defer_pixmap(qapp, item, imgdata3x3):
+    loader = MagicMock(return_value=imgdata3x3)
+    item.defer_pixmap(QtCore.QSize(3, 3), loader)
+    assert item.width == 3
+    assert item.height == 3
+    assert item.crop == QtCore.QRectF(0, 0, 3, 3)
+    assert str(item) == 'Image "None" 3 x 3'
+    loader.assert_not_called()
+
+
+def test_pixmap_loads_deferred_pixmap(qapp, item, imgdata3x3):
+    loader = MagicMock(return_value=imgdata3x3)
+    item.defer_pixmap(QtCore.QSize(3, 3), loader)
+    item.crop = QtCore.QRectF(1, 1, 2, 2)
+    assert item.pixmap().size() == QtCore.QSize(3, 3)
+    assert item.pixmap_loader is None
+    assert item.image_data == imgdata3x3
+    assert item.crop == QtCore.QRectF(1, 1, 2, 2)
+    item.pixmap()
+    loader.assert_called_once_with()
+
+
+def test_load_deferred_pixmap_when_loading_fails(qapp, item):
+    loader = MagicMock(return_value=None)
+    item.defer_pixmap(QtCore.QSize(3, 3), loader)
+    item.load_deferred_pixmap()
+    assert item.pixmap().isNull() is True
+    assert item.pixmap_loader is None
+    loader.assert_called_once_with()
+
+
+def test_set_pixmap_discards_deferred_pixmap(qapp, item, imgfilename3x3):
+    loader = MagicMock()
+    item.defer_pixmap(QtCore.QSize(5, 5), loader)
+    item.setPixmap(QtGui.QPixmap(imgfilename3x3))
+    assert item.pixmap_size() == QtCore.QSize(3, 3)
+    assert item.crop == QtCore.QRectF(0, 0, 3, 3)
+    loader.assert_not_called()
+
+
+def test_set_pixmap_discards_mipmaps(qapp, item, imgfilename3x3):
+    item.mipmap_loader = MagicMock()
+    item.mipmaps = {1: QtGui.QPixmap()}
+    item.setPixmap(QtGui.QPixmap(imgfilename3x3))
+    assert item.mipmap_loader is None
+    assert item.mipmaps == {}
+
+
+def test_pixmap_bytes(qapp):
+    item = BeePixmapItem(
+        QtGui.QImage(20, 10, QtGui.QImage.Format.Format_RGB32))
+    assert item.pixmap_bytes() == 800
+
+
+def png_data(img):
+    barray = QtCore.QByteArray()
+    buffer = QtCore.QBuffer(barray)
+    buffer.open(QtCore.QIODevice.OpenModeFlag.WriteOnly)
+    img.save(buffer, 'PNG')
+    return barray.data()
+
+
+def test_set_proxy(qapp, item):
+    img = QtGui.QImage(1200, 600, QtGui.QImage.Format.Format_RGB32)
+    data = png_data(img)
+    item.set_proxy(img.scaled(300, 150), data)
+    assert item.width == 1200
+    assert item.height == 600
+    assert item.crop == QtCore.QRectF(0, 0, 1200, 600)
+    assert item.image_data == data
+    assert item.pixmap_bytes() == 0
+    assert item.get_mipmap(2).size() == QtCore.QSize(300, 150)
+    assert item.get_mipmap(1).size() == QtCore.QSize(600, 300)
+    assert item.pixmap_bytes() > 0
+
+
+def test_set_proxy_when_not_scaled_down(qapp, item):
+    img = QtGui.QImage(300, 150, QtGui.QImage.Format.Format_RGB32)
+    data = png_data(img)
+    item.set_proxy(img, data)
+    assert item.pixmap_loader is None
+    assert item.pixmap().size() == QtCore.QSize(300, 150)
+    assert item.image_data == data
+    assert item.mipmaps == {}
+
+
+def test_pixmap_bytes_when_deferred(qapp, item):
+    item.defer_pixmap(QtCore.QSize(3, 3), MagicMock())
+    assert item.pixmap_bytes() == 0
+
+
+def test_unload_pixmap(qapp, imgfilename3x3, imgdata3x3):
+    item = BeePixmapItem(QtGui.QImage(imgfilename3x3),
+                         image_data=imgdata3x3)
+    key = item.pixmap_key
+    refs = pixmap_store.refcount(key)
+    item.crop = QtCore.QRectF(1, 1, 2, 2)
+    mipmaps = {1: QtGui.QPixmap()}
+    item.mipmaps = mipmaps
+    assert item.unload_pixmap() is True
+    assert item.pixmap_bytes() == 0
+    assert item.pixmap_key is None
+    assert pixmap_store.refcount(key) == refs - 1
+    assert item.pixmap_size() == QtCore.QSize(3, 3)
+    assert item.crop == QtCore.QRectF(1, 1, 2, 2)
+    assert item.mipmaps is mipmaps
+    assert item.image_data == imgdata3x3
+
+    assert item.pixmap().size() == QtCore.QSize(3, 3)
+    assert item.pixmap_key == key
+    assert item.crop == QtCore.QRectF(1, 1, 2, 2)
+
+
+def test_unload_pixmap_without_original_data(qapp, imgfilename3x3):
+    item = BeePixmapItem(QtGui.QImage(imgfilename3x3))
+    img = item.pixmap().toImage()
+    assert item.unload_pixmap() is True
+    assert item.image_data is not None
+    assert item.pixmap().toImage() == img
+
+
+def test_unload_pixmap_when_not_loaded(qapp, item):
+    item.defer_pixmap(QtCore.QSize(3, 3), MagicMock())
+    assert item.unload_pixmap() is False
+
+
+def test_unload_pixmap_when_in_crop_mode(qapp, imgfilename3x3):
+    item = BeePixmapItem(QtGui.QImage(imgfilename3x3))
+    item.crop_mode = True
+    assert item.unload_pixmap() is False
+    assert item.pixmap_bytes() > 0
+
+
+def test_memory_bytes(qapp):
+    item = BeePixmapItem(
+        QtGui.QImage(20, 10, QtGui.QImage.Format.Format_RGB32))
+    item.image_data = b'abc'
+    item.mipmaps = {1: QtGui.QPixmap(10, 5)}
+    depth = item.mipmaps[1].depth()
+    assert item.memory_bytes() == 800 + 10 * 5 * depth // 8 + 3
+
+
+def test_spill_pixmap(qapp, imgfilename3x3, imgdata3x3):
+    item = BeePixmapItem(QtGui.QImage(imgfilename3x3),
+                         image_data=imgdata3x3)
+    key = item.pixmap_key
+    refs = pixmap_store.refcount(key)
+    item.crop = QtCore.QRectF(1, 1, 2, 2)
+    item.mipmaps = {1: QtGui.QPixmap(2, 2)}
+    freed = item.memory_bytes()
+    with patch('beeref.items.spill_store') as store_mock:
+        store_mock.put.return_value = 'abc'
+        store_mock.get.return_value = imgdata3x3
+        assert item.spill_pixmap() == freed
+        store_mock.put.assert_called_once_with(imgdata3x3)
+        assert item.memory_bytes() == 0
+        assert item.pixmap_key is None
+        assert pixmap_store.refcount(key) == refs - 1
+        assert item.pixmap_size() == QtCore.QSize(3, 3)
+        assert item.crop == QtCore.QRectF(1, 1, 2, 2)
+
+        # Spilling again doesn't do anything:
+        assert item.spill_pixmap() == 0
+        store_mock.put.assert_called_once()
+
+        assert item.pixmap().size() == QtCore.QSize(3, 3)
+        store_mock.get.assert_called_once_with('abc')
+        store_mock.release.assert_called_once_with('abc')
+        assert item.image_data == imgdata3x3
+
+
+def test_spill_pixmap_uses_spill_store(qapp, imgfilename3x3):
+    item = BeePixmapItem(QtGui.QImage(imgfilename3x3))
+    img = item.pixmap().toImage()
+    count = len(spill_store)
+    assert item.spill_pixmap() > 0
+    assert len(spill_store) == count + 1
+    assert item.pixmap().toImage() == img
+    assert len(spill_store) == count
+
+
+def test_spill_pixmap_released_when_item_deleted(qapp, imgfilename3x3):
+    item = BeePixmapItem(QtGui.QImage(imgfilename3x3))
+    count = len(spill_store)
+    item.spill_pixmap()
+    assert len(spill_store) == count + 1
+    del item
+    assert len(spill_store) == count
+
+
+def test_spill_pixmap_when_empty(qapp, item):
+    assert item.spill_pixmap() == 0
+
+
+def test_spill_pixmap_when_in_crop_mode(qapp, imgfilename3x3):
+    item = BeePixmapItem(QtGui.QImage(imgfilename3x3))
+    item.crop_mode = True
+    assert item.spill_pixmap() == 0
+    assert item.pixmap_bytes() > 0
+
+
+def test_detach_from_file(qapp, item, imgdata3x3):
+    loader = MagicMock(return_value=imgdata3x3)
+    item.defer_pixmap(QtCore.QSize(3, 3), loader)
+    item.mipmap_loader = MagicMock()
+    item.detach_from_file()
+    loader.assert_called_once_with()
+    assert item.mipmap_loader is None
+    # Only the compressed data is kept:
+    assert item.pixmap_bytes() == 0
+    assert item.image_data == imgdata3x3
+    assert item.pixmap_to_bytes() == imgdata3x3
+    assert item.pixmap().size() == QtCore.QSize(3, 3)
+    loader.assert_called_once_with()
+
+
+def test_detach_from_file_when_loaded(qapp, imgfilename3x3):
+    item = BeePixmapItem(QtGui.QImage(imgfilename3x3))
+    item.mipmap_loader = MagicMock()
+    item.detach_from_file()
+    assert item.pixmap_loader is None
+    assert item.mipmap_loader is None
+    assert item.pixmap_bytes() > 0
+
+
+def test_detach_from_file_when_spilled(qapp, imgfilename3x3):
+    item = BeePixmapItem(QtGui.QImage(imgfilename3x3))
+    item.spill_pixmap()
+    item.detach_from_file()
+    assert item.image_data is None
+    assert item.pixmap().size() == QtCore.QSize(3, 3)
+
+
+@pytest.mark.parametrize('width,height,expected',
+                         [(3, 3, 0),
+                          (511, 200, 0),
+                          (512, 200, 1),
+                          (200, 1023, 1),
+                          (1024, 1024, 2),
+                          (8000, 6000, 4)])
+def test_max_mipmap_level(width, height, expected, qapp, item):
+    item.defer_pixmap(QtCore.QSize(width, height), MagicMock())
+    assert item.max_mipmap_level() == expected
+
+
+@pytest.mark.parametrize('scale,expected',
+                         [(2, 0),
+                          (1, 0),
+                          (0.6, 0),
+                          (0.5, 1),
+                          (0.3, 1),
+                          (0.25, 2),
+                          (0.01, 3),
+                          (0, 0)])
+def test_mipmap_level(scale, expected, qapp, item):
+    item.defer_pixmap(QtCore.QSize(2048, 2048), MagicMock())
+    assert item.mipmap_level(scale) == expected
+
+
+def test_get_mipmap_level_zero(qapp, item):
+    assert item.get_mipmap(0).cacheKey() == item.pixmap().cacheKey()
+
+
+def test_get_mipmap_generates_levels(qapp):
+    item = BeePixmapItem(
+        QtGui.QImage(1025, 600, QtGui.QImage.Format.Format_RGB32))
+    assert item.get_mipmap(2).size() == QtCore.QSize(257, 150)
+    assert item.mipmaps[1].size() == QtCore.QSize(513, 300)
+    assert item.mipmaps[2].size() == QtCore.QSize(257, 150)
+
+
+def test_get_mipmap_uses_loader(qapp, item, imgdata3x3):
+    item.mipmap_loader = MagicMock(return_value=imgdata3x3)
+    item.pixmap_loader = MagicMock()
+    assert item.get_mipmap(1).size() == QtCore.QSize(3, 3)
+    item.get_mipmap(1)
+    item.mipmap_loader.assert_called_once_with(1)
+    item.pixmap_loader.assert_not_called()
+
+
+def test_get_mipmap_when_loader_has_no_data(qapp):
+    item = BeePixmapItem(
+        QtGui.QImage(600, 600, QtGui.QImage.Format.Format_RGB32))
+    item.mipmap_loader = MagicMock(return_value=None)
+    assert item.get_mipmap(1).size() == QtCore.QSize(300, 300)
+    item.mipmap_loader.assert_called_once_with(1)
+
+
+def test_mipmaps_to_bytes(qapp):
+    img = QtGui.QImage(1024, 600, QtGui.QImage.Format.Format_RGB32)
+    img.fill(QtGui.QColor(255, 0, 0))
+    item = BeePixmapItem(img)
+    result = item.mipmaps_to_bytes()
+    assert [level for level, data in result] == [1, 2]
+    assert result[0][1].startswith(b'\xff\xd8')
+    assert result[1][1].startswith(b'\xff\xd8')
+
+
+def test_mipmaps_to_bytes_with_alpha(qapp):
+    img = QtGui.QImage(600, 600, QtGui.QImage.Format.Format_ARGB32)
+    img.fill(QtGui.QColor(255, 0, 0, 100))
+    item = BeePixmapItem(img)
+    result = item.mipmaps_to_bytes()
+    assert len(result) == 1
+    assert result[0][1].startswith(b'\x89PNG')
+
+
+def test_mipmaps_to_bytes_uses_existing_mipmaps(qapp):
+    img = QtGui.QImage(1024, 600, QtGui.QImage.Format.Format_RGB32)
+    item = BeePixmapItem(img)
+    level1 = QtGui.QImage(512, 300, QtGui.QImage.Format.Format_ARGB32)
+    level1.fill(QtGui.QColor(255, 0, 0, 100))
+    item.mipmaps[1] = QtGui.QPixmap.fromImage(level1)
+    result = item.mipmaps_to_bytes()
+    assert result[0][1].startswith(b'\x89PNG')
+    assert QtGui.QImage.fromData(result[1][1]).size() == QtCore.QSize(
+        256, 150)
+    assert 2 not in item.mipmaps
+
+
+def test_mipmaps_to_bytes_when_deferred(qapp, item):
+    img = QtGui.QImage(1024, 600, QtGui.QImage.Format.Format_RGB32)
+    data = png_data(img)
+    item.defer_pixmap(img.size(), lambda: data)
+    level1 = png_data(img.scaled(512, 300))
+    item.mipmap_loader = MagicMock(side_effect=[level1, None])
+    result = item.mipmaps_to_bytes()
+    assert result[0] == (1, level1)
+    assert result[1][0] == 2
+    assert QtGui.QImage.fromData(result[1][1]).size() == QtCore.QSize(
+        256, 150)
+    assert item.pixmap_loader is not None
+    assert item.pixmap_bytes() == 0
+    assert item.mipmaps == {}
+
+
+def test_mipmaps_to_bytes_of_proxy(qapp, item):
+    img = QtGui.QImage(1200, 600, QtGui.QImage.Format.Format_RGB32)
+    item.set_proxy(img.scaled(300, 150), png_data(img))
+    result = item.mipmaps_to_bytes()
+    assert [level for level, data in result] == [1, 2]
+    assert QtGui.QImage.fromData(result[0][1]).size() == QtCore.QSize(
+        600, 300)
+    assert QtGui.QImage.fromData(result[1][1]).size() == QtCore.QSize(
+        300, 150)
+    assert item.pixmap_bytes() == 0
+    assert list(item.mipmaps) == [2]
+
+
+def test_mipmaps_to_bytes_small_image(qapp, item):
+    assert item.mipmaps_to_bytes() == []
 
 
 def test_has_selection_outline_when_not_selected(view, item):
@@ -192,8 +658,11 @@ def test_create_copy(qapp, imgfilename3x3):
     item.setScale(2.2)
     item.crop = QtCore.QRectF(10, 20, 30, 40)
 
+    item.image_data = b'abc'
+
     copy = item.create_copy()
-    assert copy.pixmap_to_bytes() == item.pixmap_to_bytes()
+    assert copy.pixmap().toImage() == item.pixmap().toImage()
+    assert copy.image_data == b'abc'
     assert copy.filename == 'foo.png'
     assert copy.pos() == QtCore.QPointF(20, 30)
     assert copy.rotation() == 33
@@ -203,6 +672,24 @@ def test_create_copy(qapp, imgfilename3x3):
     assert copy.crop == QtCore.QRectF(10, 20, 30, 40)
 
 
+def test_create_copy_shares_pixmap(qapp, imgfilename3x3):
+    item = BeePixmapItem(QtGui.QImage(imgfilename3x3), 'foo.png')
+    refs = pixmap_store.refcount(item.pixmap_key)
+    copy = item.create_copy()
+    assert copy.pixmap_key == item.pixmap_key
+    assert copy.pixmap().cacheKey() == item.pixmap().cacheKey()
+    assert pixmap_store.refcount(item.pixmap_key) == refs + 1
+
+
+def test_create_copy_keeps_mipmaps(qapp):
+    item = BeePixmapItem(
+        QtGui.QImage(600, 600, QtGui.QImage.Format.Format_RGB32))
+    mipmap = item.get_mipmap(1)
+    copy = item.create_copy()
+    assert copy.mipmaps[1].cacheKey() == mipmap.cacheKey()
+    assert copy.mipmaps is not item.mipmaps
+
+
 def test_copy_to_clipboard(qapp, imgfilename3x3):
     clipboard = QtWidgets.QApplication.clipboard()
     item = BeePixmapItem(QtGui.QImage(imgfilename3x3), 'foo.png')
@@ -285,6 +772,38 @@ def test_paint_when_crop_mode(qapp, item):
     painter.drawPixmap.assert_called_with(0, 0, item.pixmap())
 
 
+def test_paint_uses_mipmap_when_zoomed_out(view):
+    item = BeePixmapItem(
+        QtGui.QImage(1024, 512, QtGui.QImage.Format.Format_RGB32))
+    view.scene.addItem(item)
+    view.scale(0.3, 0.3)
+    item.paint_selectable = MagicMock()
+    item.crop = QtCore.QRectF(100, 50, 400, 200)
+    painter = MagicMock()
+    item.paint(painter, None, None)
+    painter.drawPixmap.assert_called_once_with(
+        QtCore.QRectF(100, 50, 400, 200),
+        item.mipmaps[1],
+        QtCore.QRectF(50, 25, 200, 100))
+
+
+def test_paint_uses_full_pixmap_when_zoomed_in(view):
+    item = BeePixmapItem(
+        QtGui.QImage(1024, 512, QtGui.QImage.Format.Format_RGB32))
+    view.scene.addItem(item)
+    view.scale(0.3, 0.3)
+    item.setScale(4)
+    item.paint_selectable = MagicMock()
+    painter = MagicMock()
+    item.paint(painter, None, None)
+    painter.drawPixmap.assert_called_once()
+    args = painter.drawPixmap.call_args[0]
+    assert args[0] == QtCore.QRectF(0, 0, 1024, 512)
+    assert args[1].cacheKey() == item.pixmap().cacheKey()
+    assert args[2] == QtCore.QRectF(0, 0, 1024, 512)
+    assert item.mipmaps == {}
+
+
 def test_enter_crop_mode(view, item):
     view.scene.addItem(item)
     item.crop = QtCore.QRectF(10, 20, 30, 40)
@@ -1,5 +1,7 @@
 from unittest.mock import patch, MagicMock
 
+import pytest
+
 from PyQt6 import QtCore, QtWidgets
 from PyQt6.QtCore import Qt
 
@@ -20,9 +22,31 @@ def test_init(selectable_mock, qapp):
     assert item.toPlainText() == 'foo bar'
     assert item.is_editable is True
     assert item.edit_mode is False
+    assert item.dirty is True
     selectable_mock.assert_called_once()
 
 
+def test_changing_text_marks_item_dirty(qapp):
+    item = BeeTextItem('foo bar')
+    item.dirty = False
+    item.setPlainText('baz')
+    assert item.dirty is True
+
+
+@pytest.mark.parametrize('func,args',
+                         [('setPos', (QtCore.QPointF(3, 4),)),
+                          ('setPos', (3, 4)),
+                          ('setScale', (2,)),
+                          ('setRotation', (45,)),
+                          ('setZValue', (0.5,)),
+                          ('do_flip', ())])
+def test_transforms_mark_item_dirty(func, args, qapp):
+    item = BeeTextItem('foo bar')
+    item.dirty = False
+    getattr(item, func)(*args)
+    assert item.dirty is True
+
+
 def test_set_pos_center(qapp):
     item = BeeTextItem('foo bar')
     with patch.object(item, 'bounding_rect_unselected',
@@ -118,6 +118,35 @@ def test_do_flip_vertical_anchor(qapp, item):
     assert item.pos() == QtCore.QPointF(0, 200)
 
 
+def test_transform_state(qapp, item):
+    item.setPos(5, 6)
+    item.setScale(2)
+    item.setRotation(90)
+    item.do_flip()
+    x, y, scale, rotation, flip = item.transform_state()
+    assert (x, y) == (item.pos().x(), item.pos().y())
+    assert scale == 2
+    assert rotation == 90
+    assert flip == -1
+
+
+def test_set_transform_state(qapp, item):
+    item.set_transform_state(5, 6, 2, 90, -1)
+    assert item.pos() == QtCore.QPointF(5, 6)
+    assert item.scale() == 2
+    assert item.rotation() == 90
+    assert item.flip() == -1
+
+
+def test_set_transform_state_only_sets_changed_values(qapp, item):
+    item.prepareGeometryChange = MagicMock()
+    item.setTransform = MagicMock()
+    item.set_transform_state(5, 6, 1, 0, 1)
+    assert item.pos() == QtCore.QPointF(5, 6)
+    item.prepareGeometryChange.assert_not_called()
+    item.setTransform.assert_not_called()
+
+
 def test_width(view, item):
     view.scene.addItem(item)
     item.setPos(5, 5)
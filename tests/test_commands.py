@@ -85,6 +85,21 @@ def test_delete_items(view):
     assert item2.isSelected() is True
 
 
+def test_delete_items_reads_deferred_pixmaps(view, imgdata3x3):
+    loader = MagicMock(return_value=imgdata3x3)
+    item = BeePixmapItem(QtGui.QImage())
+    item.defer_pixmap(QtCore.QSize(3, 3), loader)
+    view.scene.addItem(item)
+    command = commands.DeleteItems(view.scene, [item])
+    item.mipmap_loader = MagicMock()
+    command.redo()
+    loader.assert_called_once_with()
+    assert item.mipmap_loader is None
+    # The pixmap doesn't get decoded until it's needed:
+    assert item.pixmap_bytes() == 0
+    assert item.pixmap().size() == QtCore.QSize(3, 3)
+
+
 def test_move_items_by(qapp):
     item1 = BeePixmapItem(QtGui.QImage())
     item1.setPos(0, 0)
@@ -124,6 +139,19 @@ def test_move_items_by_ignore_first_redo(qapp):
     assert item2.pos().y() == 140
 
 
+def test_move_items_by_marks_items_dirty(qapp):
+    item = BeePixmapItem(QtGui.QImage())
+    command = commands.MoveItemsBy([item],
+                                   QtCore.QPointF(50, 100),
+                                   ignore_first_redo=True)
+    item.dirty = False
+    command.redo()
+    assert item.dirty is True
+    item.dirty = False
+    command.undo()
+    assert item.dirty is True
+
+
 def test_scale_items_by(view):
     item1 = BeePixmapItem(QtGui.QImage())
     item1.setScale(1)
@@ -474,3 +502,158 @@ def test_crop_item(item):
     command.undo()
     assert item.crop == QtCore.QRectF(0, 0, 100, 80)
     assert item.pos() == QtCore.QPointF(0, 0)
+
+
+def test_crop_item_marks_item_dirty(item):
+    command = commands.CropItem(item, QtCore.QRectF(10, 20, 30, 40))
+    item.dirty = False
+    command.redo()
+    assert item.dirty is True
+    item.dirty = False
+    command.undo()
+    assert item.dirty is True
+
+
+def test_pack_and_apply_transforms(qapp):
+    item1 = BeePixmapItem(QtGui.QImage())
+    item1.setPos(1, 2)
+    item1.setScale(3)
+    item2 = BeeTextItem('foo')
+    item2.setRotation(90)
+    item2.do_flip()
+    values = commands.pack_transforms([item1, item2])
+    assert len(values) == 10
+    assert values.typecode == 'd'
+
+    item3 = BeePixmapItem(QtGui.QImage())
+    item4 = BeeTextItem('bar')
+    commands.apply_transforms([item3, item4], values)
+    assert item3.transform_state() == item1.transform_state()
+    assert item4.transform_state() == item2.transform_state()
+
+
+def test_transform_items_redo_again_doesnt_recalculate(view):
+    item = BeePixmapItem(QtGui.QImage())
+    view.scene.addItem(item)
+    command = commands.ArrangeItems(
+        view.scene, [item], [QtCore.QPointF(10, 20)])
+    command.redo()
+    assert item.pos() == QtCore.QPointF(10, 20)
+    command.undo()
+    assert item.pos() == QtCore.QPointF(0, 0)
+    command.transform = MagicMock()
+    command.redo()
+    command.transform.assert_not_called()
+    assert item.pos() == QtCore.QPointF(10, 20)
+
+
+def test_transform_items_suspends_index(view):
+    items = []
+    for i in range(3):
+        item = BeePixmapItem(QtGui.QImage())
+        view.scene.addItem(item)
+        items.append(item)
+    command = commands.NormalizeItems(items, [2, 2, 2])
+    with patch.object(view.scene, 'bulk_transform',
+                      wraps=view.scene.bulk_transform) as bulk_mock:
+        command.redo()
+        bulk_mock.assert_called_once_with(items)
+        command.undo()
+        assert bulk_mock.call_count == 2
+
+
+def test_reset_transforms_redo_again_resets_crop(qapp):
+    item = BeePixmapItem(QtGui.QImage())
+    item.crop = QtCore.QRectF(10, 20, 30, 40)
+    item.reset_crop = MagicMock()
+    command = commands.ResetTransforms([item])
+    command.redo()
+    command.undo()
+    assert item.crop == QtCore.QRectF(10, 20, 30, 40)
+    command.redo()
+    assert item.reset_crop.call_count == 2
+
+
+def test_insert_items_retained_bytes(view):
+    img = QtGui.QImage(20, 10, QtGui.QImage.Format.Format_RGB32)
+    item = BeePixmapItem(img)
+    command = commands.InsertItems(view.scene, [item, BeeTextItem('foo')])
+    command.redo()
+    assert command.retained_bytes() == 0
+    command.undo()
+    assert command.retained_bytes() == 800
+
+
+def test_delete_items_retained_bytes(view):
+    img = QtGui.QImage(20, 10, QtGui.QImage.Format.Format_RGB32)
+    item = BeePixmapItem(img)
+    view.scene.addItem(item)
+    command = commands.DeleteItems(view.scene, [item])
+    assert command.retained_bytes() == 0
+    command.redo()
+    assert command.retained_bytes() == 800
+
+
+def test_delete_items_spill(view):
+    img = QtGui.QImage(20, 10, QtGui.QImage.Format.Format_RGB32)
+    item = BeePixmapItem(img)
+    view.scene.addItem(item)
+    command = commands.DeleteItems(view.scene, [item])
+    command.redo()
+    assert command.spill() == 800
+    assert command.retained_bytes() == 0
+    command.undo()
+    assert item.scene() == view.scene
+    assert item.pixmap().size() == QtCore.QSize(20, 10)
+
+
+def test_undo_stack_iter_commands_includes_macros(qapp):
+    stack = commands.BeeUndoStack()
+    command1 = commands.MoveItemsBy([], QtCore.QPointF(1, 1))
+    stack.push(command1)
+    stack.beginMacro('foo')
+    command2 = commands.MoveItemsBy([], QtCore.QPointF(1, 1))
+    stack.push(command2)
+    stack.endMacro()
+    result = list(stack.iter_commands())
+    assert len(result) == 3
+    assert result[0] is command1
+    assert result[1].childCount() == 1
+    assert result[2] is command2
+
+
+def test_undo_stack_retained_bytes(view):
+    stack = commands.BeeUndoStack()
+    for i in range(2):
+        img = QtGui.QImage(20, 10, QtGui.QImage.Format.Format_RGB32)
+        item = BeePixmapItem(img)
+        view.scene.addItem(item)
+        stack.push(commands.DeleteItems(view.scene, [item]))
+    stack.push(commands.MoveItemsBy([], QtCore.QPointF(1, 1)))
+    assert stack.retained_bytes() == 1600
+
+
+def test_undo_stack_enforce_memory_budget_spills_oldest(view):
+    stack = commands.BeeUndoStack()
+    cmds = []
+    for i in range(3):
+        img = QtGui.QImage(20, 10, QtGui.QImage.Format.Format_RGB32)
+        item = BeePixmapItem(img)
+        view.scene.addItem(item)
+        cmds.append(commands.DeleteItems(view.scene, [item]))
+        stack.push(cmds[-1])
+    stack.enforce_memory_budget(1000)
+    assert cmds[0].retained_bytes() == 0
+    assert cmds[1].retained_bytes() == 0
+    assert cmds[2].retained_bytes() == 800
+    assert stack.retained_bytes() == 800
+
+
+def test_undo_stack_enforce_memory_budget_when_within_budget(view):
+    stack = commands.BeeUndoStack()
+    img = QtGui.QImage(20, 10, QtGui.QImage.Format.Format_RGB32)
+    item = BeePixmapItem(img)
+    view.scene.addItem(item)
+    stack.push(commands.DeleteItems(view.scene, [item]))
+    stack.enforce_memory_budget(1000)
+    assert stack.retained_bytes() == 800
@@ -0,0 +1,93 @@
+import math
+
+from pytest import approx
+
+from PyQt6 import QtCore, QtGui
+
+from beeref.geometry import GeometrySnapshot
+from beeref.items import BeePixmapItem
+
+
+def make_item(scene, width, height, x=0, y=0):
+    item = BeePixmapItem(QtGui.QImage())
+    item.crop = QtCore.QRectF(0, 0, width, height)
+    item.setPos(x, y)
+    scene.addItem(item)
+    return item
+
+
+def test_snapshot_rects_and_positions(view):
+    item1 = make_item(view.scene, 100, 80, 10, 20)
+    item2 = make_item(view.scene, 50, 40, -30, 5)
+    item2.setScale(2)
+    geometry = GeometrySnapshot([item1, item2])
+    assert len(geometry) == 2
+    assert geometry.rect(0) == QtCore.QRectF(10, 20, 100, 80)
+    assert geometry.rect(1) == QtCore.QRectF(-30, 5, 100, 80)
+    assert list(geometry.x) == [10, -30]
+    assert list(geometry.y) == [20, 5]
+
+
+def test_snapshot_does_not_follow_item_changes(view):
+    item = make_item(view.scene, 100, 80)
+    geometry = GeometrySnapshot([item])
+    item.setPos(50, 50)
+    assert geometry.rect(0) == QtCore.QRectF(0, 0, 100, 80)
+
+
+def test_snapshot_bounds(view):
+    item1 = make_item(view.scene, 100, 80, 10, 20)
+    item2 = make_item(view.scene, 50, 40, -30, 5)
+    geometry = GeometrySnapshot([item1, item2])
+    assert geometry.bounds() == QtCore.QRectF(-30, 5, 140, 95)
+    assert geometry.center() == QtCore.QPointF(40, 52.5)
+
+
+def test_snapshot_bounds_when_rotated(view):
+    item = make_item(view.scene, 100, 80)
+    item.setRotation(90)
+    geometry = GeometrySnapshot([item])
+    assert geometry.bounds() == QtCore.QRectF(-80, 0, 80, 100)
+
+
+def test_snapshot_bounds_when_empty():
+    geometry = GeometrySnapshot([])
+    assert geometry.bounds() == QtCore.QRectF(0, 0, 0, 0)
+
+
+def test_snapshot_normalize_factors(view):
+    item1 = make_item(view.scene, 100, 80)
+    item2 = make_item(view.scene, 50, 20)
+    geometry = GeometrySnapshot([item1, item2])
+    assert geometry.normalize_factors('width') == [0.75, 1.5]
+    assert geometry.normalize_factors('height') == [0.625, 2.5]
+    factors = geometry.normalize_factors('size')
+    assert factors == approx([math.sqrt(4500 / 8000), math.sqrt(4.5)])
+
+
+def test_snapshot_order(view):
+    item1 = make_item(view.scene, 10, 10, 50, 0)
+    item2 = make_item(view.scene, 10, 10, 0, 30)
+    item3 = make_item(view.scene, 10, 10, 20, -10)
+    geometry = GeometrySnapshot([item1, item2, item3])
+    assert geometry.order() == [1, 2, 0]
+    assert geometry.order(vertical=True) == [2, 0, 1]
+
+
+def test_snapshot_origin_offsets(view):
+    item1 = make_item(view.scene, 100, 80, 10, 20)
+    item2 = make_item(view.scene, 100, 80, 10, 20)
+    item2.setRotation(90)
+    geometry = GeometrySnapshot([item1, item2])
+    assert geometry.origin_offsets() == [
+        QtCore.QPointF(0, 0), QtCore.QPointF(80, 0)]
+
+
+def test_snapshot_scaled_positions_keep_centers(view):
+    item1 = make_item(view.scene, 100, 80, 10, 20)
+    item2 = make_item(view.scene, 100, 80, 10, 20)
+    item2.setRotation(90)
+    geometry = GeometrySnapshot([item1, item2])
+    positions = geometry.scaled_positions([2, 0.5])
+    assert positions[0] == approx((-40, -20))
+    assert positions[1] == approx((-10, 45))
@@ -0,0 +1,188 @@
+import random
+from unittest.mock import MagicMock
+
+import pytest
+
+from PyQt6 import QtCore
+
+from beeref import packing
+
+
+def random_sizes(n, seed=1):
+    rnd = random.Random(seed)
+    return [(rnd.randint(20, 200), rnd.randint(20, 200)) for i in range(n)]
+
+
+def overlapping(sizes, positions):
+    rects = [(x, y, x + w, y + h)
+             for (x, y), (w, h) in zip(positions, sizes)]
+    for i, a in enumerate(rects):
+        for b in rects[i + 1:]:
+            if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                return True
+    return False
+
+
+@pytest.mark.parametrize('algorithm', ['shelf', 'skyline', 'maxrects'])
+def test_algorithm_packs_within_width_without_overlap(algorithm):
+    sizes = random_sizes(100)
+    positions = packing.ALGORITHMS[algorithm](sizes, 1200)
+    assert len(positions) == 100
+    assert not overlapping(sizes, positions)
+    for (x, y), (w, h) in zip(positions, sizes):
+        assert x >= 0
+        assert y >= 0
+        assert x + w <= 1200
+
+
+@pytest.mark.parametrize('algorithm', ['shelf', 'skyline', 'maxrects'])
+def test_algorithm_packs_grid(algorithm):
+    sizes = [(100, 80)] * 4
+    positions = packing.ALGORITHMS[algorithm](sizes, 200)
+    assert set(positions) == {(0, 0), (100, 0), (0, 80), (100, 80)}
+
+
+@pytest.mark.parametrize('algorithm', ['shelf', 'skyline', 'maxrects'])
+def test_algorithm_can_be_interrupted(algorithm):
+    with pytest.raises(packing.PackingInterrupted):
+        packing.ALGORITHMS[algorithm](
+            random_sizes(10), 500, interrupted=lambda: True)
+
+
+def test_skyline_fills_gaps():
+    # The small items fit next to the high one, below the wide one
+    sizes = [(100, 100), (50, 50), (50, 50), (150, 20)]
+    positions = packing.pack_skyline(sizes, 150)
+    assert positions == [(0, 0), (100, 0), (100, 50), (0, 100)]
+
+
+def test_maxrects_fills_gaps():
+    sizes = [(100, 100), (150, 20), (50, 40), (50, 40)]
+    positions = packing.pack_maxrects(sizes, 150)
+    assert positions[0] == (0, 0)
+    assert positions[2:] == [(100, 0), (100, 40)]
+    assert positions[1] == (0, 100)
+
+
+def test_rpack_returns_none_when_too_small():
+    assert packing.pack_rpack([(100, 100), (100, 100)], 150) is None
+
+
+def test_layout_size_and_density():
+    layout = packing.Layout([(100, 50), (50, 50)], [(0, 0), (0, 50)],
+                            'shelf')
+    assert layout.width == 100
+    assert layout.height == 100
+    assert layout.density == 0.75
+    assert layout.score() == (100, 10000)
+
+
+def test_packing_job_widths():
+    job = packing.PackingJob(None, [(100, 100)] * 4, None)
+    widths = job.widths()
+    assert widths[0] == 200
+    assert widths[-1] == 300
+    assert widths == sorted(set(widths))
+
+
+def test_packing_job_widths_fit_widest_item():
+    job = packing.PackingJob(None, [(500, 10), (10, 10)], None)
+    assert job.widths()[0] == 500
+
+
+def test_packing_job_candidates():
+    job = packing.PackingJob(None, [(100, 100)] * 4, None,
+                             algorithm='maxrects')
+    widths = job.widths()
+    assert job.candidates() == (
+        [('shelf', w) for w in widths] + [('maxrects', w) for w in widths])
+    assert job.num_candidates() == 2 * len(widths)
+
+
+def test_packing_job_candidates_shelf():
+    job = packing.PackingJob(None, [(100, 100)] * 4, None,
+                             algorithm='shelf')
+    assert job.candidates() == [('shelf', w) for w in job.widths()]
+
+
+def test_packing_job_candidates_default_tries_rpack_for_few_items():
+    job = packing.PackingJob(
+        None, [(100, 100)] * packing.RPACK_MAX_ITEMS, None)
+    widths = job.widths()
+    assert job.candidates() == (
+        [('shelf', w) for w in widths]
+        + [(packing.DEFAULT_ALGORITHM, w) for w in widths]
+        + [('rpack', w) for w in widths])
+
+
+def test_packing_job_candidates_default_without_rpack_for_many_items():
+    job = packing.PackingJob(
+        None, [(100, 100)] * (packing.RPACK_MAX_ITEMS + 1), None)
+    assert 'rpack' not in {alg for alg, width in job.candidates()}
+
+
+def test_packing_job_run_default_at_least_as_dense_as_rpack():
+    sizes = random_sizes(25)
+    layout = packing.PackingJob(None, sizes, None, time_budget=None).run()
+    rpack_layout = packing.PackingJob(
+        None, sizes, None, algorithm='rpack', time_budget=None).run()
+    assert layout.score() <= rpack_layout.score()
+
+
+def test_packing_job_run_finds_best_layout():
+    on_improved = MagicMock()
+    on_progress = MagicMock()
+    job = packing.PackingJob(None, [(100, 80)] * 4, None,
+                             algorithm='skyline')
+    layout = job.run(on_improved=on_improved, on_progress=on_progress)
+    assert layout is job.layout
+    assert (layout.width, layout.height) == (200, 160)
+    assert on_improved.call_args_list[-1].args == (layout,)
+    assert on_progress.call_count == job.num_candidates()
+
+
+def test_packing_job_run_only_reports_improvements():
+    job = packing.PackingJob(None, random_sizes(50), None)
+    layouts = []
+    job.run(on_improved=layouts.append)
+    scores = [layout.score() for layout in layouts]
+    assert scores == sorted(scores, reverse=True)
+    assert len(set(scores)) == len(scores)
+
+
+def test_packing_job_run_without_time_budget_has_result():
+    job = packing.PackingJob(None, random_sizes(50), None,
+                             algorithm='maxrects', time_budget=0)
+    on_progress = MagicMock()
+    layout = job.run(on_progress=on_progress)
+    assert layout.algorithm == 'shelf'
+    on_progress.assert_called_once_with(1)
+
+
+def test_packing_job_run_when_canceled():
+    job = packing.PackingJob(None, random_sizes(50), None)
+    job.cancel()
+    assert job.run() is None
+    assert job.layout is None
+
+
+def test_threaded_packing(qtbot):
+    job = packing.PackingJob(None, [(100, 80)] * 4, None)
+    worker = packing.ThreadedPacking(job)
+    begin = MagicMock()
+    improved = MagicMock()
+    worker.begin_processing.connect(begin)
+    worker.improved.connect(improved)
+    with qtbot.waitSignal(worker.finished):
+        worker.start()
+    worker.wait()
+    begin.assert_called_once_with(job.num_candidates())
+    improved.assert_called()
+    assert (job.layout.width, job.layout.height) == (200, 160)
+
+
+def test_threaded_packing_on_canceled():
+    job = packing.PackingJob(None, [(100, 80)] * 4, QtCore.QPointF())
+    worker = packing.ThreadedPacking(job)
+    worker.on_canceled()
+    assert job.canceled is True
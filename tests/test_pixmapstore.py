@@ -0,0 +1,150 @@
+from unittest.mock import MagicMock
+
+from PyQt6 import QtGui
+
+from beeref.pixmapstore import (
+    key_from_data,
+    key_from_image,
+    pixmap_from_data,
+    PixmapStore,
+)
+
+
+def make_pixmap(width=10, height=10):
+    pixmap = QtGui.QPixmap(width, height)
+    pixmap.fill(QtGui.QColor(255, 0, 0))
+    return pixmap
+
+
+def test_key_from_data():
+    assert key_from_data(b'abc') == key_from_data(b'abc')
+    assert key_from_data(b'abc') != key_from_data(b'abd')
+
+
+def test_key_from_image(qapp):
+    img1 = QtGui.QImage(10, 10, QtGui.QImage.Format.Format_RGB32)
+    img1.fill(QtGui.QColor(255, 0, 0))
+    img2 = QtGui.QImage(10, 10, QtGui.QImage.Format.Format_RGB32)
+    img2.fill(QtGui.QColor(255, 0, 0))
+    assert key_from_image(img1) == key_from_image(img2)
+    img2.fill(QtGui.QColor(0, 255, 0))
+    assert key_from_image(img1) != key_from_image(img2)
+
+
+def test_key_from_image_takes_size_into_account(qapp):
+    img1 = QtGui.QImage(10, 20, QtGui.QImage.Format.Format_RGB32)
+    img1.fill(QtGui.QColor(255, 0, 0))
+    img2 = QtGui.QImage(20, 10, QtGui.QImage.Format.Format_RGB32)
+    img2.fill(QtGui.QColor(255, 0, 0))
+    assert key_from_image(img1) != key_from_image(img2)
+
+
+def test_pixmap_from_data(qapp, imgdata3x3):
+    pixmap = pixmap_from_data(imgdata3x3)
+    assert pixmap.width() == 3
+    assert pixmap.height() == 3
+
+
+def test_acquire_creates_pixmap(qapp):
+    store = PixmapStore()
+    factory = MagicMock(return_value=make_pixmap())
+    pixmap = store.acquire('foo', factory)
+    factory.assert_called_once_with()
+    assert pixmap.width() == 10
+    assert 'foo' in store
+    assert store.refcount('foo') == 1
+    assert store.resident_bytes == 400
+    assert store.unused_bytes == 0
+
+
+def test_acquire_shares_pixmap(qapp):
+    store = PixmapStore()
+    pixmap1 = store.acquire('foo', make_pixmap)
+    factory = MagicMock()
+    pixmap2 = store.acquire('foo', factory)
+    factory.assert_not_called()
+    assert pixmap1.cacheKey() == pixmap2.cacheKey()
+    assert store.refcount('foo') == 2
+    assert len(store) == 1
+    assert store.resident_bytes == 400
+
+
+def test_release_keeps_unused_pixmap(qapp):
+    store = PixmapStore()
+    store.acquire('foo', make_pixmap)
+    store.release('foo')
+    assert 'foo' in store
+    assert store.refcount('foo') == 0
+    assert store.unused_bytes == 400
+
+    factory = MagicMock()
+    store.acquire('foo', factory)
+    factory.assert_not_called()
+    assert store.unused_bytes == 0
+
+
+def test_release_unknown_key(qapp):
+    store = PixmapStore()
+    store.release('foo')
+    assert store.refcount('foo') == 0
+
+
+def test_release_evicts_least_recently_used(qapp):
+    store = PixmapStore(max_unused_bytes=800)
+    for key in ('foo', 'bar', 'baz'):
+        store.acquire(key, make_pixmap)
+    store.release('bar')
+    store.release('foo')
+    assert len(store) == 3
+    store.release('baz')
+    assert 'bar' not in store
+    assert 'foo' in store
+    assert 'baz' in store
+    assert store.unused_bytes == 800
+
+
+def test_release_doesnt_evict_referenced_pixmaps(qapp):
+    store = PixmapStore(max_unused_bytes=0)
+    store.acquire('foo', make_pixmap)
+    store.acquire('foo', make_pixmap)
+    store.release('foo')
+    assert 'foo' in store
+    store.release('foo')
+    assert 'foo' not in store
+    assert store.unused_bytes == 0
+
+
+def test_discard(qapp):
+    store = PixmapStore()
+    store.acquire('foo', make_pixmap)
+    store.acquire('bar', make_pixmap)
+    store.acquire('baz', make_pixmap)
+    store.release('bar')
+    store.release('baz')
+    assert store.discard('bar') is True
+    assert 'bar' not in store
+    assert 'baz' in store
+    assert store.unused_bytes == store._entries['baz'].nbytes
+
+
+def test_discard_when_referenced(qapp):
+    store = PixmapStore()
+    store.acquire('foo', make_pixmap)
+    assert store.discard('foo') is False
+    assert 'foo' in store
+
+
+def test_discard_when_missing(qapp):
+    store = PixmapStore()
+    assert store.discard('foo') is False
+
+
+def test_clear(qapp):
+    store = PixmapStore()
+    store.acquire('foo', make_pixmap)
+    store.acquire('bar', make_pixmap)
+    store.release('bar')
+    store.clear()
+    assert 'foo' in store
+    assert 'bar' not in store
+    assert store.unused_bytes == 0
@@ -0,0 +1,121 @@
+import json
+from unittest.mock import patch
+
+from beeref.profiler import Profiler, profiled
+
+
+def test_measure_when_disabled():
+    profiler = Profiler()
+    with profiler.measure('foo'):
+        pass
+    assert profiler.frame == {}
+    assert profiler.trace_events == []
+
+
+def test_measure_adds_up_within_frame():
+    profiler = Profiler()
+    profiler.enabled = True
+    with patch.object(profiler, 'now', side_effect=[10, 15, 20, 30]):
+        with profiler.measure('foo'):
+            pass
+        with profiler.measure('foo'):
+            pass
+    assert profiler.frame == {'foo': 15}
+    assert len(profiler.trace_events) == 2
+    event = profiler.trace_events[0]
+    assert event['name'] == 'foo'
+    assert event['ph'] == 'X'
+    assert event['ts'] == 10
+    assert event['dur'] == 5
+
+
+def test_measure_records_time_on_exception():
+    profiler = Profiler()
+    profiler.enabled = True
+    try:
+        with profiler.measure('foo'):
+            raise ValueError()
+    except ValueError:
+        pass
+    assert 'foo' in profiler.frame
+
+
+def test_trace_events_are_limited():
+    profiler = Profiler()
+    profiler.enabled = True
+    profiler.MAX_TRACE_EVENTS = 2
+    for i in range(3):
+        profiler.add_trace_event('foo', i, 1)
+    assert len(profiler.trace_events) == 2
+
+
+def test_end_frame():
+    profiler = Profiler()
+    profiler.enabled = True
+    profiler.frame = {'foo': 5}
+    profiler.end_frame(items_painted=3)
+    assert profiler.last_frame == {'foo': 5, 'items_painted': 3}
+    assert profiler.frame == {}
+
+
+def test_end_frame_when_disabled():
+    profiler = Profiler()
+    profiler.frame = {'foo': 5}
+    profiler.end_frame(items_painted=3)
+    assert profiler.last_frame == {}
+
+
+def test_end_frame_input_latency():
+    profiler = Profiler()
+    profiler.enabled = True
+    with patch.object(profiler, 'now', side_effect=[100, 150]):
+        profiler.mark_input()
+        # Only the first input event until the next frame counts:
+        profiler.mark_input()
+        profiler.end_frame()
+    assert profiler.last_frame['input_latency'] == 50
+    assert profiler.input_start is None
+    assert profiler.trace_events[0]['name'] == 'input_latency'
+
+
+def test_end_frame_without_input():
+    profiler = Profiler()
+    profiler.enabled = True
+    profiler.end_frame()
+    assert 'input_latency' not in profiler.last_frame
+
+
+def test_write_trace(tmpfile):
+    profiler = Profiler()
+    profiler.enabled = True
+    with profiler.measure('foo'):
+        pass
+    profiler.write_trace(tmpfile)
+    with open(tmpfile) as f:
+        trace = json.load(f)
+    assert trace['displayTimeUnit'] == 'ms'
+    assert trace['traceEvents'][0]['name'] == 'foo'
+
+
+@patch('beeref.profiler.profiler')
+def test_profiled(profiler_mock):
+    profiler_mock.enabled = True
+
+    @profiled('foo')
+    def func(x):
+        return x * 2
+
+    assert func(3) == 6
+    profiler_mock.measure.assert_called_once_with('foo')
+
+
+@patch('beeref.profiler.profiler')
+def test_profiled_when_disabled(profiler_mock):
+    profiler_mock.enabled = False
+
+    @profiled('foo')
+    def func(x):
+        return x * 2
+
+    assert func(3) == 6
+    profiler_mock.measure.assert_not_called()
@@ -1,6 +1,7 @@
 import math
 from unittest.mock import patch, MagicMock
 
+import pytest
 from pytest import approx
 
 from PyQt6 import QtCore, QtGui, QtWidgets
@@ -8,6 +9,7 @@ from PyQt6.QtCore import Qt
 
 from beeref import commands
 from beeref.items import BeePixmapItem, BeeTextItem
+from beeref.pixmapstore import pixmap_store
 
 
 def test_add_remove_item(view, item):
@@ -365,6 +367,54 @@ def test_arrange_optimal_when_no_items(view):
     view.scene.cancel_crop_mode.assert_called_once_with()
 
 
+@pytest.mark.parametrize('algorithm', ['shelf', 'skyline', 'maxrects'])
+def test_arrange_optimal_with_algorithm(view, algorithm):
+    for i in range(4):
+        item = BeePixmapItem(QtGui.QImage())
+        view.scene.addItem(item)
+        item.setSelected(True)
+        item.crop = QtCore.QRectF(0, 0, 100, 80)
+
+    view.scene.arrange_optimal(algorithm=algorithm)
+    expected_positions = {(-50, -40), (50, -40), (-50, 40), (50, 40)}
+    actual_positions = {
+        (i.pos().x(), i.pos().y())
+        for i in view.scene.selectedItems(user_only=True)}
+    assert expected_positions == actual_positions
+
+
+def test_create_packing_job(view):
+    items = []
+    for i in range(2):
+        item = BeePixmapItem(QtGui.QImage())
+        view.scene.addItem(item)
+        item.setSelected(True)
+        item.crop = QtCore.QRectF(0, 0, 100.4, 80)
+        item.setPos(i * 200, 0)
+        items.append(item)
+
+    job = view.scene.create_packing_job(algorithm='shelf', time_budget=3)
+    assert job.items == items
+    assert job.sizes == [(100, 80), (100, 80)]
+    assert job.center == QtCore.QPointF(150.2, 40)
+    assert job.algorithm == 'shelf'
+    assert job.time_budget == 3
+
+
+def test_create_packing_job_when_single_item(view, item):
+    view.scene.addItem(item)
+    item.setSelected(True)
+    assert view.scene.create_packing_job() is None
+
+
+def test_apply_packing_job_without_result(view, item):
+    view.scene.addItem(item)
+    view.scene.undo_stack = MagicMock(push=MagicMock())
+    job = MagicMock(items=[item], layout=None)
+    view.scene.apply_packing_job(job)
+    view.scene.undo_stack.push.assert_not_called()
+
+
 def test_flip_items(view, item):
     view.scene.addItem(item)
     item.setSelected(True)
@@ -840,6 +890,52 @@ def test_mouse_move_event_when_rubberband_not_new(
     assert mouse_mock.called_once_with(event)
 
 
+@patch('PyQt6.QtWidgets.QGraphicsScene.mouseMoveEvent')
+def test_mouse_move_event_when_rubberband_throttles_selection(
+        mouse_mock, view, imgfilename3x3):
+    item = BeePixmapItem(QtGui.QImage(imgfilename3x3))
+    item.setPos(50, 50)
+    view.scene.addItem(item)
+    view.scene.rubberband_active = True
+    view.scene.event_start = QtCore.QPointF(0, 0)
+    event = MagicMock(scenePos=MagicMock(return_value=QtCore.QPointF(10, 20)))
+    view.scene.mouseMoveEvent(event)
+    assert view.scene.rubberband_timer.isActive() is True
+
+    event = MagicMock(scenePos=MagicMock(return_value=QtCore.QPointF(60, 60)))
+    view.scene.mouseMoveEvent(event)
+    assert view.scene.rubberband_pending is True
+    assert item.isSelected() is False
+
+    view.scene.on_rubberband_timer()
+    assert view.scene.rubberband_pending is False
+    assert item.isSelected() is True
+
+
+def test_on_rubberband_timer_when_nothing_pending(view):
+    view.scene.rubberband_active = True
+    view.scene.rubberband_pending = False
+    view.scene.setSelectionArea = MagicMock()
+    view.scene.on_rubberband_timer()
+    view.scene.setSelectionArea.assert_not_called()
+
+
+@patch('PyQt6.QtWidgets.QGraphicsScene.mouseReleaseEvent')
+def test_mouse_release_event_when_rubberband_applies_pending_selection(
+        mouse_mock, view, imgfilename3x3):
+    item = BeePixmapItem(QtGui.QImage(imgfilename3x3))
+    view.scene.addItem(item)
+    view.scene.rubberband_active = True
+    view.scene.rubberband_item.fit(QtCore.QPointF(0, 0),
+                                   QtCore.QPointF(10, 10))
+    view.scene.rubberband_pending = True
+    view.scene.rubberband_timer.start()
+    view.scene.mouseReleaseEvent(MagicMock())
+    assert item.isSelected() is True
+    assert view.scene.rubberband_pending is False
+    assert view.scene.rubberband_timer.isActive() is False
+
+
 @patch('PyQt6.QtWidgets.QGraphicsScene.mouseMoveEvent')
 def test_mouse_move_event_when_no_rubberband(mouse_mock, view, imgfilename3x3):
     item = BeePixmapItem(QtGui.QImage(imgfilename3x3))
@@ -996,6 +1092,87 @@ def test_items_for_save(view):
     assert items == [item1, item2]
 
 
+def test_items_for_save_in_stacking_order(view):
+    item1 = BeePixmapItem(QtGui.QImage())
+    item1.setZValue(2)
+    view.scene.addItem(item1)
+    item2 = BeePixmapItem(QtGui.QImage())
+    item2.setZValue(1)
+    view.scene.addItem(item2)
+    item3 = BeeTextItem('foo')
+    item3.setZValue(1)
+    view.scene.addItem(item3)
+
+    items = list(view.scene.items_for_save())
+    assert items == [item2, item3, item1]
+
+
+def test_user_items(view):
+    item1 = BeePixmapItem(QtGui.QImage())
+    view.scene.addItem(item1)
+    item2 = BeeTextItem('foo')
+    view.scene.addItem(item2)
+    view.scene.addItem(QtWidgets.QGraphicsRectItem())
+    assert view.scene.user_items() == [item1, item2]
+    view.scene.removeItem(item1)
+    assert view.scene.user_items() == [item2]
+    view.scene.clear()
+    assert view.scene.user_items() == []
+
+
+def test_clear_with_selected_items(view):
+    item1 = BeePixmapItem(QtGui.QImage())
+    view.scene.addItem(item1)
+    item2 = BeeTextItem('foo')
+    view.scene.addItem(item2)
+    view.scene.set_selected_all_items(True)
+    view.scene.clear()
+    assert view.scene.user_items() == []
+    assert view.scene.selectedItems(user_only=True) == []
+    assert view.scene.has_selection() is False
+
+
+def test_selected_items_user_only_doesnt_query_qt(view):
+    item = BeePixmapItem(QtGui.QImage())
+    view.scene.addItem(item)
+    item.setSelected(True)
+    with patch('PyQt6.QtWidgets.QGraphicsScene.selectedItems') as qt_mock:
+        assert view.scene.selectedItems(user_only=True) == [item]
+        assert view.scene.has_selection() is True
+        assert view.scene.has_single_selection() is True
+        assert view.scene.has_multi_selection() is False
+        assert view.scene.has_croppable_selection() is True
+        qt_mock.assert_not_called()
+
+
+def test_selected_items_user_only_after_clear_selection(view):
+    item1 = BeePixmapItem(QtGui.QImage())
+    view.scene.addItem(item1)
+    item1.setSelected(True)
+    item2 = BeePixmapItem(QtGui.QImage())
+    view.scene.addItem(item2)
+    item2.setSelected(True)
+    view.scene.clearSelection()
+    assert view.scene.selectedItems(user_only=True) == []
+    assert view.scene.has_selection() is False
+
+
+def test_selected_items_user_only_after_remove(view):
+    item = BeePixmapItem(QtGui.QImage())
+    view.scene.addItem(item)
+    item.setSelected(True)
+    view.scene.removeItem(item)
+    assert view.scene.selectedItems(user_only=True) == []
+    assert view.scene.has_selection() is False
+
+
+def test_selected_items_user_only_when_added_selected(view):
+    item = BeePixmapItem(QtGui.QImage())
+    item.setSelected(True)
+    view.scene.addItem(item)
+    assert view.scene.selectedItems(user_only=True) == [item]
+
+
 def test_clear_save_ids(view):
     item1 = BeePixmapItem(QtGui.QImage())
     item1.save_id = 5
@@ -1011,6 +1188,20 @@ def test_clear_save_ids(view):
     assert hasattr(item3, 'save_id') is False
 
 
+def test_detach_items_from_file(view, imgdata3x3):
+    item1 = BeePixmapItem(QtGui.QImage())
+    item1.defer_pixmap(QtCore.QSize(3, 3),
+                       MagicMock(return_value=imgdata3x3))
+    view.scene.addItem(item1)
+    item1.mipmap_loader = MagicMock()
+    item2 = BeeTextItem('foo')
+    view.scene.addItem(item2)
+    view.scene.detach_items_from_file()
+    assert item1.image_data == imgdata3x3
+    assert item1.mipmap_loader is None
+    assert item1.pixmap_bytes() == 0
+
+
 def test_on_view_scale_change(view, item):
     view.scene.addItem(item)
     item.setSelected(True)
@@ -1019,6 +1210,160 @@ def test_on_view_scale_change(view, item):
     item.on_view_scale_change.assert_called_once()
 
 
+def make_pixmap_item(color, width=100, height=100):
+    img = QtGui.QImage(width, height, QtGui.QImage.Format.Format_RGB32)
+    img.fill(QtGui.QColor(*color))
+    return BeePixmapItem(img)
+
+
+def test_pixmap_bytes(view):
+    item1 = make_pixmap_item((255, 0, 0))
+    view.scene.addItem(item1)
+    item2 = make_pixmap_item((0, 255, 0), width=200)
+    view.scene.addItem(item2)
+    view.scene.addItem(BeeTextItem('foo'))
+    assert view.scene.pixmap_bytes() == 120000
+
+
+def test_pixmap_bytes_counts_shared_pixmaps_once(view):
+    item = make_pixmap_item((255, 0, 0))
+    view.scene.addItem(item)
+    view.scene.addItem(item.create_copy())
+    assert view.scene.pixmap_bytes() == 40000
+
+
+def test_enforce_memory_budget_when_within_budget(view):
+    item = make_pixmap_item((255, 0, 0))
+    item.setPos(5000, 5000)
+    view.scene.addItem(item)
+    assert view.scene.enforce_memory_budget(
+        40000, QtCore.QRectF(0, 0, 100, 100)) == 0
+    assert item.pixmap_bytes() == 40000
+
+
+def test_enforce_memory_budget_unloads_farthest_items_first(view):
+    near = make_pixmap_item((255, 0, 0))
+    near.setPos(1000, 0)
+    view.scene.addItem(near)
+    far = make_pixmap_item((0, 255, 0))
+    far.setPos(5000, 0)
+    view.scene.addItem(far)
+    assert view.scene.enforce_memory_budget(
+        40000, QtCore.QRectF(0, 0, 100, 100)) == 1
+    assert near.pixmap_bytes() == 40000
+    assert far.pixmap_bytes() == 0
+    assert view.scene.pixmap_bytes() == 40000
+
+
+def test_enforce_memory_budget_keeps_items_near_visible_area(view):
+    visible = make_pixmap_item((255, 0, 0))
+    view.scene.addItem(visible)
+    near = make_pixmap_item((0, 255, 0))
+    near.setPos(150, 150)
+    view.scene.addItem(near)
+    assert view.scene.enforce_memory_budget(
+        0, QtCore.QRectF(0, 0, 100, 100)) == 0
+    assert visible.pixmap_bytes() == 40000
+    assert near.pixmap_bytes() == 40000
+
+
+def test_enforce_memory_budget_unloads_all_users_of_shared_pixmap(view):
+    item1 = make_pixmap_item((12, 34, 56))
+    item1.setPos(5000, 0)
+    view.scene.addItem(item1)
+    item2 = item1.create_copy()
+    item2.setPos(6000, 0)
+    view.scene.addItem(item2)
+    key = item1.pixmap_key
+    assert view.scene.enforce_memory_budget(
+        0, QtCore.QRectF(0, 0, 100, 100)) == 2
+    assert view.scene.pixmap_bytes() == 0
+    assert key not in pixmap_store
+
+
+def test_enforce_memory_budget_keeps_other_unused_pixmaps(view):
+    unused = make_pixmap_item((65, 43, 21))
+    key = unused.pixmap_key
+    unused.unload_pixmap()
+    assert key in pixmap_store
+    item = make_pixmap_item((12, 34, 56))
+    item.setPos(5000, 0)
+    view.scene.addItem(item)
+    assert view.scene.enforce_memory_budget(
+        0, QtCore.QRectF(0, 0, 100, 100)) == 1
+    assert key in pixmap_store
+
+
+def test_items_bounding_rect_is_cached(view):
+    item = BeePixmapItem(QtGui.QImage())
+    view.scene.addItem(item)
+    item.setPos(4, -6)
+    assert view.scene.itemsBoundingRect() == QtCore.QRectF(4, -6, 0, 0)
+    with patch.object(view.scene, '_bounding_rect') as rect_mock:
+        assert view.scene.itemsBoundingRect() == QtCore.QRectF(4, -6, 0, 0)
+        rect_mock.assert_not_called()
+
+
+def test_items_bounding_rect_returns_copy_of_cache(view):
+    item = BeePixmapItem(QtGui.QImage())
+    view.scene.addItem(item)
+    rect = view.scene.itemsBoundingRect()
+    rect.setWidth(100)
+    assert view.scene.itemsBoundingRect() == QtCore.QRectF(0, 0, 0, 0)
+
+
+def test_items_bounding_rect_updates_when_item_moved_by_qt(view):
+    item = BeePixmapItem(QtGui.QImage())
+    view.scene.addItem(item)
+    view.scene.itemsBoundingRect()
+    # Bypass our own setPos, like Qt does when dragging items:
+    QtWidgets.QGraphicsPixmapItem.setPos(item, 10, 20)
+    assert view.scene.itemsBoundingRect() == QtCore.QRectF(10, 20, 0, 0)
+
+
+def test_items_bounding_rect_updates_when_item_transformed(
+        view, imgfilename3x3):
+    item = BeePixmapItem(QtGui.QImage(imgfilename3x3))
+    view.scene.addItem(item)
+    assert view.scene.itemsBoundingRect() == QtCore.QRectF(0, 0, 3, 3)
+    item.setScale(2)
+    assert view.scene.itemsBoundingRect() == QtCore.QRectF(0, 0, 6, 6)
+    item.setRotation(90)
+    assert view.scene.itemsBoundingRect() == QtCore.QRectF(-6, 0, 6, 6)
+    item.do_flip()
+    assert view.scene.itemsBoundingRect() == QtCore.QRectF(0, 0, 6, 6)
+
+
+def test_items_bounding_rect_updates_when_item_cropped(view, imgfilename3x3):
+    item = BeePixmapItem(QtGui.QImage(imgfilename3x3))
+    view.scene.addItem(item)
+    view.scene.itemsBoundingRect()
+    item.crop = QtCore.QRectF(1, 1, 2, 2)
+    assert view.scene.itemsBoundingRect() == QtCore.QRectF(1, 1, 2, 2)
+
+
+def test_items_bounding_rect_updates_when_text_changed(view):
+    item = BeeTextItem('foo')
+    view.scene.addItem(item)
+    width = view.scene.itemsBoundingRect().width()
+    item.setPlainText('foo bar baz')
+    assert view.scene.itemsBoundingRect().width() > width
+
+
+def test_items_bounding_rect_updates_when_items_added_or_removed(view):
+    item1 = BeePixmapItem(QtGui.QImage())
+    view.scene.addItem(item1)
+    view.scene.itemsBoundingRect()
+    item2 = BeePixmapItem(QtGui.QImage())
+    item2.setPos(10, 10)
+    view.scene.addItem(item2)
+    assert view.scene.itemsBoundingRect() == QtCore.QRectF(0, 0, 10, 10)
+    view.scene.removeItem(item1)
+    assert view.scene.itemsBoundingRect() == QtCore.QRectF(10, 10, 0, 0)
+    view.scene.clear()
+    assert view.scene.itemsBoundingRect() == QtCore.QRectF(0, 0, 0, 0)
+
+
 def test_items_bounding_rect_given_items(view):
     item1 = BeePixmapItem(QtGui.QImage())
     view.scene.addItem(item1)
@@ -1206,6 +1551,7 @@ def test_add_queued_items_unselected(view):
     assert item.isSelected() is False
     assert view.scene.max_z == 0.33
     assert item.toPlainText() == 'foo'
+    assert item.dirty is False
 
 
 def test_add_queued_items_selected(view):
@@ -1231,3 +1577,60 @@ def test_add_queued_items_ignores_unknown_type(view):
     assert len(view.scene.items()) == 1
     item = view.scene.items()[0]
     assert item.toPlainText() == 'Item of unknown type: foo'
+
+
+def test_add_queued_items_with_time_budget(view):
+    for i in range(3):
+        data = {'type': 'text', 'z': 0.33, 'data': {'text': 'foo'}}
+        view.scene.add_item_later(data, selected=False)
+    with patch('beeref.scene.QtCore.QElapsedTimer.elapsed',
+               side_effect=[0, 1, 9]):
+        view.scene.add_queued_items(time_budget=8)
+    assert len(view.scene.items()) == 2
+    assert view.scene.items_to_add.qsize() == 1
+    assert view.scene.add_items_timer.isActive() is True
+
+
+def test_add_queued_items_batch(view):
+    with patch.object(view.scene, 'add_queued_items') as add_mock:
+        view.scene.add_queued_items_batch()
+        add_mock.assert_called_once_with(
+            time_budget=view.scene.ADD_ITEMS_TIME_BUDGET)
+
+
+def test_add_item_later_when_queue_full_in_main_thread(view):
+    for i in range(view.scene.MAX_QUEUED_ITEMS + 1):
+        data = {'type': 'text', 'z': 0.33, 'data': {'text': 'foo'}}
+        view.scene.add_item_later(data, selected=False)
+    assert len(view.scene.items()) == view.scene.MAX_QUEUED_ITEMS
+    assert view.scene.items_to_add.qsize() == 1
+
+
+def test_bulk_transform_suspends_index_for_many_items(view):
+    items = [BeePixmapItem(QtGui.QImage()) for i in range(4)]
+    for item in items:
+        view.scene.addItem(item)
+    with view.scene.bulk_transform(items[:2]):
+        assert (view.scene.itemIndexMethod()
+                == QtWidgets.QGraphicsScene.ItemIndexMethod.NoIndex)
+    assert (view.scene.itemIndexMethod()
+            == QtWidgets.QGraphicsScene.ItemIndexMethod.BspTreeIndex)
+
+
+def test_bulk_transform_keeps_index_for_few_items(view):
+    items = [BeePixmapItem(QtGui.QImage()) for i in range(4)]
+    for item in items:
+        view.scene.addItem(item)
+    with view.scene.bulk_transform(items[:1]):
+        assert (view.scene.itemIndexMethod()
+                == QtWidgets.QGraphicsScene.ItemIndexMethod.BspTreeIndex)
+
+
+def test_bulk_transform_restores_index_on_error(view):
+    item = BeePixmapItem(QtGui.QImage())
+    view.scene.addItem(item)
+    with pytest.raises(ValueError):
+        with view.scene.bulk_transform([item]):
+            raise ValueError()
+    assert (view.scene.itemIndexMethod()
+            == QtWidgets.QGraphicsScene.ItemIndexMethod.BspTreeIndex)
@@ -0,0 +1,39 @@
+import os.path
+
+from beeref.spillstore import SpillStore
+
+
+def test_put_and_get():
+    store = SpillStore()
+    key = store.put(b'foo')
+    assert key in store
+    assert store.get(key) == b'foo'
+    assert store.disk_bytes == 3
+
+
+def test_put_same_data_twice_stores_once():
+    store = SpillStore()
+    key1 = store.put(b'foo')
+    key2 = store.put(b'foo')
+    assert key1 == key2
+    assert len(store) == 1
+    assert store.disk_bytes == 3
+
+
+def test_release_removes_file_when_unreferenced():
+    store = SpillStore()
+    key = store.put(b'foo')
+    store.put(b'foo')
+    path = store.path(key)
+    store.release(key)
+    assert os.path.exists(path)
+    store.release(key)
+    assert not os.path.exists(path)
+    assert key not in store
+    assert store.disk_bytes == 0
+
+
+def test_release_unreferenced_key():
+    store = SpillStore()
+    store.release('foo')
+    assert len(store) == 0
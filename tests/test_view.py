@@ -6,6 +6,7 @@ from unittest.mock import MagicMock, patch, mock_open
 from PyQt6 import QtCore, QtGui, QtWidgets
 from PyQt6.QtCore import Qt
 
+from beeref import commands, fileio
 from beeref.config import logfile_name
 from beeref.items import BeePixmapItem, BeeTextItem
 from beeref.view import BeeGraphicsView
@@ -39,6 +40,20 @@ def test_init_with_filename(open_file_mock, view, qapp, commandline_args):
     del view
 
 
+@patch('beeref.view.profiler')
+def test_init_with_profile(profiler_mock, qapp, commandline_args):
+    commandline_args.profile = True
+    parent = QtWidgets.QMainWindow()
+    view = BeeGraphicsView(qapp, parent)
+    assert profiler_mock.enabled is True
+    assert view.profiler_overlay.isVisible() is True
+    del view
+
+
+def test_init_without_profile(view):
+    assert not hasattr(view, 'profiler_overlay')
+
+
 @patch('beeref.widgets.WelcomeOverlay.hide')
 def test_on_scene_changed_when_items(hide_mock, view):
     item = BeePixmapItem(QtGui.QImage())
@@ -149,9 +164,8 @@ def test_fit_rect_toggle_when_previous(center_mock, fit_mock, view):
 
 
 @patch('beeref.view.BeeGraphicsView.clear_scene')
-def test_open_from_file(clear_mock, view, qtbot):
-    root = os.path.dirname(__file__)
-    filename = os.path.join(root, 'assets', 'test1item.bee')
+def test_open_from_file(clear_mock, view, qtbot, beefilename1item):
+    filename = beefilename1item
     view.on_loading_finished = MagicMock()
     view.open_from_file(filename)
     view.worker.wait()
@@ -164,6 +178,201 @@ def test_open_from_file(clear_mock, view, qtbot):
     view.on_loading_finished.assert_called_once_with(filename, [])
 
 
+@patch('beeref.view.BeeGraphicsView.clear_scene')
+def test_open_from_file_lazy_setting(clear_mock, view):
+    root = os.path.dirname(__file__)
+    filename = os.path.join(root, 'assets', 'test1item.bee')
+    view.settings.setValue('FileIO/lazy_loading', False)
+    with patch('beeref.view.fileio.ThreadedIO') as threaded_mock:
+        view.open_from_file(filename)
+        threaded_mock.assert_called_once_with(
+            fileio.load_bee, filename, view.scene, lazy=False)
+
+
+def test_do_save_sqlite_settings(view, tmpdir):
+    filename = os.path.join(tmpdir, 'test.bee')
+    view.settings.setValue('FileIO/journal_mode', 'WAL')
+    view.settings.setValue('FileIO/synchronous', 'NORMAL')
+    with patch('beeref.view.fileio.ThreadedIO') as threaded_mock:
+        view.do_save(filename, create_new=True)
+        threaded_mock.assert_called_once_with(
+            fileio.save_bee, filename, view.scene, create_new=True,
+            journal_mode='WAL', synchronous='NORMAL')
+
+
+def test_paint_event_loads_deferred_pixmaps(view, imgdata3x3):
+    item = BeePixmapItem(QtGui.QImage())
+    item.defer_pixmap(QtCore.QSize(3, 3), MagicMock(return_value=imgdata3x3))
+    view.scene.addItem(item)
+    view.centerOn(item)
+    view.viewport().repaint()
+    assert item.pixmap_loader is None
+
+
+def test_paint_event_keeps_deferred_pixmaps_when_mipmap_suffices(
+        view, imgdata3x3):
+    item = BeePixmapItem(QtGui.QImage())
+    loader = MagicMock(return_value=None)
+    item.defer_pixmap(QtCore.QSize(2000, 1000), loader)
+    item.mipmap_loader = MagicMock(return_value=imgdata3x3)
+    item.setScale(0.1)
+    view.scene.addItem(item)
+    view.centerOn(item)
+    view.viewport().repaint()
+    assert item.pixmap_loader is loader
+    loader.assert_not_called()
+
+
+def test_paint_event_starts_memory_timer(view):
+    view.memory_timer.stop()
+    view.viewport().repaint()
+    assert view.memory_timer.isActive() is True
+
+
+@patch('beeref.view.profiler')
+def test_paint_event_ends_profiler_frame(profiler_mock, view):
+    img = QtGui.QImage(10, 10, QtGui.QImage.Format.Format_RGB32)
+    view.scene.addItem(BeePixmapItem(img))
+    view.viewport().repaint()
+    profiler_mock.measure.assert_called_with('paint')
+    profiler_mock.end_frame.assert_called_once_with(items_painted=1)
+
+
+@patch('beeref.view.profiler')
+def test_viewport_event_marks_input_when_profiling(profiler_mock, view):
+    profiler_mock.enabled = True
+    event = QtGui.QKeyEvent(
+        QtCore.QEvent.Type.KeyPress,
+        Qt.Key.Key_A,
+        Qt.KeyboardModifier.NoModifier)
+    view.viewportEvent(event)
+    profiler_mock.mark_input.assert_called_once_with()
+
+
+@patch('beeref.view.profiler')
+def test_viewport_event_doesnt_mark_other_events(profiler_mock, view):
+    profiler_mock.enabled = True
+    view.viewportEvent(QtCore.QEvent(QtCore.QEvent.Type.Show))
+    profiler_mock.mark_input.assert_not_called()
+
+
+def test_enforce_memory_budget(view, settings):
+    settings.setValue('Memory/pixmap_budget', 100)
+    view.scene.enforce_memory_budget = MagicMock()
+    view.enforce_memory_budget()
+    args = view.scene.enforce_memory_budget.call_args[0]
+    assert args[0] == 100 * 1024 * 1024
+    assert isinstance(args[1], QtCore.QRectF)
+
+
+def test_enforce_memory_budget_when_unlimited(view, settings):
+    settings.setValue('Memory/pixmap_budget', 0)
+    view.scene.enforce_memory_budget = MagicMock()
+    view.enforce_memory_budget()
+    view.scene.enforce_memory_budget.assert_not_called()
+
+
+def test_enforce_undo_budget(view, settings):
+    settings.setValue('Memory/undo_budget', 100)
+    view.undo_stack.enforce_memory_budget = MagicMock()
+    view.enforce_undo_budget()
+    view.undo_stack.enforce_memory_budget.assert_called_once_with(
+        100 * 1024 * 1024)
+
+
+def test_enforce_undo_budget_when_unlimited(view, settings):
+    settings.setValue('Memory/undo_budget', 0)
+    view.undo_stack.enforce_memory_budget = MagicMock()
+    view.enforce_undo_budget()
+    view.undo_stack.enforce_memory_budget.assert_not_called()
+
+
+def test_get_arrange_options_default(view, settings):
+    assert view.get_arrange_options() == {
+        'algorithm': 'skyline', 'time_budget': 1}
+
+
+def test_get_arrange_options_from_settings(view, settings):
+    settings.setValue('Arrange/algorithm', 'maxrects')
+    settings.setValue('Arrange/time_budget', 500)
+    assert view.get_arrange_options() == {
+        'algorithm': 'maxrects', 'time_budget': 0.5}
+
+
+def test_get_arrange_options_unknown_algorithm(view, settings):
+    settings.setValue('Arrange/algorithm', 'foo')
+    assert view.get_arrange_options()['algorithm'] == 'skyline'
+
+
+def test_get_import_options_default(view, settings):
+    assert view.get_import_options() == {
+        'policy': 'original', 'max_size': 4096}
+
+
+def test_get_import_options_from_settings(view, settings):
+    settings.setValue('Import/policy', 'proxy')
+    settings.setValue('Import/max_size', 2000)
+    assert view.get_import_options() == {
+        'policy': 'proxy', 'max_size': 2000}
+
+
+def test_get_import_options_unknown_policy(view, settings):
+    settings.setValue('Import/policy', 'foo')
+    assert view.get_import_options()['policy'] == 'original'
+
+
+@patch('beeref.widgets.BeeProgressDialog')
+def test_do_insert_images_passes_import_options(
+        dialog_mock, view, settings, imgfilename3x3):
+    settings.setValue('Import/policy', 'cap')
+    settings.setValue('Import/max_size', 2000)
+    with patch('beeref.view.fileio.ThreadedIO') as threaded_mock:
+        view.do_insert_images([imgfilename3x3])
+    threaded_mock.assert_called_once()
+    assert threaded_mock.call_args.kwargs == {
+        'policy': 'cap', 'max_size': 2000}
+    assert '2000 px' in dialog_mock.call_args.args[0]
+    view.undo_stack.endMacro()
+
+
+def test_on_action_arrange_optimal(view, qtbot):
+    for i in range(4):
+        item = BeePixmapItem(QtGui.QImage())
+        view.scene.addItem(item)
+        item.setSelected(True)
+        item.crop = QtCore.QRectF(0, 0, 100, 80)
+
+    view.on_action_arrange_optimal()
+    qtbot.waitUntil(lambda: view.undo_stack.count() == 1)
+    assert isinstance(view.undo_stack.command(0), commands.ArrangeItems)
+    positions = {(i.pos().x(), i.pos().y())
+                 for i in view.scene.selectedItems(user_only=True)}
+    assert positions == {(-50, -40), (50, -40), (-50, 40), (50, 40)}
+
+
+def test_on_action_arrange_optimal_when_single_item(view, item):
+    view.scene.addItem(item)
+    item.setSelected(True)
+    view.on_action_arrange_optimal()
+    assert view.undo_stack.count() == 0
+
+
+def test_undo_stack_change_enforces_undo_budget(view, settings):
+    settings.setValue('Memory/undo_budget', 100)
+    view.undo_stack.enforce_memory_budget = MagicMock()
+    view.undo_stack.push(commands.MoveItemsBy([], QtCore.QPointF(1, 1)))
+    view.undo_stack.enforce_memory_budget.assert_called_once_with(
+        100 * 1024 * 1024)
+
+
+def test_on_selection_changed_schedules_update(view):
+    view.viewport().update = MagicMock()
+    view.viewport().repaint = MagicMock()
+    view.on_selection_changed()
+    view.viewport().update.assert_called_once_with()
+    view.viewport().repaint.assert_not_called()
+
+
 def test_open_from_file_when_error(view, qtbot):
     view.on_loading_finished = MagicMock()
     view.open_from_file('uieauiae')
@@ -175,11 +384,10 @@ def test_open_from_file_when_error(view, qtbot):
 
 
 @patch('PyQt6.QtWidgets.QFileDialog.getOpenFileName')
-def test_on_action_open(dialog_mock, view, qtbot):
+def test_on_action_open(dialog_mock, view, qtbot, beefilename1item):
     # FIXME: #1
     # Can't check signal handling currently
-    root = os.path.dirname(__file__)
-    filename = os.path.join(root, 'assets', 'test1item.bee')
+    filename = beefilename1item
     dialog_mock.return_value = (filename, None)
     view.on_loading_finished = MagicMock()
     view.scene.cancel_crop_mode = MagicMock()
@@ -306,6 +514,19 @@ def test_on_action_debuglog(show_mock, view):
         open_mock.assert_called_once_with(logfile_name())
 
 
+@patch('PyQt6.QtWidgets.QMessageBox.information')
+def test_on_action_memory_usage(msg_mock, view):
+    img = QtGui.QImage(1024, 512, QtGui.QImage.Format.Format_RGB32)
+    view.scene.addItem(BeePixmapItem(img))
+    view.scene.addItem(BeeTextItem('foo'))
+    view.on_action_memory_usage()
+    msg_mock.assert_called_once()
+    text = msg_mock.call_args[0][2]
+    assert 'Images in memory: 1 of 1' in text
+    assert 'Resident: 2.0 MB' in text
+    assert 'Undo history: 0.0 MB' in text
+
+
 @patch('beeref.scene.BeeGraphicsScene.clearSelection')
 @patch('PyQt6.QtWidgets.QFileDialog.getOpenFileNames')
 def test_on_action_insert_images_new_scene(
@@ -1,10 +1,15 @@
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 from PyQt6 import QtCore, QtWidgets
 from PyQt6.QtCore import Qt
 
 from beeref.config import logfile_name
-from beeref.widgets import DebugLogDialog, RecentFilesModel
+from beeref.profiler import profiler
+from beeref.widgets import (
+    DebugLogDialog,
+    ProfilerOverlay,
+    RecentFilesModel,
+)
 
 
 def test_debug_log_dialog(qtbot, settings, view):
@@ -38,3 +43,20 @@ def test_recent_files_model_data_fontrole(view):
     index.row.return_value = 1
     font = model.data(index, QtCore.Qt.ItemDataRole.FontRole)
     assert font.underline() is True
+
+
+def test_profiler_overlay_update_text(view):
+    overlay = ProfilerOverlay(view)
+    with patch.object(profiler, 'last_frame', {'paint': 2500,
+                                               'items_painted': 7}):
+        overlay.update_text()
+    text = overlay.text()
+    assert 'Paint: 2.50 ms' in text
+    assert 'Items painted: 7' in text
+    assert 'Input latency: -' in text
+
+
+def test_profiler_overlay_transparent_for_mouse_events(view):
+    overlay = ProfilerOverlay(view)
+    assert overlay.testAttribute(
+        Qt.WidgetAttribute.WA_TransparentForMouseEvents) is True